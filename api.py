@@ -5,7 +5,240 @@ import logging
 import os
 import time
 import hashlib
+from collections import OrderedDict
 from config import Config
+from member_store import member_store
+from metrics import ApiMetrics
+from shared_state import global_state
+
+class ApiResponseCache:
+    """按接口策略缓存只读API的响应，未在策略表中的接口一律不缓存
+    
+    缓存中保存响应的私有副本，命中时返回新的副本：插件修改拿到的结果不会影响缓存和其他插件。
+    """
+    def __init__(self, policies):
+        self.policies = {}
+        for endpoint, policy in (policies or {}).items():
+            ttl = float(policy.get("ttl", 0))
+            max_size = int(policy.get("max_size", 0))
+            if ttl > 0 and max_size > 0:
+                self.policies[endpoint] = (ttl, max_size)
+        
+        self._stores = {endpoint: OrderedDict() for endpoint in self.policies}
+        self.stats = {endpoint: {"hits": 0, "misses": 0, "bypass": 0, "evictions": 0, "invalidations": 0, "patches": 0} for endpoint in self.policies}
+    
+    def is_cacheable(self, endpoint):
+        return endpoint in self.policies
+    
+    @staticmethod
+    def make_key(params):
+        if not params:
+            return "{}"
+        # 数字ID统一按字符串处理，123 和 "123" 命中同一条缓存
+        return json.dumps({
+            k: str(v) if isinstance(v, int) and not isinstance(v, bool) else v
+            for k, v in params.items() if k != "no_cache"
+        }, sort_keys=True)
+    
+    @staticmethod
+    def _clone(value):
+        """复制 JSON 结构的响应（只有字典和列表需要复制），比 copy.deepcopy 省去备忘表开销"""
+        if isinstance(value, dict):
+            return {k: ApiResponseCache._clone(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [ApiResponseCache._clone(v) for v in value]
+        return value
+    
+    def get(self, endpoint, params):
+        """命中返回缓存结果的副本，未命中或传入 no_cache 时返回 None"""
+        store = self._stores.get(endpoint)
+        if store is None:
+            return None
+        
+        stats = self.stats[endpoint]
+        if params and params.get("no_cache"):
+            stats["bypass"] += 1
+            return None
+        
+        key = self.make_key(params)
+        entry = store.get(key)
+        if entry is None:
+            stats["misses"] += 1
+            return None
+        
+        if entry[0] <= time.time():
+            del store[key]
+            stats["misses"] += 1
+            return None
+        
+        store.move_to_end(key)
+        stats["hits"] += 1
+        return self._clone(entry[1])
+    
+    def put(self, endpoint, params, result):
+        store = self._stores.get(endpoint)
+        if store is None:
+            return
+        
+        ttl, max_size = self.policies[endpoint]
+        key = self.make_key(params)
+        store[key] = (time.time() + ttl, self._clone(result))
+        store.move_to_end(key)
+        
+        while len(store) > max_size:
+            store.popitem(last=False)
+            self.stats[endpoint]["evictions"] += 1
+    
+    def invalidate(self, endpoint, params=None):
+        """删除指定接口的缓存，params 为空时清空该接口全部缓存"""
+        store = self._stores.get(endpoint)
+        if not store:
+            return 0
+        
+        if params is None:
+            count = len(store)
+            store.clear()
+        else:
+            count = 1 if store.pop(self.make_key(params), None) is not None else 0
+        
+        self.stats[endpoint]["invalidations"] += count
+        return count
+    
+    def invalidate_matching(self, endpoint, params):
+        """删除请求参数包含 params 全部字段的缓存，如某个群的全部成员信息"""
+        store = self._stores.get(endpoint)
+        if not store:
+            return 0
+        
+        wanted = json.loads(self.make_key(params))
+        keys = []
+        for key in store:
+            cached = json.loads(key)
+            if all(cached.get(field) == value for field, value in wanted.items()):
+                keys.append(key)
+        for key in keys:
+            del store[key]
+        
+        self.stats[endpoint]["invalidations"] += len(keys)
+        return len(keys)
+    
+    def patch(self, endpoint, params, updater):
+        """在缓存条目 data 的副本上修改后替换原条目，不刷新过期时间；updater 返回 False 时改为删除该条目"""
+        store = self._stores.get(endpoint)
+        if not store:
+            return False
+        
+        key = self.make_key(params)
+        entry = store.get(key)
+        if entry is None:
+            return False
+        
+        if entry[0] <= time.time():
+            del store[key]
+            return False
+        
+        data = self._clone(entry[1].get("data"))
+        if data is None or updater(data) is False:
+            del store[key]
+            self.stats[endpoint]["invalidations"] += 1
+            return False
+        
+        store[key] = (entry[0], dict(entry[1], data=data))
+        self.stats[endpoint]["patches"] += 1
+        return True
+    
+    def handle_notice(self, event):
+        """根据群成员变动通知修正或失效受影响的缓存条目"""
+        if not self._stores or event.get("post_type") != "notice":
+            return
+        
+        notice_type = event.get("notice_type")
+        group_id = event.get("group_id")
+        user_id = event.get("user_id")
+        if not group_id:
+            return
+        
+        group = {"group_id": group_id}
+        member = {"group_id": group_id, "user_id": user_id}
+        
+        if notice_type == "group_increase":
+            self.invalidate("/get_group_member_info", member)
+            self.invalidate("/get_group_member_list", group)
+            self.patch("/get_group_info", group, lambda data: self._shift_member_count(data, 1))
+            if user_id == event.get("self_id"):
+                self.invalidate("/get_group_list")
+        
+        elif notice_type == "group_decrease":
+            if user_id == event.get("self_id") or event.get("sub_type") == "kick_me":
+                self.invalidate("/get_group_list")
+                self.invalidate("/get_group_info", group)
+                self.invalidate("/get_group_member_list", group)
+                self.invalidate_matching("/get_group_member_info", group)
+                return
+            
+            self.invalidate("/get_group_member_info", member)
+            self.patch("/get_group_member_list", group, lambda data: self._remove_member(data, user_id))
+            self.patch("/get_group_info", group, lambda data: self._shift_member_count(data, -1))
+        
+        elif notice_type == "group_admin":
+            role = "admin" if event.get("sub_type") == "set" else "member"
+            self._patch_member(member, group, user_id, {"role": role})
+        
+        elif notice_type == "group_card":
+            self._patch_member(member, group, user_id, {"card": event.get("card_new", "")})
+        
+        elif notice_type == "group_ban":
+            if not user_id:
+                return
+            shut_up = 0
+            if event.get("sub_type") == "ban":
+                shut_up = int(event.get("time", time.time())) + int(event.get("duration", 0))
+            self._patch_member(member, group, user_id, {"shut_up_timestamp": shut_up})
+    
+    def _patch_member(self, member, group, user_id, fields):
+        def update(data):
+            if not isinstance(data, dict):
+                return False
+            data.update(fields)
+        
+        def update_list(data):
+            if not isinstance(data, list):
+                return False
+            for item in data:
+                if isinstance(item, dict) and str(item.get("user_id")) == str(user_id):
+                    item.update(fields)
+                    return True
+            return False
+        
+        self.patch("/get_group_member_info", member, update)
+        self.patch("/get_group_member_list", group, update_list)
+    
+    @staticmethod
+    def _remove_member(data, user_id):
+        if not isinstance(data, list):
+            return False
+        data[:] = [item for item in data if not (isinstance(item, dict) and str(item.get("user_id")) == str(user_id))]
+    
+    @staticmethod
+    def _shift_member_count(data, delta):
+        if not isinstance(data, dict) or not isinstance(data.get("member_count"), int):
+            return False
+        data["member_count"] = max(0, data["member_count"] + delta)
+    
+    def clear(self):
+        for store in self._stores.values():
+            store.clear()
+    
+    def get_stats(self):
+        result = {}
+        for endpoint, stats in self.stats.items():
+            lookups = stats["hits"] + stats["misses"]
+            result[endpoint] = dict(
+                stats,
+                size=len(self._stores[endpoint]),
+                hit_rate=round(stats["hits"] / lookups, 4) if lookups else 0.0
+            )
+        return result
 
 class BotAPI:
     def __init__(self):
@@ -15,14 +248,14 @@ class BotAPI:
             "Authorization": f"Bearer {Config.TOKEN}"
         }
         self.session = None
+        self.connection_pool = None
         
         self.logger = logging.getLogger("BotAPI")
         
         if not self.logger.handlers:
             self.logger.setLevel(logging.INFO)
             
-            base_dir = os.path.dirname(os.path.abspath(__file__))
-            logs_dir = os.path.join(base_dir, 'logs')
+            logs_dir = Config.get_logs_dir()
             if not os.path.exists(logs_dir):
                 os.makedirs(logs_dir)
             
@@ -45,93 +278,221 @@ class BotAPI:
         Config.validate_request_deduplication_config()
         
         self.enable_deduplication = Config.ENABLE_REQUEST_DEDUPLICATION
-        self.cleanup_interval = Config.REQUEST_CLEANUP_INTERVAL
-        self.request_expire_time = Config.REQUEST_EXPIRE_TIME
         self.request_wait_timeout = Config.REQUEST_WAIT_TIMEOUT
         
-        self.request_tracker = {}
-        self.last_cleanup_time = time.time()
+        self._inflight = {}
+        self.dedup_stats = {
+            "leaders": 0,
+            "coalesced": 0,
+            "wait_timeouts": 0
+        }
+        
+        self.metrics = ApiMetrics()
+        self.response_cache = ApiResponseCache(Config.API_CACHE_POLICIES if Config.ENABLE_API_RESPONSE_CACHE else {})
+        
+        self.ws_connections = []
+        self._ws_pending = {}
+        self._echo_seq = 0
+        self.ws_stats = {
+            "calls": 0,
+            "fallbacks": 0,
+            "timeouts": 0,
+            "unmatched_responses": 0
+        }
         
         if self.enable_deduplication:
-            self.logger.info(f"API请求去重机制: 已启用 (清理间隔: {self.cleanup_interval}秒)")
+            self.logger.info(f"API请求去重机制: 已启用 (合并进行中的相同请求，等待超时: {self.request_wait_timeout}秒)")
         else:
             self.logger.info("API请求去重机制: 已禁用")
+        
+        if self.response_cache.policies:
+            self.logger.info(f"API响应缓存: 已启用 ({len(self.response_cache.policies)} 个只读接口)")
 
+    def use_connection_pool(self, connection_pool):
+        """改用框架共享的连接池，会话的生命周期由连接池管理"""
+        self.connection_pool = connection_pool
+        self.session = None
+    
     async def init_session(self):
-        if self.session is None:
-            self.session = aiohttp.ClientSession()
+        if self.session is None or self.session.closed:
+            if self.connection_pool is not None:
+                self.session = await self.connection_pool.get_session()
+            else:
+                self.session = aiohttp.ClientSession()
     
     async def close_session(self):
         if self.session:
-            await self.session.close()
+            if self.connection_pool is None:
+                await self.session.close()
             self.session = None
     
-    def _generate_request_id(self, endpoint, params):
-        params_str = json.dumps(params, sort_keys=True) if params else "{}"
-        request_str = f"{endpoint}_{params_str}"
-        return hashlib.md5(request_str.encode('utf-8')).hexdigest()
+    def attach_websocket(self, ws):
+        """登记可用于发送API动作的WebSocket连接"""
+        if ws not in self.ws_connections:
+            self.ws_connections.append(ws)
+            self.logger.info(f"API WebSocket通道已就绪 (可用连接: {len(self.ws_connections)})")
     
-    def _cleanup_old_requests(self):
-        if not self.enable_deduplication:
-            return
-            
-        current_time = time.time()
-        if current_time - self.last_cleanup_time < self.cleanup_interval:
-            return
+    def detach_websocket(self, ws):
+        """连接断开后移除，并让该连接上未完成的请求失败重试"""
+        if ws in self.ws_connections:
+            self.ws_connections.remove(ws)
         
-        self.last_cleanup_time = current_time
-        expired_requests = []
+        for echo, (pending_ws, future) in list(self._ws_pending.items()):
+            if pending_ws is ws and not future.done():
+                future.set_exception(ConnectionError("WebSocket连接已断开"))
+                self._ws_pending.pop(echo, None)
         
-        for request_id, request_data in self.request_tracker.items():
-            if current_time - request_data.get("timestamp", 0) > self.request_expire_time:
-                expired_requests.append(request_id)
+        if not self.ws_connections and Config.API_USE_WEBSOCKET:
+            self.logger.warning("API WebSocket通道不可用，API调用将回退到HTTP")
+    
+    def handle_ws_response(self, data):
+        """按 echo 把WebSocket响应交给对应的调用方"""
+        echo = data.get("echo")
+        pending = self._ws_pending.pop(echo, None)
+        if pending is None:
+            self.ws_stats["unmatched_responses"] += 1
+            return False
         
-        for request_id in expired_requests:
-            del self.request_tracker[request_id]
+        future = pending[1]
+        if not future.done():
+            future.set_result(data)
+        return True
+    
+    def _get_websocket(self):
+        if not Config.API_USE_WEBSOCKET:
+            return None
+        for ws in self.ws_connections:
+            if not ws.closed:
+                return ws
+        return None
+    
+    async def _ws_request(self, ws, endpoint, params, timeout_value):
+        self._echo_seq += 1
+        echo = f"nebula_{self._echo_seq}"
+        future = asyncio.get_running_loop().create_future()
+        self._ws_pending[echo] = (ws, future)
         
-        if expired_requests and Config.ENABLE_DEBUG:
-            self.logger.debug(f"清理了 {len(expired_requests)} 个过期请求记录")
+        try:
+            await ws.send_json({
+                "action": endpoint.lstrip("/"),
+                "params": params or {},
+                "echo": echo
+            })
+            self.ws_stats["calls"] += 1
+            return await asyncio.wait_for(future, timeout=timeout_value)
+        except asyncio.TimeoutError:
+            self.ws_stats["timeouts"] += 1
+            raise
+        finally:
+            self._ws_pending.pop(echo, None)
+    
+    def get_dedup_stats(self):
+        """请求合并统计"""
+        return dict(self.dedup_stats, inflight=len(self._inflight))
+    
+    def get_api_metrics(self):
+        """按接口的调用统计与延迟分布"""
+        return self.metrics.snapshot()
+    
+    def get_cache_stats(self):
+        """响应缓存统计"""
+        return self.response_cache.get_stats()
+    
+    def _generate_request_id(self, endpoint, params):
+        params_str = json.dumps(params, sort_keys=True) if params else "{}"
+        request_str = f"{endpoint}_{params_str}"
+        return hashlib.md5(request_str.encode('utf-8')).hexdigest()
     
     async def _request_with_retry(self, endpoint, params=None, max_retries=Config.API_REQUEST_MAX_RETRIES):
         await self.init_session()
-        url = f"{self.api_base}{endpoint}"
+        
+        cacheable = self.response_cache.is_cacheable(endpoint)
+        if cacheable:
+            cached = self.response_cache.get(endpoint, params)
+            if cached is not None:
+                if Config.ENABLE_DEBUG:
+                    self.logger.debug(f"API响应缓存命中: {endpoint}")
+                self.metrics.record_cache_hit(endpoint)
+                global_state._increment_api_requests(success=True)
+                return cached
         
         request_id = None
+        flight = None
         if self.enable_deduplication:
             request_id = self._generate_request_id(endpoint, params)
             
-            self._cleanup_old_requests()
-            
-            if request_id in self.request_tracker:
-                request_data = self.request_tracker[request_id]
+            inflight = self._inflight.get(request_id)
+            if inflight is not None:
+                self.dedup_stats["coalesced"] += 1
+                if Config.ENABLE_DEBUG:
+                    self.logger.debug(f"检测到重复的API请求: {endpoint}, 等待进行中的请求结果...")
                 
-                if request_data.get("status") == "processing":
+                try:
+                    result = await asyncio.wait_for(asyncio.shield(inflight), timeout=self.request_wait_timeout)
+                    self.metrics.record_coalesced(endpoint, result)
+                    global_state._increment_api_requests(success=self._is_success(result))
+                    return result
+                except asyncio.TimeoutError:
+                    self.dedup_stats["wait_timeouts"] += 1
                     if Config.ENABLE_DEBUG:
-                        self.logger.debug(f"检测到重复的API请求: {endpoint}, 等待结果...")
-                    
-                    wait_start = time.time()
-                    while (time.time() - wait_start < self.request_wait_timeout and 
-                           request_id in self.request_tracker and 
-                           self.request_tracker[request_id].get("status") == "processing"):
-                        await asyncio.sleep(0.1)
-                    
-                    if (request_id in self.request_tracker and 
-                        self.request_tracker[request_id].get("status") != "processing"):
-                        if Config.ENABLE_DEBUG:
-                            self.logger.debug(f"重复请求已完成，返回缓存结果: {endpoint}")
-                        return self.request_tracker[request_id].get("result")
-                
-                if request_data.get("status") == "completed":
-                    if Config.ENABLE_DEBUG:
-                        self.logger.debug(f"检测到重复的API请求: {endpoint}, 返回缓存结果")
-                    return request_data.get("result")
+                        self.logger.debug(f"等待重复请求超时，重新发起请求: {endpoint}")
+                except asyncio.CancelledError:
+                    if not inflight.cancelled():
+                        raise
             
-            self.request_tracker[request_id] = {
-                "status": "processing",
-                "timestamp": time.time(),
-                "endpoint": endpoint,
-                "params": params
-            }
+            flight = asyncio.get_running_loop().create_future()
+            self._inflight[request_id] = flight
+            self.dedup_stats["leaders"] += 1
+        
+        start_time = time.perf_counter()
+        try:
+            final_result = await self._send_with_retry(endpoint, params, max_retries)
+        except asyncio.CancelledError:
+            if flight is not None and not flight.done():
+                flight.cancel()
+            raise
+        except Exception as e:
+            self.metrics.record_request(endpoint, time.perf_counter() - start_time, None)
+            global_state._increment_api_requests(success=False)
+            if flight is not None and not flight.done():
+                flight.set_exception(e)
+                flight.exception()
+            raise
+        finally:
+            if flight is not None and self._inflight.get(request_id) is flight:
+                del self._inflight[request_id]
+        
+        success = self._is_success(final_result)
+        self.metrics.record_request(endpoint, time.perf_counter() - start_time, final_result)
+        global_state._increment_api_requests(success=success)
+        
+        if success:
+            if cacheable:
+                self.response_cache.put(endpoint, params, final_result)
+            if endpoint == "/get_group_member_list" and Config.ENABLE_MEMBER_STORE:
+                self._load_member_store(params, final_result)
+        
+        if flight is not None and not flight.done():
+            flight.set_result(final_result)
+        
+        return final_result
+    
+    @staticmethod
+    def _is_success(result):
+        return isinstance(result, dict) and result.get("status") == "ok" and result.get("retcode") == 0
+    
+    def _load_member_store(self, params, result):
+        """实际请求到的群成员列表写入列式成员表，缓存命中时不重复加载"""
+        data = result.get("data")
+        if not params or not isinstance(data, list):
+            return
+        try:
+            member_store.load(params.get("group_id"), data)
+        except Exception as e:
+            self.logger.warning(f"群成员表加载失败: {str(e)}")
+    
+    async def _send_with_retry(self, endpoint, params, max_retries):
+        url = f"{self.api_base}{endpoint}"
         
         final_result = None
         for attempt in range(max_retries):
@@ -145,16 +506,26 @@ class BotAPI:
                 ]
                 
                 timeout_value = Config.API_REQUEST_TIMEOUT_LONG if is_long_operation else Config.API_REQUEST_TIMEOUT_NORMAL
-                timeout = aiohttp.ClientTimeout(total=timeout_value)
                 
-                async with self.session.post(url, headers=self.headers, json=params, timeout=timeout) as response:
-                    if response.status in [401, 403]:
-                        error_msg = f"API Token验证失败: {url}, 状态码: {response.status}"
-                        self.logger.error(error_msg)
-                        final_result = {"status": "failed", "retcode": response.status, "error": "Token验证失败"}
-                        break
+                ws = self._get_websocket()
+                if ws is not None:
+                    result = await self._ws_request(ws, endpoint, params, timeout_value)
+                else:
+                    if Config.API_USE_WEBSOCKET and (Config.ENABLE_REVERSE_WS or Config.ENABLE_FORWARD_WS):
+                        self.ws_stats["fallbacks"] += 1
+                        if Config.ENABLE_DEBUG:
+                            self.logger.debug(f"WebSocket不可用，API请求回退到HTTP: {endpoint}")
+                    
+                    timeout = aiohttp.ClientTimeout(total=timeout_value)
                     
-                    result = await response.json()
+                    async with self.session.post(url, headers=self.headers, json=params, timeout=timeout) as response:
+                        if response.status in [401, 403]:
+                            error_msg = f"API Token验证失败: {url}, 状态码: {response.status}"
+                            self.logger.error(error_msg)
+                            final_result = {"status": "failed", "retcode": response.status, "error": "Token验证失败"}
+                            break
+                        
+                        result = await response.json()
                 
                 if result.get("status") == "ok" and result.get("retcode") == 0:
                     final_result = result
@@ -167,6 +538,7 @@ class BotAPI:
                         final_result = result
                         break
                     
+                    self.metrics.record_retry(endpoint)
                     await asyncio.sleep(2 ** attempt)
                     
             except aiohttp.ClientError as e:
@@ -177,6 +549,7 @@ class BotAPI:
                     final_result = {"status": "failed", "retcode": -1, "error": str(e)}
                     break
                 
+                self.metrics.record_retry(endpoint)
                 await asyncio.sleep(2 ** attempt)
                 
             except Exception as e:
@@ -187,21 +560,12 @@ class BotAPI:
                     final_result = {"status": "failed", "retcode": -1, "error": str(e)}
                     break
                 
+                self.metrics.record_retry(endpoint)
                 await asyncio.sleep(2 ** attempt)
         
         if final_result is None:
             final_result = {"status": "failed", "retcode": -1, "error": "Max retries exceeded"}
         
-        if self.enable_deduplication and request_id:
-            if final_result.get("status") == "ok" and final_result.get("retcode") == 0:
-                self.request_tracker[request_id] = {
-                    "status": "completed",
-                    "timestamp": time.time(),
-                    "result": final_result
-                }
-            else:
-                del self.request_tracker[request_id]
-        
         return final_result
     
     async def _request(self, endpoint, params=None):
@@ -1,4 +1,5 @@
 import json
+from collections import deque
 from datetime import datetime
 import logging
 from config import Config
@@ -17,10 +18,16 @@ import re
 import hashlib
 import inspect
 from logging.handlers import TimedRotatingFileHandler
-from server_manager import ServerManager, PluginContext
+from server_manager import ServerManager, PluginContext, EventIngressQueue, LoopWatchdog
 import subprocess
 import signal
 from shared_state import global_state, readonly_global_state, PluginStateAccessor
+from command_registry import CommandRegistry, PluginCommandRegistrar
+from ws_transport import WebSocketEventTransport
+from member_store import member_store, readonly_member_store
+from metrics import PluginMetrics, PrometheusWriter
+from plugin_worker import IsolatedPluginHost, create_isolated_plugin
+from dedup import create_key_tracker, create_shared_store, serialize_key
 
 class StartupEventRejector:
     def __init__(self):
@@ -83,8 +90,7 @@ class LogCleaner:
         self.logger.info("开始运行时日志清理...")
         
         try:
-            base_dir = os.path.dirname(os.path.abspath(__file__))
-            log_dir = os.path.join(base_dir, 'logs')
+            log_dir = Config.get_logs_dir()
             if not os.path.exists(log_dir):
                 return
                 
@@ -115,8 +121,7 @@ class LogCleaner:
 
     def clean_plugin_log_file(self, plugin_name):
         try:
-            base_dir = os.path.dirname(os.path.abspath(__file__))
-            log_dir = os.path.join(base_dir, 'logs')
+            log_dir = Config.get_logs_dir()
             log_file = os.path.join(log_dir, f"plugin_{plugin_name}.log")
             
             if os.path.exists(log_file):
@@ -126,103 +131,586 @@ class LogCleaner:
             self.logger.warning(f"清理插件日志文件失败 {plugin_name}: {str(e)}")
 
 class DeduplicationManager:
-    """去重管理器，统一管理API和事件去重"""
-    def __init__(self):
-        self.api_request_tracker = {}
-        self.event_tracker = {}
-        self.last_cleanup_time = time.time()
-        
-    def _generate_request_id(self, endpoint, params):
-        """生成API请求ID"""
-        params_str = json.dumps(params, sort_keys=True) if params else "{}"
-        request_str = f"{endpoint}_{params_str}"
-        return hashlib.md5(request_str.encode('utf-8')).hexdigest()
+    """事件去重管理器（API请求去重由 BotAPI 合并进行中的相同请求完成）"""
+    # 通知事件除 notice_type/sub_type 外参与去重的字段；file 等字段是字典时无法作为键，退回计算指纹
+    NOTICE_IDENTITY_FIELDS = ("group_id", "user_id", "operator_id", "target_id", "message_id", "file")
+    
+    def __init__(self, logger=None):
+        self.logger = logger or logging.getLogger("BotServer")
+        self.mode = Config.DEDUPLICATION_MODE
+        self.backend = Config.DEDUPLICATION_BACKEND
+        self.event_tracker = create_key_tracker(
+            self.mode, Config.EVENT_DEDUPLICATION_WINDOW, Config.DEDUP_BLOOM_MEMORY,
+            Config.DEDUP_BLOOM_FALSE_POSITIVE_RATE, Config.DEDUP_BLOOM_SLICES
+        )
+        self.shared_store = create_shared_store(self.backend, Config.EVENT_DEDUPLICATION_WINDOW, self.logger)
+        self.shared_store_errors = 0
+        self._shared_store_retry_at = 0
     
     def _generate_event_id(self, event_data):
-        """生成事件ID"""
-        event_str = json.dumps(event_data, sort_keys=True) if event_data else "{}"
+        """生成事件ID：优先使用 OneBot 事件自带的标识字段，没有标识的事件才计算整个事件的指纹"""
+        post_type = event_data.get("post_type") if event_data else None
+        self_id = event_data.get("self_id") if event_data else None
+        
+        if post_type in ("message", "message_sent"):
+            message_id = event_data.get("message_id")
+            if message_id is not None:
+                return (post_type, self_id, message_id)
+        elif post_type == "request":
+            flag = event_data.get("flag")
+            if flag is not None:
+                return (post_type, self_id, flag)
+        elif post_type == "notice" and event_data.get("time") is not None:
+            return (post_type, self_id, event_data.get("time"), event_data.get("notice_type"), event_data.get("sub_type"),
+                    *(event_data.get(field) for field in self.NOTICE_IDENTITY_FIELDS))
+        elif post_type == "meta_event" and event_data.get("time") is not None:
+            return (post_type, self_id, event_data.get("time"), event_data.get("meta_event_type"), event_data.get("sub_type"))
+        
+        return self._fingerprint_event(event_data)
+    
+    @staticmethod
+    def _fingerprint_event(event_data):
+        event_str = json.dumps(event_data, sort_keys=True, default=str) if event_data else "{}"
         return hashlib.md5(event_str.encode('utf-8')).hexdigest()
     
-    def _cleanup_old_entries(self):
-        """清理过期条目"""
-        current_time = time.time()
-        if current_time - self.last_cleanup_time < Config.REQUEST_CLEANUP_INTERVAL:
-            return
-        
-        self.last_cleanup_time = current_time
-        
-        expired_requests = []
-        for request_id, request_data in self.api_request_tracker.items():
-            if current_time - request_data.get("timestamp", 0) > Config.REQUEST_EXPIRE_TIME:
-                expired_requests.append(request_id)
+    async def check_event(self, event_data):
+        """检查事件是否重复；配置了共享存储时由存储原子完成检查并写入，多个实例中只有一个会处理该事件"""
+        if not Config.ENABLE_EVENT_DEDUPLICATION:
+            return False
         
-        for request_id in expired_requests:
-            del self.api_request_tracker[request_id]
+        event_id = self._generate_event_id(event_data)
+        try:
+            hash(event_id)
+        except TypeError:
+            event_id = self._fingerprint_event(event_data)
         
-        expired_events = []
-        for event_id, event_data in self.event_tracker.items():
-            if current_time - event_data.get("timestamp", 0) > Config.EVENT_DEDUPLICATION_WINDOW:
-                expired_events.append(event_id)
+        if self.shared_store is not None and time.monotonic() >= self._shared_store_retry_at:
+            try:
+                return await self.shared_store.check_and_add(serialize_key(event_id))
+            except Exception as e:
+                self.shared_store_errors += 1
+                self._shared_store_retry_at = time.monotonic() + Config.DEDUP_STORE_RETRY_INTERVAL
+                self.logger.warning(f"去重共享存储({self.backend})不可用: {str(e) or type(e).__name__}，"
+                                    f"{Config.DEDUP_STORE_RETRY_INTERVAL} 秒内改用进程内去重")
         
-        for event_id in expired_events:
-            del self.event_tracker[event_id]
+        return self.event_tracker.check_and_add(event_id)
     
-    def check_api_request(self, endpoint, params):
-        """检查API请求是否重复"""
-        if not Config.ENABLE_REQUEST_DEDUPLICATION:
-            return None
-        
-        self._cleanup_old_entries()
+    async def close(self):
+        if self.shared_store is not None:
+            await self.shared_store.close()
+    
+    def get_stats(self):
+        return {
+            "mode": self.mode,
+            "backend": self.backend,
+            "event_tracker": self.event_tracker.get_stats(),
+            "shared_store": self.shared_store.get_stats() if self.shared_store is not None else None,
+            "shared_store_errors": self.shared_store_errors
+        }
+
+class EventSubscriptionIndex:
+    """事件订阅索引，按插件声明的 EVENT_SUBSCRIPTIONS 只分发给关心该事件的插件"""
+    SUBSCRIPTION_FIELDS = ("post_type", "message_type", "notice_type", "request_type",
+                           "meta_event_type", "sub_type", "group_id")
+    MAX_CACHE_ENTRIES = 4096
+    
+    def __init__(self):
+        self._plugins = []
+        self._all_mask = 0
+        self._unconstrained = {}
+        self._by_value = {}
+        self._match_cache = {}
+    
+    @staticmethod
+    def _normalize_values(value):
+        if isinstance(value, (list, tuple, set, frozenset)):
+            values = value
+        else:
+            values = [value]
+        
+        normalized = set()
+        for item in values:
+            normalized.add(item)
+            if isinstance(item, int) and not isinstance(item, bool):
+                normalized.add(str(item))
+            elif isinstance(item, str) and item.isdigit():
+                normalized.add(int(item))
+        return normalized
+    
+    @staticmethod
+    def get_plugin_subscriptions(plugin):
+        subscriptions = getattr(plugin, "EVENT_SUBSCRIPTIONS", None)
+        if not subscriptions or not isinstance(subscriptions, dict):
+            return {}
+        return subscriptions
+    
+    def rebuild(self, plugins):
+        """根据插件列表重建索引，插件加载/重载/卸载后调用"""
+        self._plugins = list(plugins)
+        self._all_mask = (1 << len(self._plugins)) - 1
+        self._unconstrained = {field: 0 for field in self.SUBSCRIPTION_FIELDS}
+        self._by_value = {field: {} for field in self.SUBSCRIPTION_FIELDS}
+        self._match_cache = {}
+        
+        for index, plugin in enumerate(self._plugins):
+            bit = 1 << index
+            subscriptions = self.get_plugin_subscriptions(plugin)
+            
+            for field in self.SUBSCRIPTION_FIELDS:
+                if field not in subscriptions or subscriptions[field] is None:
+                    self._unconstrained[field] |= bit
+                    continue
+                
+                field_index = self._by_value[field]
+                for value in self._normalize_values(subscriptions[field]):
+                    field_index[value] = field_index.get(value, 0) | bit
+    
+    def match(self, event):
+        """返回需要接收该事件的插件列表（保持加载顺序）"""
+        values = tuple(event.get(field) for field in self.SUBSCRIPTION_FIELDS)
+        key = values
         
-        request_id = self._generate_request_id(endpoint, params)
+        try:
+            cached = self._match_cache.get(key)
+        except TypeError:
+            cached = None
+            key = None
+        
+        if cached is not None:
+            return cached
+        
+        mask = self._all_mask
+        for field, value in zip(self.SUBSCRIPTION_FIELDS, values):
+            if not mask:
+                break
+            allowed = self._unconstrained[field]
+            if value is not None:
+                try:
+                    allowed |= self._by_value[field].get(value, 0)
+                except TypeError:
+                    pass
+            mask &= allowed
+        
+        matched = []
+        index = 0
+        while mask:
+            if mask & 1:
+                matched.append(self._plugins[index])
+            mask >>= 1
+            index += 1
+        
+        if key is not None:
+            if len(self._match_cache) >= self.MAX_CACHE_ENTRIES:
+                self._match_cache.clear()
+            self._match_cache[key] = matched
+        
+        return matched
+
+class ConversationScheduler:
+    """按会话分键的事件调度器
+    
+    同一会话（群或私聊对象）的事件严格按到达顺序串行处理，不同会话并行处理；
+    同时处理的会话数不超过 max_active，排队事件总数达到 max_pending 后 submit 会等待，
+    把背压传回事件接收队列。
+    """
+    def __init__(self, logger, max_active=None, max_pending=None):
+        self.logger = logger
+        self.max_active = max(1, max_active or Config.MAX_ACTIVE_CONVERSATIONS)
+        # 上限不超过事件队列长度，过载时积压留在事件队列中，由其溢出策略(优先级丢弃/503)处理
+        max_pending = max_pending or Config.MAX_PENDING_CONVERSATION_EVENTS or Config.EVENT_QUEUE_MAX_SIZE // 4
+        self.max_pending = max(1, min(max_pending, Config.EVENT_QUEUE_MAX_SIZE))
+        self._queues = {}
+        self._active = set()
+        self._waiting_keys = deque()
+        self._runners = set()
+        self._pending = 0
+        self._has_space = asyncio.Event()
+        self._has_space.set()
+        
+        self.submitted_total = 0
+        self.completed_total = 0
+        self.backpressure_waits = 0
+        self.max_pending_seen = 0
+    
+    async def submit(self, key, func, *args):
+        while self._pending >= self.max_pending:
+            self.backpressure_waits += 1
+            self._has_space.clear()
+            await self._has_space.wait()
+        
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = deque()
+            self._queues[key] = queue
+            if len(self._active) < self.max_active:
+                self._start_runner(key)
+            else:
+                self._waiting_keys.append(key)
         
-        if request_id in self.api_request_tracker:
-            request_data = self.api_request_tracker[request_id]
+        queue.append((func, args))
+        self._pending += 1
+        self.submitted_total += 1
+        if self._pending > self.max_pending_seen:
+            self.max_pending_seen = self._pending
+    
+    def _start_runner(self, key):
+        self._active.add(key)
+        runner = asyncio.create_task(self._run_conversation(key))
+        self._runners.add(runner)
+        runner.add_done_callback(self._runners.discard)
+    
+    async def _run_conversation(self, key):
+        queue = self._queues[key]
+        try:
+            while queue:
+                func, args = queue.popleft()
+                self._pending -= 1
+                if self._pending < self.max_pending:
+                    self._has_space.set()
+                
+                try:
+                    await func(*args)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self.logger.error(f"会话 {key} 事件处理出错: {str(e)}", exc_info=Config.ENABLE_DEBUG)
+                finally:
+                    self.completed_total += 1
+        finally:
+            self._pending -= len(queue)
+            self._queues.pop(key, None)
+            self._active.discard(key)
+            if self._pending < self.max_pending:
+                self._has_space.set()
             
-            if request_data.get("status") == "processing":
-                return "processing"
-            elif request_data.get("status") == "completed":
-                return request_data.get("result")
-        
-        self.api_request_tracker[request_id] = {
-            "status": "processing",
-            "timestamp": time.time(),
-            "endpoint": endpoint,
-            "params": params
+            while self._waiting_keys and len(self._active) < self.max_active:
+                next_key = self._waiting_keys.popleft()
+                if next_key in self._queues:
+                    self._start_runner(next_key)
+    
+    async def stop(self):
+        self._waiting_keys.clear()
+        for runner in list(self._runners):
+            runner.cancel()
+        await asyncio.gather(*self._runners, return_exceptions=True)
+        self._queues.clear()
+        self._active.clear()
+        self._pending = 0
+    
+    def get_stats(self):
+        return {
+            "active_conversations": len(self._active),
+            "waiting_conversations": len(self._waiting_keys),
+            "pending_events": self._pending,
+            "max_pending_seen": self.max_pending_seen,
+            "max_active": self.max_active,
+            "max_pending": self.max_pending,
+            "submitted_total": self.submitted_total,
+            "completed_total": self.completed_total,
+            "backpressure_waits": self.backpressure_waits
         }
+
+class PluginTimeoutWheel:
+    """插件调用超时时间轮
+    
+    按到期时刻分桶（精度 resolution 秒），调用正常结束时 O(1) 移除；
+    整个时间轮只挂一个定时器，到期时把同一批超时的调用一次性交给 on_expire 处理。
+    """
+    def __init__(self, on_expire, resolution=None):
+        self.on_expire = on_expire
+        self.resolution = resolution or Config.PLUGIN_TIMEOUT_RESOLUTION
+        self._buckets = {}
+        self._task_ticks = {}
+        self._handle = None
+        self._next_tick = None
+        
+        self.scheduled_total = 0
+        self.expired_total = 0
+        self.batches_total = 0
+    
+    def add(self, task, plugin_name, timeout, stage="run"):
+        loop = asyncio.get_running_loop()
+        tick = int((loop.time() + timeout) / self.resolution) + 1
+        
+        bucket = self._buckets.get(tick)
+        if bucket is None:
+            bucket = self._buckets[tick] = {}
+        bucket[task] = (plugin_name, stage)
+        self._task_ticks[task] = tick
+        self.scheduled_total += 1
+        
+        if self._handle is None or tick < self._next_tick:
+            self._schedule(loop, tick)
+    
+    def discard(self, task):
+        tick = self._task_ticks.pop(task, None)
+        if tick is None:
+            return
+        bucket = self._buckets.get(tick)
+        if bucket is not None:
+            bucket.pop(task, None)
+            if not bucket:
+                del self._buckets[tick]
+    
+    def _schedule(self, loop, tick):
+        if self._handle is not None:
+            self._handle.cancel()
+        self._next_tick = tick
+        self._handle = loop.call_at(tick * self.resolution, self._fire)
+    
+    def _fire(self):
+        self._handle = None
+        loop = asyncio.get_running_loop()
+        current_tick = int(loop.time() / self.resolution)
+        
+        expired = []
+        for tick in [tick for tick in self._buckets if tick <= current_tick]:
+            for task, (plugin_name, stage) in self._buckets.pop(tick).items():
+                self._task_ticks.pop(task, None)
+                if not task.done():
+                    expired.append((task, plugin_name, stage))
         
+        if self._buckets:
+            self._schedule(loop, min(self._buckets))
+        
+        if expired:
+            self.expired_total += len(expired)
+            self.batches_total += 1
+            self.on_expire(expired)
+    
+    def clear(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        self._buckets.clear()
+        self._task_ticks.clear()
+    
+    def get_stats(self):
+        return {
+            "pending": len(self._task_ticks),
+            "buckets": len(self._buckets),
+            "scheduled_total": self.scheduled_total,
+            "expired_total": self.expired_total,
+            "batches_total": self.batches_total
+        }
+
+class PluginInvocationGate:
+    """单个插件的并发上限与等待队列
+    
+    同时运行的调用数达到 max_concurrency 后，新调用进入长度为 max_queue 的等待队列；
+    队列满时按 policy 处理：drop 丢弃新调用，drop_oldest 丢弃最早排队的调用，
+    coalesce 同一会话同一处理函数只保留最新一次调用（队列满时再丢弃最早的）。
+    """
+    POLICIES = ("drop", "drop_oldest", "coalesce")
+    
+    def __init__(self, plugin_name, max_concurrency, max_queue, policy):
+        self.plugin_name = plugin_name
+        self.running = 0
+        self.queue = deque()
+        self._pending_keys = {}
+        self.configure(max_concurrency, max_queue, policy)
+        
+        self.dropped_total = 0
+        self.coalesced_total = 0
+        self.queued_total = 0
+        self.max_depth_seen = 0
+    
+    def configure(self, max_concurrency, max_queue, policy):
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.max_queue = max(0, int(max_queue))
+        self.policy = policy if policy in self.POLICIES else "drop_oldest"
+    
+    def try_acquire(self):
+        if self.running < self.max_concurrency:
+            self.running += 1
+            return True
+        return False
+    
+    def enqueue(self, key, invocation):
+        """返回因排队策略被丢弃/合并的调用列表"""
+        discarded = []
+        
+        if self.policy == "coalesce":
+            item = self._pending_keys.get(key)
+            if item is not None:
+                discarded.append(item[1])
+                item[1] = invocation
+                self.coalesced_total += 1
+                return discarded
+        
+        if len(self.queue) >= self.max_queue:
+            if self.policy == "drop" or not self.queue:
+                self.dropped_total += 1
+                discarded.append(invocation)
+                return discarded
+            
+            oldest = self.queue.popleft()
+            self._pending_keys.pop(oldest[0], None)
+            self.dropped_total += 1
+            discarded.append(oldest[1])
+        
+        item = [key, invocation]
+        self.queue.append(item)
+        if self.policy == "coalesce":
+            self._pending_keys[key] = item
+        self.queued_total += 1
+        if len(self.queue) > self.max_depth_seen:
+            self.max_depth_seen = len(self.queue)
+        return discarded
+    
+    def release(self):
+        """一次调用结束，返回下一个可以开始的排队调用（没有则返回 None）"""
+        if self.queue and self.running <= self.max_concurrency:
+            key, invocation = self.queue.popleft()
+            self._pending_keys.pop(key, None)
+            return invocation
+        self.running -= 1
         return None
     
-    def complete_api_request(self, request_id, result):
-        """完成API请求"""
-        if request_id in self.api_request_tracker:
-            if result.get("status") == "ok" and result.get("retcode") == 0:
-                self.api_request_tracker[request_id] = {
-                    "status": "completed",
-                    "timestamp": time.time(),
-                    "result": result
-                }
-            else:
-                del self.api_request_tracker[request_id]
+    def flush(self):
+        invocations = [item[1] for item in self.queue]
+        self.queue.clear()
+        self._pending_keys.clear()
+        return invocations
     
-    def check_event(self, event_data):
-        """检查事件是否重复"""
-        if not Config.ENABLE_EVENT_DEDUPLICATION:
-            return False
-        
-        self._cleanup_old_entries()
+    def get_stats(self):
+        return {
+            "running": self.running,
+            "queue_depth": len(self.queue),
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "policy": self.policy,
+            "queued_total": self.queued_total,
+            "dropped_total": self.dropped_total,
+            "coalesced_total": self.coalesced_total,
+            "max_depth_seen": self.max_depth_seen
+        }
+
+class PluginCircuitBreaker:
+    """单个插件的熔断器
+    
+    closed: 正常分发，window 秒内失败（出错或超时）达到 failure_threshold 次后打开；
+    open: cooldown 秒内跳过该插件的所有调用；
+    half_open: 冷却结束后最多放行 half_open_trials 个试探调用，全部成功则关闭，任一失败重新打开。
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    STATE_CODES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+    
+    def __init__(self, plugin_name, on_state_change=None):
+        self.plugin_name = plugin_name
+        self.on_state_change = on_state_change
+        self.state = self.CLOSED
+        self.failures = deque()
+        self.opened_at = 0.0
+        self.trials_started = 0
+        self.trials_succeeded = 0
+        self.configure()
+        
+        self.skipped_total = 0
+        self.opened_total = 0
+        self.transitions = {self.CLOSED: 0, self.OPEN: 0, self.HALF_OPEN: 0}
+        self.last_change_time = None
+    
+    def configure(self):
+        self.failure_threshold = max(1, int(Config.PLUGIN_BREAKER_FAILURE_THRESHOLD))
+        self.window = float(Config.PLUGIN_BREAKER_WINDOW)
+        self.cooldown = float(Config.PLUGIN_BREAKER_COOLDOWN)
+        self.half_open_trials = max(1, int(Config.PLUGIN_BREAKER_HALF_OPEN_TRIALS))
+    
+    def _transition(self, state, reason):
+        previous = self.state
+        self.state = state
+        self.transitions[state] += 1
+        self.last_change_time = datetime.now().isoformat(timespec="seconds")
+        self.trials_started = 0
+        self.trials_succeeded = 0
+        if state == self.OPEN:
+            self.opened_at = time.monotonic()
+            self.opened_total += 1
+        if state != self.OPEN:
+            self.failures.clear()
+        if self.on_state_change is not None:
+            self.on_state_change(self, previous, reason)
+    
+    def allow(self):
+        """是否分发本次调用；打开状态下冷却结束时转为半开并放行试探调用"""
+        if self.state == self.CLOSED:
+            return True
         
-        event_id = self._generate_event_id(event_data)
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.cooldown:
+                self.skipped_total += 1
+                return False
+            self._transition(self.HALF_OPEN, "冷却结束")
         
-        if event_id in self.event_tracker:
+        if self.trials_started < self.half_open_trials:
+            self.trials_started += 1
             return True
+        self.skipped_total += 1
+        return False
+    
+    def record_success(self):
+        if self.state != self.HALF_OPEN:
+            return
+        self.trials_succeeded += 1
+        if self.trials_succeeded >= self.half_open_trials:
+            self._transition(self.CLOSED, f"{self.trials_succeeded} 次试探调用成功")
+    
+    def record_failure(self, reason):
+        if self.state == self.OPEN:
+            return
+        if self.state == self.HALF_OPEN:
+            self._transition(self.OPEN, f"试探调用失败({reason})")
+            return
         
-        self.event_tracker[event_id] = {
-            "timestamp": time.time(),
-            "event_data": event_data
+        now = time.monotonic()
+        failures = self.failures
+        failures.append(now)
+        while failures and now - failures[0] > self.window:
+            failures.popleft()
+        if len(failures) >= self.failure_threshold:
+            self._transition(self.OPEN, f"{self.window:g} 秒内失败 {len(failures)} 次，最近一次为{reason}")
+    
+    def record_abort(self):
+        """试探调用被取消（如插件卸载）或被并发限制丢弃时归还名额"""
+        if self.state == self.HALF_OPEN and self.trials_started > self.trials_succeeded:
+            self.trials_started -= 1
+    
+    def reset(self):
+        if self.state != self.CLOSED:
+            self._transition(self.CLOSED, "插件已重新加载")
+        self.failures.clear()
+    
+    def get_stats(self):
+        stats = {
+            "state": self.state,
+            "recent_failures": len(self.failures),
+            "failure_threshold": self.failure_threshold,
+            "skipped_total": self.skipped_total,
+            "opened_total": self.opened_total,
+            "transitions": dict(self.transitions),
+            "last_change_time": self.last_change_time
         }
-        
-        return False
+        if self.state == self.OPEN:
+            stats["cooldown_remaining"] = round(max(0.0, self.cooldown - (time.monotonic() - self.opened_at)), 1)
+        elif self.state == self.HALF_OPEN:
+            stats["trials"] = f"{self.trials_succeeded}/{self.half_open_trials}"
+        return stats
+
+class _DispatchBatch:
+    """一次事件分发中所有插件调用的完成计数"""
+    __slots__ = ("remaining", "future")
+    
+    def __init__(self, count):
+        self.remaining = count
+        self.future = asyncio.get_running_loop().create_future()
+    
+    def done_one(self):
+        self.remaining -= 1
+        if self.remaining <= 0 and not self.future.done():
+            self.future.set_result(None)
 
 class PluginManager:
     def __init__(self, server_manager):
@@ -241,7 +729,165 @@ class PluginManager:
         self.initial_loading_complete = False
         self._server_manager = server_manager
         self._plugin_path_inserted = False
-        self.deduplication_manager = DeduplicationManager()
+        self.deduplication_manager = DeduplicationManager(server_manager.logger)
+        self.subscription_index = EventSubscriptionIndex()
+        self.command_registry = CommandRegistry()
+        self.conversation_scheduler = ConversationScheduler(server_manager.logger)
+        self.plugin_metrics = {}
+        self.event_stats = {"deduplicated": 0, "startup_rejected": 0}
+        self.slow_handlers = deque(maxlen=Config.PLUGIN_SLOW_LOG_SIZE)
+        self.slow_logger = self._setup_slow_logger()
+        self.timeout_wheel = PluginTimeoutWheel(self._on_plugin_timeouts)
+        self._plugin_timeouts = {}
+        self._invocations = {}
+        self._gates = {}
+        self._breakers = {}
+        self._isolated_hosts = {}
+        self.refused_cancel_total = 0
+    
+    @staticmethod
+    def _setup_slow_logger():
+        """慢处理记录单独写入 logs/slow_handler.log"""
+        logger = logging.getLogger("SlowHandler")
+        if logger.handlers:
+            return logger
+        
+        logger.setLevel(logging.INFO)
+        logs_dir = Config.get_logs_dir()
+        if not os.path.exists(logs_dir):
+            os.makedirs(logs_dir)
+        
+        file_handler = logging.FileHandler(os.path.join(logs_dir, "slow_handler.log"), 'a', encoding='utf-8')
+        file_handler.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
+        logger.addHandler(file_handler)
+        logger.propagate = False
+        return logger
+    
+    @staticmethod
+    def _describe_event(event):
+        post_type = event.get("post_type", "unknown")
+        detail = (event.get("message_type") or event.get("notice_type") or
+                  event.get("request_type") or event.get("meta_event_type"))
+        return f"{post_type}.{detail}" if detail else post_type
+    
+    def _record_plugin_timing(self, plugin_name, metrics, elapsed, event, handler=None):
+        metrics.latency.record(elapsed)
+        if elapsed < Config.PLUGIN_SLOW_THRESHOLD:
+            return
+        
+        metrics.slow_calls += 1
+        event_type = self._describe_event(event)
+        record = {
+            "time": datetime.now().isoformat(timespec="seconds"),
+            "plugin": plugin_name,
+            "handler": handler or "handle_event_async",
+            "event_type": event_type,
+            "duration_ms": round(elapsed * 1000, 1),
+            "group_id": event.get("group_id"),
+            "user_id": event.get("user_id")
+        }
+        self.slow_handlers.append(record)
+        self.slow_logger.info(f"插件 {plugin_name} [{record['handler']}] 处理 {event_type} 耗时 {record['duration_ms']}ms "
+                              f"(群: {record['group_id']}, 用户: {record['user_id']})")
+    
+    def get_concurrency_stats(self):
+        return {plugin_name: gate.get_stats() for plugin_name, gate in list(self._gates.items())}
+    
+    def get_isolated_plugin_stats(self):
+        return {plugin_name: host.get_stats() for plugin_name, host in list(self._isolated_hosts.items())}
+    
+    def get_circuit_breaker_stats(self):
+        return {plugin_name: breaker.get_stats() for plugin_name, breaker in list(self._breakers.items())}
+    
+    def _on_breaker_state_change(self, breaker, previous, reason):
+        logger = self._server_manager.logger
+        if breaker.state == PluginCircuitBreaker.OPEN:
+            logger.warning(f"插件 {breaker.plugin_name} 熔断已打开({reason})，{breaker.cooldown:g} 秒内跳过该插件")
+        elif breaker.state == PluginCircuitBreaker.HALF_OPEN:
+            logger.info(f"插件 {breaker.plugin_name} 熔断半开({reason})，放行 {breaker.half_open_trials} 个试探调用")
+        else:
+            logger.info(f"插件 {breaker.plugin_name} 熔断已关闭({reason})，恢复正常分发")
+    
+    def get_plugin_latency_stats(self):
+        """各插件调用次数与耗时分位数，按 p99 从高到低排列"""
+        stats = {name: metrics.snapshot() for name, metrics in list(self.plugin_metrics.items())}
+        return dict(sorted(stats.items(), key=lambda item: item[1]["latency"]["p99_ms"], reverse=True))
+    
+    def _get_plugin_metrics(self, plugin_name):
+        metrics = self.plugin_metrics.get(plugin_name)
+        if metrics is None:
+            metrics = self.plugin_metrics[plugin_name] = PluginMetrics()
+        return metrics
+    
+    def _create_plugin_context(self, module_name):
+        plugin_state_accessor = PluginStateAccessor(module_name, global_state)
+        command_registrar = PluginCommandRegistrar(module_name, self.command_registry)
+        return PluginContext(module_name, readonly_global_state, plugin_state_accessor,
+                             command_registrar=command_registrar,
+                             member_store=readonly_member_store if Config.ENABLE_MEMBER_STORE else None,
+                             connection_pool=self._server_manager.connection_pool,
+                             process_pool=self._server_manager.process_pool)
+    
+    def _rebuild_event_index(self):
+        """插件列表变化后重建事件订阅索引"""
+        self.subscription_index.rebuild(self.plugins)
+        self._plugin_timeouts = {type(plugin).__module__: self._resolve_plugin_timeout(plugin) for plugin in self.plugins}
+        
+        gates = {}
+        for plugin in self.plugins:
+            plugin_name = type(plugin).__module__
+            limits = self._resolve_concurrency_limit(plugin)
+            if limits is None:
+                continue
+            gate = self._gates.get(plugin_name)
+            if gate is None:
+                gate = PluginInvocationGate(plugin_name, *limits)
+            else:
+                gate.configure(*limits)
+            gates[plugin_name] = gate
+        self._gates = gates
+        
+        breakers = {}
+        if Config.ENABLE_PLUGIN_CIRCUIT_BREAKER:
+            for plugin in self.plugins:
+                plugin_name = type(plugin).__module__
+                if getattr(plugin, "CIRCUIT_BREAKER", True) is False:
+                    continue
+                breaker = self._breakers.get(plugin_name)
+                if breaker is None:
+                    breaker = PluginCircuitBreaker(plugin_name, self._on_breaker_state_change)
+                else:
+                    breaker.configure()
+                breakers[plugin_name] = breaker
+        self._breakers = breakers
+    
+    @staticmethod
+    def _resolve_concurrency_limit(plugin):
+        """并发限制优先取 PLUGIN_CONCURRENCY_LIMITS，其次插件类属性 CONCURRENCY_LIMIT；都没有时不限制"""
+        plugin_name = type(plugin).__module__
+        limits = Config.PLUGIN_CONCURRENCY_LIMITS.get(plugin_name)
+        if limits is None:
+            limits = getattr(plugin, "CONCURRENCY_LIMIT", None)
+        if isinstance(limits, int) and not isinstance(limits, bool):
+            limits = {"max_concurrency": limits}
+        if not isinstance(limits, dict) or not limits.get("max_concurrency"):
+            return None
+        return (limits["max_concurrency"],
+                limits.get("max_queue", Config.PLUGIN_DEFAULT_MAX_QUEUE),
+                limits.get("policy", Config.PLUGIN_DEFAULT_QUEUE_POLICY))
+    
+    @staticmethod
+    def _resolve_plugin_timeout(plugin):
+        """超时时间优先取 PLUGIN_TIMEOUT_OVERRIDES，其次插件类属性 EVENT_TIMEOUT，最后 PLUGIN_EVENT_TIMEOUT"""
+        plugin_name = type(plugin).__module__
+        timeout = Config.PLUGIN_TIMEOUT_OVERRIDES.get(plugin_name)
+        if timeout is None:
+            timeout = getattr(plugin, "EVENT_TIMEOUT", None)
+        try:
+            timeout = float(timeout)
+        except (TypeError, ValueError):
+            return Config.PLUGIN_EVENT_TIMEOUT
+        return timeout if timeout > 0 else Config.PLUGIN_EVENT_TIMEOUT
         
     def _get_file_info(self, file_path):
         try:
@@ -404,6 +1050,14 @@ class PluginManager:
                             rejected_count += 1
                             continue
                     
+                    if module_name in Config.ISOLATED_PLUGINS:
+                        plugin = await self._load_isolated_plugin(module_name, file_path)
+                        async with self._lock:
+                            self.plugins.append(plugin)
+                        self._server_manager.logger.info(f"加载隔离插件: {module_name} (进程 {plugin.host.pid})")
+                        loaded_count += 1
+                        continue
+                    
                     if module_name in sys.modules:
                         del sys.modules[module_name]
                     
@@ -418,9 +1072,7 @@ class PluginManager:
                             rejected_count += 1
                             continue
                         
-                        plugin_state_accessor = PluginStateAccessor(module_name, global_state)
-                        
-                        context = PluginContext(module_name, readonly_global_state, plugin_state_accessor)
+                        context = self._create_plugin_context(module_name)
                         self.plugin_contexts[module_name] = context
                         
                         plugin = module.Plugin(context)
@@ -468,9 +1120,7 @@ class PluginManager:
                                         rejected_count += 1
                                         continue
                                     
-                                    plugin_state_accessor = PluginStateAccessor(module_name, global_state)
-                                    
-                                    context = PluginContext(module_name, readonly_global_state, plugin_state_accessor)
+                                    context = self._create_plugin_context(module_name)
                                     self.plugin_contexts[module_name] = context
                                     
                                     plugin = module.Plugin(context)
@@ -504,13 +1154,37 @@ class PluginManager:
                     await self._log_error_once(filename, error_msg, Config.ENABLE_DEBUG)
                     rejected_count += 1
         
+        self._rebuild_event_index()
+        
         global_state._update_plugin_stats(loaded_count=loaded_count, rejected_count=rejected_count)
         
         self._server_manager.logger.info(f"插件加载完成: 成功 {loaded_count} 个, 失败 {rejected_count} 个")
         gc.collect()
         self.initial_loading_complete = True
     
+    async def _load_isolated_plugin(self, module_name, file_path):
+        """在子进程中加载插件，返回主进程中的替身插件；子进程启动失败时抛出异常"""
+        host = IsolatedPluginHost(module_name, self._server_manager.logger, self.command_registry)
+        await host.start()
+        
+        self._isolated_hosts[module_name] = host
+        self.plugin_contexts[module_name] = self._create_plugin_context(module_name)
+        self.plugin_modules[file_path] = None
+        return create_isolated_plugin(host)
+    
+    async def stop_isolated_plugins(self):
+        hosts = list(self._isolated_hosts.values())
+        self._isolated_hosts.clear()
+        await asyncio.gather(*(host.stop() for host in hosts), return_exceptions=True)
+    
     async def _force_cleanup_plugin(self, plugin_name):
+        self.command_registry.unregister_plugin(plugin_name)
+        
+        gate = self._gates.get(plugin_name)
+        if gate is not None:
+            for invocation in gate.flush():
+                self._discard_invocation(invocation)
+        
         if plugin_name in self.plugin_contexts:
             context = self.plugin_contexts[plugin_name]
             
@@ -537,6 +1211,10 @@ class PluginManager:
             self.log_cleaner.clean_plugin_log_file(plugin_name)
             
             self._server_manager.logger.debug(f"已强制清理插件 {plugin_name} 的所有资源")
+        
+        host = self._isolated_hosts.pop(plugin_name, None)
+        if host is not None:
+            await host.stop()
     
     async def reload_plugin(self, file_path):
         try:
@@ -550,10 +1228,28 @@ class PluginManager:
             
             await self._force_cleanup_plugin(module_name)
             
+            if module_name in Config.ISOLATED_PLUGINS:
+                async with self._lock:
+                    self.plugins = [plugin for plugin in self.plugins if type(plugin).__module__ != module_name]
+                    self._rebuild_event_index()
+                
+                plugin = await self._load_isolated_plugin(module_name, file_path)
+                async with self._lock:
+                    self.plugins.append(plugin)
+                    self._rebuild_event_index()
+                
+                current_reload_count = global_state.get_global_var("framework.plugins.reload_count", 0)
+                global_state._update_plugin_stats(reload_count=current_reload_count + 1)
+                
+                self._server_manager.logger.info(f"重新加载隔离插件: {module_name} (进程 {plugin.host.pid})")
+                return True
+            
             if module_name in sys.modules:
                 del sys.modules[module_name]
             
             module = importlib.import_module(module_name)
+            # fork 出的进程池工作进程仍持有旧模块，用过进程池的插件重载后换一批工作进程
+            self._server_manager.process_pool.recycle(module_name)
             
             self.plugin_modules[file_path] = module
             
@@ -561,11 +1257,10 @@ class PluginManager:
                 for i, plugin in enumerate(self.plugins[:]):
                     if type(plugin).__module__ == module_name:
                         self.plugins.pop(i)
+                self._rebuild_event_index()
             
             if hasattr(module, "Plugin"):
-                plugin_state_accessor = PluginStateAccessor(module_name, global_state)
-                
-                context = PluginContext(module_name, readonly_global_state, plugin_state_accessor)
+                context = self._create_plugin_context(module_name)
                 self.plugin_contexts[module_name] = context
                 
                 plugin = module.Plugin(context)
@@ -573,6 +1268,7 @@ class PluginManager:
                 if plugin:
                     async with self._lock:
                         self.plugins.append(plugin)
+                        self._rebuild_event_index()
                     
                     current_reload_count = global_state.get_global_var("framework.plugins.reload_count", 0)
                     global_state._update_plugin_stats(reload_count=current_reload_count + 1)
@@ -606,6 +1302,7 @@ class PluginManager:
                 if type(plugin).__module__ == plugin_name:
                     await self._force_cleanup_plugin(plugin_name)
                     self.plugins.pop(i)
+                    self._rebuild_event_index()
                     
                     if plugin_name in sys.modules:
                         del sys.modules[plugin_name]
@@ -652,10 +1349,28 @@ class PluginManager:
                                 self._server_manager.logger.error(f"插件 {module_name} 的依赖安装失败，跳过加载")
                                 continue
                         
+                        if module_name in Config.ISOLATED_PLUGINS:
+                            file_info = self._get_file_info(file_path)
+                            if file_info:
+                                self.plugin_files[file_path] = file_info
+                            
+                            plugin = await self._load_isolated_plugin(module_name, file_path)
+                            async with self._lock:
+                                self.plugins.append(plugin)
+                                self._rebuild_event_index()
+                            
+                            current_loaded_count = global_state.get_global_var("framework.plugins.loaded_count", 0)
+                            global_state._update_plugin_stats(loaded_count=current_loaded_count + 1)
+                            
+                            self._server_manager.logger.info(f"发现并加载新隔离插件: {module_name} (进程 {plugin.host.pid})")
+                            new_plugins_found = True
+                            continue
+                        
                         if module_name in sys.modules:
                             del sys.modules[module_name]
                         
                         module = importlib.import_module(module_name)
+                        self._server_manager.process_pool.recycle(module_name)
                         
                         file_info = self._get_file_info(file_path)
                         if file_info:
@@ -664,9 +1379,7 @@ class PluginManager:
                         self.plugin_modules[file_path] = module
                         
                         if hasattr(module, "Plugin"):
-                            plugin_state_accessor = PluginStateAccessor(module_name, global_state)
-                            
-                            context = PluginContext(module_name, readonly_global_state, plugin_state_accessor)
+                            context = self._create_plugin_context(module_name)
                             self.plugin_contexts[module_name] = context
                             
                             plugin = module.Plugin(context)
@@ -674,6 +1387,7 @@ class PluginManager:
                             if plugin:
                                 async with self._lock:
                                     self.plugins.append(plugin)
+                                    self._rebuild_event_index()
                                 
                                 current_loaded_count = global_state.get_global_var("framework.plugins.loaded_count", 0)
                                 global_state._update_plugin_stats(loaded_count=current_loaded_count + 1)
@@ -705,9 +1419,7 @@ class PluginManager:
                                     self.plugin_modules[file_path] = module
                                     
                                     if hasattr(module, "Plugin"):
-                                        plugin_state_accessor = PluginStateAccessor(module_name, global_state)
-                                        
-                                        context = PluginContext(module_name, readonly_global_state, plugin_state_accessor)
+                                        context = self._create_plugin_context(module_name)
                                         self.plugin_contexts[module_name] = context
                                         
                                         plugin = module.Plugin(context)
@@ -715,6 +1427,7 @@ class PluginManager:
                                         if plugin:
                                             async with self._lock:
                                                 self.plugins.append(plugin)
+                                                self._rebuild_event_index()
                                             
                                             current_loaded_count = global_state.get_global_var("framework.plugins.loaded_count", 0)
                                             global_state._update_plugin_stats(loaded_count=current_loaded_count + 1)
@@ -750,6 +1463,7 @@ class PluginManager:
                             global_state._update_plugin_stats(loaded_count=current_loaded_count - 1)
                             
                             self._server_manager.logger.info(f"插件 {module_name} 已被移除")
+                    self._rebuild_event_index()
                 
                 if module_name in sys.modules:
                     del sys.modules[module_name]
@@ -780,17 +1494,23 @@ class PluginManager:
             if self._is_file_changed(file_path, old_info):
                 self._server_manager.logger.info(f"检测到插件文件修改: {os.path.basename(file_path)}")
                 if await self.reload_plugin(file_path):
+                    module_name = os.path.basename(file_path)[:-3]
+                    breaker = self._breakers.get(module_name)
+                    if breaker is not None:
+                        breaker.reset()
                     new_info = self._get_file_info(file_path)
                     if new_info:
                         self.plugin_files[file_path] = new_info
     
     async def handle_event(self, event):
-        if self.deduplication_manager.check_event(event):
+        if await self.deduplication_manager.check_event(event):
+            self.event_stats["deduplicated"] += 1
             if Config.ENABLE_DEBUG:
                 self._server_manager.logger.debug(f"检测到重复事件，已跳过处理")
             return
         
         if self.startup_rejector.should_reject_event():
+            self.event_stats["startup_rejected"] += 1
             remaining_time = self.startup_rejector.get_remaining_time()
             if Config.ENABLE_DEBUG:
                 self._server_manager.logger.debug(f"启动拒绝期内，拒绝处理事件。剩余时间: {remaining_time:.1f}秒，已拒绝事件数: {self.startup_rejector.rejected_count}")
@@ -802,71 +1522,205 @@ class PluginManager:
             last_event_time=datetime.now().isoformat()
         )
         
-        async with self._lock:
-            plugins_copy = self.plugins[:]
+        post_type = event.get("post_type")
+        if post_type == "notice":
+            try:
+                bot_api.response_cache.handle_notice(event)
+                if Config.ENABLE_MEMBER_STORE:
+                    member_store.handle_notice(event)
+            except Exception as e:
+                self._server_manager.logger.warning(f"根据通知更新API缓存失败: {str(e)}")
+        elif post_type == "message" and Config.ENABLE_MEMBER_STORE and event.get("message_type") == "group":
+            member_store.handle_message(event)
         
-        timeout_tracker = {}
-        user_tasks = []
+        conversation_key = self._get_conversation_key(event) if Config.ENABLE_CONVERSATION_ORDERING else None
+        if conversation_key is None:
+            await self._dispatch_event(event)
+        else:
+            await self.conversation_scheduler.submit(conversation_key, self._dispatch_event, event)
+    
+    @staticmethod
+    def _get_conversation_key(event):
+        """同一群/同一私聊对象的事件按顺序处理，其余事件不排序"""
+        group_id = event.get("group_id")
+        if group_id:
+            return ("group", group_id)
+        
+        if event.get("post_type") == "meta_event":
+            return None
+        
+        user_id = event.get("user_id")
+        if user_id:
+            return ("user", user_id)
+        return None
+    
+    async def _dispatch_event(self, event):
+        async with self._lock:
+            plugins_copy = self.subscription_index.match(event)
         
+        invocations = []
         for plugin in plugins_copy:
             plugin_name = type(plugin).__module__
-            task = asyncio.create_task(self._handle_plugin_event_with_timeout(plugin, event, plugin_name))
-            user_tasks.append(task)
-            timeout_tracker[task] = plugin_name
+            handler = getattr(plugin, 'handle_event_async', None)
+            if handler is None:
+                self._server_manager.logger.warning(f"插件 {plugin_name} 没有实现异步事件处理方法 handle_event_async，将忽略此事件")
+                continue
+            invocations.append((plugin_name, handler, (event,), None))
+        
+        if event.get("post_type") in ("message", "message_sent") and self.command_registry.has_commands():
+            for entry, command_match in self.command_registry.match(event.get("raw_message", "")):
+                invocations.append((entry.plugin_name, entry.handler, (event, command_match), entry))
+        
+        if self._breakers:
+            # 熔断中的插件直接跳过，不创建任务也不占用并发名额
+            breakers = self._breakers
+            allowed = []
+            for invocation in invocations:
+                breaker = breakers.get(invocation[0])
+                if breaker is None or breaker.allow():
+                    allowed.append(invocation)
+            invocations = allowed
+        
+        if not invocations:
+            return
         
-        try:
-            done, pending = await asyncio.wait(user_tasks, timeout=Config.PLUGIN_EVENT_TIMEOUT)
+        batch = _DispatchBatch(len(invocations))
+        for plugin_name, handler, args, entry in invocations:
+            gate = self._gates.get(plugin_name)
+            if gate is None:
+                self._start_plugin_task(plugin_name, handler, args, event, batch, entry)
+                continue
             
-            for task in pending:
-                plugin_name = timeout_tracker.get(task, "unknown")
-                self._server_manager.logger.warning(f"插件 {plugin_name} 事件处理超时，正在处理...")
-                
+            # 限制并发的插件由自己的等待队列保证顺序：交给并发限制即算本批完成，不阻塞同一会话的后续事件，
+            # 后续事件的调用才能在队列中合并
+            batch.done_one()
+            if gate.try_acquire():
+                self._start_plugin_task(plugin_name, handler, args, event, None, entry, gate)
+                continue
+            
+            key = (self._get_conversation_key(event), entry.pattern if entry is not None else None)
+            for discarded in gate.enqueue(key, (plugin_name, handler, args, event, None, entry)):
+                self._discard_invocation(discarded)
+        
+        # 超时由时间轮统一取消，这里只等待本批不限并发的调用全部结束（或被放弃）
+        await batch.future
+    
+    def _discard_invocation(self, invocation):
+        """并发限制丢弃、合并或清空的调用：归还熔断器的试探名额"""
+        breaker = self._breakers.get(invocation[0])
+        if breaker is not None:
+            breaker.record_abort()
+    
+    def _start_plugin_task(self, plugin_name, handler, args, event, batch, entry=None, gate=None):
+        """每次插件调用只创建一个任务：插件协程直接在该任务中运行，并登记到插件上下文以便卸载时取消"""
+        task = asyncio.create_task(self._run_plugin_handler(plugin_name, handler, args, event, entry))
+        context = self.plugin_contexts.get(plugin_name)
+        if context is not None:
+            context.active_tasks.add(task)
+        self._invocations[task] = (context, batch, gate)
+        self.timeout_wheel.add(task, plugin_name, self._plugin_timeouts.get(plugin_name, Config.PLUGIN_EVENT_TIMEOUT))
+        task.add_done_callback(self._on_plugin_task_done)
+        return task
+    
+    def _on_plugin_task_done(self, task):
+        self.timeout_wheel.discard(task)
+        context, batch, gate = self._invocations.pop(task, (None, None, None))
+        if context is not None:
+            context.active_tasks.discard(task)
+        if batch is not None:
+            batch.done_one()
+        if gate is not None:
+            self._release_gate(gate)
+    
+    def _release_gate(self, gate):
+        invocation = gate.release()
+        if invocation is not None:
+            self._start_plugin_task(*invocation, gate=gate)
+    
+    def _on_plugin_timeouts(self, expired):
+        """时间轮回调：批量取消超时调用；取消宽限期过后仍未结束的调用放弃等待并重载插件"""
+        timed_out = {}
+        refused = set()
+        
+        for task, plugin_name, stage in expired:
+            if stage == "run":
                 task.cancel()
-                
+                timed_out[plugin_name] = timed_out.get(plugin_name, 0) + 1
                 global_state._increment_plugin_timeout()
-                
-                try:
-                    await asyncio.wait_for(task, timeout=Config.PLUGIN_CANCEL_WAIT_TIMEOUT)
-                    self._server_manager.logger.info(f"插件 {plugin_name} 已成功取消")
-                except (asyncio.CancelledError, asyncio.TimeoutError):
-                    self._server_manager.logger.error(f"插件 {plugin_name} 拒绝终止，将强制重载插件")
-                    asyncio.create_task(self.reload_plugin_by_name(plugin_name))
-            
-            for task in done:
-                try:
-                    task.result()
-                except asyncio.CancelledError:
-                    pass  
-                except Exception as e:
-                    plugin_name = timeout_tracker.get(task, "unknown")
-                    self._server_manager.logger.error(f"插件 {plugin_name} 事件处理出错: {str(e)}")
-                    
-        except Exception as e:
-            self._server_manager.logger.error(f"用户插件事件处理出错: {str(e)}")
+                self._get_plugin_metrics(plugin_name).timeouts += 1
+                breaker = self._breakers.get(plugin_name)
+                if breaker is not None:
+                    breaker.record_failure("超时")
+                self.timeout_wheel.add(task, plugin_name, Config.PLUGIN_CANCEL_WAIT_TIMEOUT, stage="cancel")
+            else:
+                self.refused_cancel_total += 1
+                refused.add(plugin_name)
+                context, batch, gate = self._invocations.get(task, (None, None, None))
+                if batch is not None:
+                    self._invocations[task] = (context, None, None)
+                    batch.done_one()
+                if gate is not None:
+                    self._release_gate(gate)
+        
+        if timed_out:
+            summary = ", ".join(f"{name}×{count}" if count > 1 else name for name, count in timed_out.items())
+            self._server_manager.logger.warning(f"插件事件处理超时，已取消: {summary}")
+        
+        for plugin_name in refused:
+            self._server_manager.logger.error(f"插件 {plugin_name} 拒绝终止，将强制重载插件")
+            asyncio.create_task(self.reload_plugin_by_name(plugin_name))
     
-    async def _handle_plugin_event_with_timeout(self, plugin, event, plugin_name):
+    async def _run_plugin_handler(self, plugin_name, handler, args, event, entry=None):
+        metrics = self._get_plugin_metrics(plugin_name)
+        metrics.invocations += 1
+        start_time = time.perf_counter()
+        breaker = self._breakers.get(plugin_name)
         try:
-            if hasattr(plugin, 'handle_event_async'):
-                task = asyncio.create_task(plugin.handle_event_async(event))
-                if plugin_name in self.plugin_contexts:
-                    self.plugin_contexts[plugin_name].register_task(task)
-                await task
-            else:
-                self._server_manager.logger.warning(f"插件 {plugin_name} 没有实现异步事件处理方法 handle_event_async，将忽略此事件")
+            await handler(*args)
+        except asyncio.CancelledError:
+            if breaker is not None:
+                breaker.record_abort()
+            raise
         except Exception as e:
-            error_msg = f"插件 {plugin_name} 处理事件出错: {str(e)}"
+            metrics.errors += 1
+            if breaker is not None:
+                breaker.record_failure("出错")
+            if entry is None:
+                error_msg = f"插件 {plugin_name} 处理事件出错: {str(e)}"
+            else:
+                error_msg = f"插件 {plugin_name} 处理命令 {entry.pattern} 出错: {str(e)}"
             await self._log_error_once(plugin_name, error_msg, Config.ENABLE_DEBUG)
+        else:
+            if breaker is not None:
+                breaker.record_success()
+        finally:
+            self._record_plugin_timing(plugin_name, metrics, time.perf_counter() - start_time, event,
+                                       handler=f"{entry.kind}:{entry.pattern}" if entry is not None else None)
 
 class BotApplication:
-    def __init__(self, logger, api_logger):
+    def __init__(self, logger, api_logger, cluster_channel=None):
         self.logger = logger
         self.api_logger = api_logger
+        self.cluster_channel = cluster_channel
         self.global_stop_event = asyncio.Event()
         
         self.server_manager = ServerManager(Config, self.logger)
         
         self.plugin_manager = PluginManager(self.server_manager)
         
+        self.event_queue = EventIngressQueue(self.plugin_manager.handle_event, self.logger)
+        
+        self.ws_transport = WebSocketEventTransport(
+            self.logger,
+            self.dispatch_event,
+            on_response=bot_api.handle_ws_response,
+            on_connect=bot_api.attach_websocket,
+            on_disconnect=bot_api.detach_websocket
+        )
+        
+        self.events_received = 0
+        self.loop_watchdog = LoopWatchdog(self.logger, self.plugin_manager.plugins_dir)
+        
         self._initialize_global_state()
     
     def _initialize_global_state(self):
@@ -883,6 +1737,11 @@ class BotApplication:
     async def initialize(self):
         await self.server_manager.initialize()
         
+        bot_api.use_connection_pool(self.server_manager.connection_pool)
+        if Config.HTTP_POOL_PREWARM > 0:
+            warmed = await self.server_manager.connection_pool.prewarm(Config.API_BASE_URL, Config.HTTP_POOL_PREWARM)
+            self.logger.info(f"HTTP连接池预热完成: {warmed}/{Config.HTTP_POOL_PREWARM} 个连接")
+        
         global_state._update_framework_status("running")
         
         self.logger.info("框架初始化完成")
@@ -892,6 +1751,12 @@ class BotApplication:
         
         self.logger.info("正在关闭服务器...")
         
+        self.loop_watchdog.stop()
+        await self.ws_transport.close()
+        await self.event_queue.stop()
+        await self.plugin_manager.conversation_scheduler.stop()
+        await self.plugin_manager.stop_isolated_plugins()
+        await self.plugin_manager.deduplication_manager.close()
         await self.server_manager.shutdown()
         self.global_stop_event.set()
     
@@ -970,20 +1835,184 @@ class BotApplication:
                 
                 global_state._update_runtime_stats(uptime=uptime)
                 
+                self.event_queue.publish_stats(force=True)
+                global_state._set_global_var("framework.runtime.conversations", self.plugin_manager.conversation_scheduler.get_stats())
+                
+                if Config.ENABLE_REQUEST_DEDUPLICATION:
+                    global_state._set_global_var("framework.performance.api_dedup", bot_api.get_dedup_stats())
+                
+                if Config.ENABLE_EVENT_DEDUPLICATION:
+                    global_state._set_global_var("framework.performance.event_dedup", self.plugin_manager.deduplication_manager.get_stats())
+                
+                if Config.ENABLE_API_RESPONSE_CACHE:
+                    global_state._set_global_var("framework.performance.api_cache", bot_api.get_cache_stats())
+                
+                if Config.ENABLE_MEMBER_STORE:
+                    global_state._set_global_var("framework.runtime.member_store", member_store.get_stats())
+                
+                global_state._set_global_var("framework.transport.http_pool", self.server_manager.connection_pool.get_stats())
+                global_state._set_global_var("framework.runtime.process_pool", self.server_manager.process_pool.get_stats())
+                global_state._set_global_var("framework.performance.api_endpoints", bot_api.get_api_metrics())
+                
+                if Config.ENABLE_LOOP_WATCHDOG:
+                    global_state._set_global_var("framework.runtime.loop_lag", self.loop_watchdog.get_stats())
+                
+                global_state._set_global_var("framework.plugins.latency", self.plugin_manager.get_plugin_latency_stats())
+                global_state._set_global_var("framework.plugins.concurrency", self.plugin_manager.get_concurrency_stats())
+                global_state._set_global_var("framework.plugins.circuit_breakers", self.plugin_manager.get_circuit_breaker_stats())
+                global_state._set_global_var("framework.plugins.isolated", self.plugin_manager.get_isolated_plugin_stats())
+                global_state._set_global_var("framework.plugins.timeouts", dict(
+                    self.plugin_manager.timeout_wheel.get_stats(),
+                    refused_cancel_total=self.plugin_manager.refused_cancel_total
+                ))
+                global_state._set_global_var("framework.plugins.slow_handlers", list(self.plugin_manager.slow_handlers)[-20:])
+                
+                if Config.ENABLE_REVERSE_WS or Config.ENABLE_FORWARD_WS:
+                    ws_stats = self.ws_transport.get_stats()
+                    ws_stats["api"] = dict(bot_api.ws_stats, pending=len(bot_api._ws_pending))
+                    global_state._set_global_var("framework.transport.websocket", ws_stats)
+                
             except Exception as e:
                 self.logger.error(f"运行时统计更新出错: {str(e)}", exc_info=Config.ENABLE_DEBUG)
             
             await asyncio.sleep(10)
     
+    def dispatch_event(self, data):
+        """HTTP 与 WebSocket 共用的事件入口，返回 queued / dropped / rejected"""
+        self.events_received += 1
+        return self.event_queue.put_nowait(data)
+    
+    async def handle_metrics(self, request):
+        try:
+            body = self.render_metrics()
+        except Exception as e:
+            self.logger.error(f"生成监控指标出错: {str(e)}", exc_info=Config.ENABLE_DEBUG)
+            return web.Response(status=500, text="metrics error")
+        return web.Response(body=body.encode("utf-8"),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+    
+    async def handle_admin_plugins(self, request):
+        """本机管理接口：插件耗时分布与慢处理记录"""
+        if request.remote not in ("127.0.0.1", "::1"):
+            return web.json_response({"error": "forbidden"}, status=403)
+        
+        return web.json_response({
+            "slow_threshold_ms": Config.PLUGIN_SLOW_THRESHOLD * 1000,
+            "plugins": self.plugin_manager.get_plugin_latency_stats(),
+            "slow_handlers": list(self.plugin_manager.slow_handlers),
+            "circuit_breakers": self.plugin_manager.get_circuit_breaker_stats(),
+            "loop_lag": self.loop_watchdog.get_stats()
+        }, dumps=lambda data: json.dumps(data, ensure_ascii=False))
+    
+    def render_metrics(self):
+        """汇总框架计数器，输出 Prometheus 文本格式"""
+        writer = PrometheusWriter()
+        plugin_manager = self.plugin_manager
+        queue_stats = self.event_queue.get_stats()
+        
+        writer.counter("nebula_events_received_total", "收到的事件总数", self.events_received)
+        writer.counter("nebula_events_processed_total", "交给插件处理的事件总数",
+                       global_state.get_global_var("framework.runtime.total_events_processed", 0))
+        writer.counter("nebula_events_deduplicated_total", "因重复被跳过的事件数", plugin_manager.event_stats["deduplicated"])
+        dedup_stats = plugin_manager.deduplication_manager.get_stats()
+        event_tracker_stats = dedup_stats["event_tracker"]
+        writer.gauge("nebula_dedup_tracker_entries", "去重跟踪表中的条目数", event_tracker_stats["entries"], {"tracker": "event", "mode": dedup_stats["mode"]})
+        writer.gauge("nebula_dedup_tracker_entries", "去重跟踪表中的条目数", len(bot_api._inflight), {"tracker": "api_inflight", "mode": "exact"})
+        if event_tracker_stats["mode"] == "bloom":
+            writer.gauge("nebula_dedup_filter_memory_bytes", "事件去重布隆过滤器占用内存", event_tracker_stats["memory_bytes"])
+            writer.gauge("nebula_dedup_filter_fill_ratio", "最新分段已置位比例", event_tracker_stats["fill_ratio"])
+            writer.gauge("nebula_dedup_filter_estimated_fpr", "按置位比例估算的误判率", event_tracker_stats["estimated_fpr"])
+            writer.counter("nebula_dedup_filter_early_rotations_total", "分段写满提前轮换的次数", event_tracker_stats["early_rotations_total"])
+        store_stats = dedup_stats["shared_store"]
+        if store_stats is not None:
+            labels = {"backend": store_stats["backend"]}
+            writer.counter("nebula_dedup_store_checks_total", "共享去重存储的检查次数", store_stats["checks_total"], labels)
+            writer.counter("nebula_dedup_store_duplicates_total", "共享去重存储判定为重复的次数", store_stats["duplicates_total"], labels)
+            writer.counter("nebula_dedup_store_errors_total", "共享去重存储不可用而改用进程内去重的次数", dedup_stats["shared_store_errors"], labels)
+        writer.counter("nebula_events_rejected_total", "被拒绝的事件数", plugin_manager.event_stats["startup_rejected"], {"reason": "startup"})
+        writer.counter("nebula_events_rejected_total", "被拒绝的事件数", queue_stats["rejected_total"], {"reason": "queue_full"})
+        writer.counter("nebula_events_dropped_total", "队列溢出时丢弃的事件数", queue_stats["dropped_total"])
+        
+        writer.gauge("nebula_ingress_queue_depth", "事件队列当前长度", queue_stats["queue_depth"])
+        writer.gauge("nebula_ingress_queue_max_size", "事件队列容量", queue_stats["max_size"])
+        
+        writer.gauge("nebula_plugins_loaded", "已加载插件数", len(plugin_manager.plugins))
+        writer.counter("nebula_plugin_timeouts_total", "插件超时总数",
+                       global_state.get_global_var("framework.plugins.timeout_count", 0))
+        for plugin_name, metrics in list(plugin_manager.plugin_metrics.items()):
+            labels = {"plugin": plugin_name}
+            writer.counter("nebula_plugin_invocations_total", "插件调用次数", metrics.invocations, labels)
+            writer.counter("nebula_plugin_errors_total", "插件处理出错次数", metrics.errors, labels)
+            writer.counter("nebula_plugin_handler_timeouts_total", "插件处理超时次数", metrics.timeouts, labels)
+            writer.counter("nebula_plugin_slow_calls_total", "超过慢处理阈值的调用次数", metrics.slow_calls, labels)
+            writer.histogram("nebula_plugin_handler_duration_seconds", "插件单次处理耗时", metrics.latency, labels)
+        
+        for plugin_name, gate in list(plugin_manager._gates.items()):
+            labels = {"plugin": plugin_name}
+            writer.gauge("nebula_plugin_queue_depth", "插件等待队列长度", len(gate.queue), labels)
+            writer.gauge("nebula_plugin_running", "插件正在运行的调用数", gate.running, labels)
+            writer.counter("nebula_plugin_queue_dropped_total", "插件等待队列丢弃的调用数", gate.dropped_total, labels)
+            writer.counter("nebula_plugin_queue_coalesced_total", "插件等待队列合并的调用数", gate.coalesced_total, labels)
+        
+        for plugin_name, breaker in list(plugin_manager._breakers.items()):
+            labels = {"plugin": plugin_name}
+            writer.gauge("nebula_plugin_circuit_state", "插件熔断状态(0=关闭 1=半开 2=打开)",
+                         PluginCircuitBreaker.STATE_CODES[breaker.state], labels)
+            writer.counter("nebula_plugin_circuit_skipped_total", "熔断期间跳过的插件调用数", breaker.skipped_total, labels)
+            for state, count in breaker.transitions.items():
+                writer.counter("nebula_plugin_circuit_transitions_total", "插件熔断状态切换次数", count, dict(labels, state=state))
+        
+        for plugin_name, host in list(plugin_manager._isolated_hosts.items()):
+            labels = {"plugin": plugin_name}
+            writer.gauge("nebula_isolated_worker_up", "隔离插件工作进程是否就绪", 1 if host.ready else 0, labels)
+            writer.gauge("nebula_isolated_worker_in_flight", "隔离插件工作进程中未完成的调用数", len(host._calls), labels)
+            writer.counter("nebula_isolated_worker_restarts_total", "隔离插件工作进程崩溃后重启次数", host.restarts_total, labels)
+            writer.counter("nebula_isolated_worker_killed_total", "隔离插件工作进程因拒绝终止被强制结束的次数", host.killed_total, labels)
+            writer.counter("nebula_isolated_worker_rejected_total", "IPC积压超限而直接失败的隔离插件调用数", host.rejected_total, labels)
+            writer.counter("nebula_isolated_api_calls_total", "隔离插件代理到主进程的API调用数", host.api_calls_total, labels)
+        
+        for plugin_name, context in list(plugin_manager.plugin_contexts.items()):
+            writer.gauge("nebula_plugin_active_tasks", "插件未完成的任务数", len(context.active_tasks), {"plugin": plugin_name})
+        writer.gauge("nebula_active_tasks", "事件循环中的任务总数", len(asyncio.all_tasks()))
+        
+        writer.counter("nebula_api_requests_total", "API调用总数",
+                       global_state.get_global_var("framework.performance.api_requests_total", 0))
+        writer.counter("nebula_api_requests_failed_total", "API调用失败数",
+                       global_state.get_global_var("framework.performance.api_requests_failed", 0))
+        for endpoint, metrics in bot_api.metrics.endpoints():
+            labels = {"endpoint": endpoint}
+            writer.counter("nebula_api_endpoint_calls_total", "按接口统计的调用次数", metrics.calls, labels)
+            writer.counter("nebula_api_endpoint_failures_total", "按接口统计的失败次数", metrics.failures, labels)
+            writer.counter("nebula_api_endpoint_retries_total", "按接口统计的重试次数", metrics.retries, labels)
+            writer.histogram("nebula_api_request_duration_seconds", "API请求耗时", metrics.latency, labels)
+        
+        process_pool_stats = self.server_manager.process_pool.get_stats()
+        writer.gauge("nebula_process_pool_workers", "存活的进程池工作进程数", process_pool_stats["workers_alive"])
+        writer.counter("nebula_process_pool_restarts_total", "进程池因工作进程崩溃重建的次数", process_pool_stats["restarts_total"])
+        for plugin_name, quota in process_pool_stats["plugins"].items():
+            labels = {"plugin": plugin_name}
+            writer.gauge("nebula_process_pool_running", "插件正在进程池中执行的任务数", quota["running"], labels)
+            writer.gauge("nebula_process_pool_waiting", "插件等待进程池配额的任务数", quota["waiting"], labels)
+            writer.counter("nebula_process_pool_tasks_total", "插件提交到进程池的任务数", quota["submitted"], labels)
+            writer.counter("nebula_process_pool_failures_total", "插件进程池任务失败数", quota["failed"], labels)
+        
+        watchdog = self.loop_watchdog
+        writer.gauge("nebula_event_loop_lag_seconds", "最近一次采样的事件循环延迟", watchdog.last_lag)
+        writer.histogram("nebula_event_loop_lag_distribution_seconds", "事件循环延迟分布", watchdog.histogram)
+        for culprit, count in list(watchdog.blocked_by_plugin.items()):
+            writer.counter("nebula_event_loop_blocked_total", "事件循环阻塞次数(按疑似来源)", count, {"plugin": culprit})
+        writer.gauge("nebula_uptime_seconds", "框架运行时间", global_state.get_global_var("framework.runtime.uptime_seconds", 0))
+        
+        return writer.render()
+    
     async def handle_event(self, request):
         try:
             data = await request.json()
             if Config.ENABLE_DEBUG:
                 self.logger.debug(f"收到事件: {json.dumps(data, ensure_ascii=False, indent=2)}")
             
-            post_type = data.get("post_type", "unknown")
-            
-            asyncio.create_task(self.plugin_manager.handle_event(data))
+            if self.dispatch_event(data) == "rejected":
+                return web.json_response({"error": "event queue full"}, status=503)
             
             return web.json_response({})
         
@@ -1018,9 +2047,43 @@ class BotApplication:
         
         await self.server_manager.start_all()
         
+        await self.event_queue.start()
+        self.logger.info(f"事件队列已启动: 容量 {self.event_queue.max_size}, 工作协程 {self.event_queue.worker_count}, 溢出策略 {self.event_queue.overflow_policy}")
+        
         app = web.Application()
         app.router.add_post('/onebot', self.handle_event)
         
+        if Config.ENABLE_METRICS_ENDPOINT:
+            app.router.add_get(Config.METRICS_PATH, self.handle_metrics)
+            self.logger.info(f"监控指标已启用: {Config.METRICS_PATH}")
+        
+        if Config.ENABLE_ADMIN_ENDPOINT:
+            app.router.add_get(Config.ADMIN_PLUGINS_PATH, self.handle_admin_plugins)
+            self.logger.info(f"本机管理接口已启用: {Config.ADMIN_PLUGINS_PATH}")
+        
+        if Config.ENABLE_LOOP_WATCHDOG:
+            self.loop_watchdog.start()
+            self.logger.info(f"事件循环看门狗已启动: 阻塞超过 {self.loop_watchdog.threshold} 秒时告警")
+        
+        if Config.ENABLE_REVERSE_WS:
+            app.router.add_get(Config.REVERSE_WS_PATH, self.ws_transport.reverse_ws_handler)
+            self.logger.info(f"反向WebSocket已启用: {Config.REVERSE_WS_PATH}")
+        
+        if Config.ENABLE_FORWARD_WS:
+            forward_ws_task = asyncio.create_task(self.ws_transport.forward_ws_worker(self.global_stop_event))
+            self.server_manager.register_task(forward_ws_task)
+            self.logger.info("正向WebSocket功能已启用")
+        
+        if self.cluster_channel is not None:
+            # 集群工作进程不监听端口，事件由主控进程通过IPC通道转发
+            try:
+                await self.cluster_channel.serve(self)
+            except Exception as e:
+                self.logger.critical(f"集群工作进程运行失败: {str(e)}", exc_info=True)
+            finally:
+                await self.shutdown()
+            return
+        
         self.logger.info(f"启动事件接收服务器: {Config.EVENT_SERVER_HOST}:{Config.EVENT_SERVER_PORT}")
         
         try:
@@ -0,0 +1,124 @@
+"""
+插件事件分发开销基准测试
+
+用法: python benchmark_dispatch.py [插件数量] [事件数量]
+
+对比旧的分发方式(每个插件调用创建两个任务: 外层超时包装任务 + handle_event_async 任务)
+与当前 PluginManager._dispatch_event(每个插件调用一个任务)的单事件开销。
+插件均为空实现，测得的时间即为框架自身的分发开销。
+"""
+
+import asyncio
+import logging
+import sys
+import time
+
+from config import Config
+from server_manager import ServerManager
+from app import PluginManager
+
+def make_plugin(index):
+    class Plugin:
+        EVENT_SUBSCRIPTIONS = {"post_type": ["message"]}
+        
+        def __init__(self, context):
+            self.context = context
+        
+        async def handle_event_async(self, event):
+            return None
+    
+    Plugin.__module__ = f"bench_plugin_{index}"
+    return Plugin
+
+def make_event(index):
+    return {
+        "post_type": "message",
+        "message_type": "group",
+        "group_id": 10000 + index % 50,
+        "user_id": 20000 + index,
+        "raw_message": f"bench {index}",
+        "time": int(time.time())
+    }
+
+async def legacy_dispatch(plugin_manager, event):
+    """旧实现：外层任务里再创建插件任务并登记，最后 asyncio.wait 等待全部完成"""
+    async def handle_with_timeout(plugin, plugin_name):
+        try:
+            task = asyncio.create_task(plugin.handle_event_async(event))
+            if plugin_name in plugin_manager.plugin_contexts:
+                plugin_manager.plugin_contexts[plugin_name].register_task(task)
+            await task
+        except Exception:
+            pass
+    
+    async with plugin_manager._lock:
+        plugins_copy = plugin_manager.subscription_index.match(event)
+    
+    timeout_tracker = {}
+    user_tasks = []
+    for plugin in plugins_copy:
+        plugin_name = type(plugin).__module__
+        task = asyncio.create_task(handle_with_timeout(plugin, plugin_name))
+        user_tasks.append(task)
+        timeout_tracker[task] = plugin_name
+    
+    if user_tasks:
+        await asyncio.wait(user_tasks, timeout=Config.PLUGIN_EVENT_TIMEOUT)
+
+async def run_case(name, dispatch, plugin_manager, event_count, concurrency):
+    events = [make_event(i) for i in range(event_count)]
+    
+    for event in events[:200]:
+        await dispatch(event)
+    
+    start = time.perf_counter()
+    if concurrency <= 1:
+        for event in events:
+            await dispatch(event)
+    else:
+        for offset in range(0, event_count, concurrency):
+            await asyncio.gather(*(dispatch(event) for event in events[offset:offset + concurrency]))
+    elapsed = time.perf_counter() - start
+    
+    per_event_us = elapsed / event_count * 1e6
+    print(f"  {name:<24} {per_event_us:>10.1f} µs/事件 {event_count / elapsed:>10.0f} 事件/秒")
+    return per_event_us
+
+async def main():
+    plugin_count = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    event_count = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    
+    logger = logging.getLogger("Benchmark")
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+    
+    Config.PLUGIN_SLOW_THRESHOLD = float("inf")
+    plugin_manager = PluginManager(ServerManager(Config, logger))
+    
+    names = []
+    for i in range(plugin_count):
+        plugin_class = make_plugin(i)
+        name = plugin_class.__module__
+        context = plugin_manager._create_plugin_context(name)
+        plugin_manager.plugin_contexts[name] = context
+        plugin_manager.plugins.append(plugin_class(context))
+        names.append(name)
+    plugin_manager._rebuild_event_index()
+    
+    print(f"插件数量: {plugin_count}, 事件数量: {event_count}")
+    try:
+        for concurrency in (1, 32):
+            print(f"并发度 {concurrency}:")
+            before = await run_case("旧实现(双任务)", lambda e: legacy_dispatch(plugin_manager, e),
+                                    plugin_manager, event_count, concurrency)
+            after = await run_case("当前实现(单任务)", plugin_manager._dispatch_event,
+                                   plugin_manager, event_count, concurrency)
+            print(f"  单事件开销降低 {(1 - after / before) * 100:.1f}%")
+    finally:
+        for name in names:
+            for handler in logging.getLogger(f"plugin.{name}").handlers[:]:
+                handler.close()
+            plugin_manager.log_cleaner.clean_plugin_log_file(name)
+
+if __name__ == "__main__":
+    asyncio.run(main())
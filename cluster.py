@@ -0,0 +1,405 @@
+"""
+集群模式
+
+CLUSTER_WORKERS > 0 时 main.py 启动为主控进程：主控进程负责监听事件端口（HTTP 上报与 WebSocket），
+并启动 N 个工作进程，每个工作进程运行完整的 BotApplication（各自的插件、BotAPI 会话和连接池）。
+事件按 group_id / user_id 的一致性哈希转发给固定的工作进程，同一会话的状态始终留在同一个进程中。
+主控进程的 /metrics 汇总所有工作进程的指标，并以 worker 标签区分。
+"""
+
+import os
+import sys
+import time
+import signal
+import socket
+import asyncio
+import hashlib
+from bisect import bisect
+from aiohttp import web
+from config import Config
+from metrics import PrometheusWriter, merge_prometheus_texts
+from plugin_worker import encode_frame, read_frame
+from ws_transport import WebSocketEventTransport
+
+CLUSTER_WORKER_ENV = "NEBULA_CLUSTER_WORKER"
+CLUSTER_FD_ENV = "NEBULA_CLUSTER_FD"
+
+def get_cluster_worker_index():
+    """当前进程是集群工作进程时返回其编号，否则返回 None"""
+    value = os.environ.get(CLUSTER_WORKER_ENV)
+    return int(value) if value is not None else None
+
+def get_routing_key(event):
+    """与会话顺序处理相同的会话划分：有群号按群，否则按用户；元事件返回 None（广播）"""
+    group_id = event.get("group_id")
+    if group_id:
+        return f"group:{group_id}"
+    if event.get("post_type") == "meta_event":
+        return None
+    user_id = event.get("user_id")
+    if user_id:
+        return f"user:{user_id}"
+    return f"type:{event.get('post_type')}"
+
+class ConsistentHashRing:
+    """一致性哈希环，每个节点放置 replicas 个虚拟节点；节点不可用时顺延到环上的下一个可用节点"""
+    def __init__(self, nodes, replicas=None):
+        self.replicas = replicas or Config.CLUSTER_HASH_REPLICAS
+        points = []
+        for node in nodes:
+            for replica in range(self.replicas):
+                points.append((self._hash(f"{node}#{replica}"), node))
+        points.sort()
+        self._hashes = [point[0] for point in points]
+        self._nodes = [point[1] for point in points]
+    
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+    
+    def get(self, key, available=None):
+        if not self._nodes:
+            return None
+        start = bisect(self._hashes, self._hash(key)) % len(self._nodes)
+        if available is None:
+            return self._nodes[start]
+        for offset in range(len(self._nodes)):
+            node = self._nodes[(start + offset) % len(self._nodes)]
+            if node in available:
+                return node
+        return None
+
+class ClusterWorkerHandle:
+    """主控进程一侧的单个工作进程：启动、转发事件、收集指标，崩溃后自动重启"""
+    def __init__(self, index, logger):
+        self.index = index
+        self.logger = logger
+        self.process = None
+        self.writer = None
+        self.ready = False
+        self._ready_future = None
+        self._reader_task = None
+        self._restart_task = None
+        self._stopping = False
+        self._metrics_requests = {}
+        self._request_id = 0
+        self._consecutive_crashes = 0
+        self.started_at = None
+        
+        self.events_routed = 0
+        self.events_dropped = 0
+        self.events_lost = 0
+        self.restarts_total = 0
+    
+    @property
+    def pid(self):
+        return self.process.pid if self.process is not None else None
+    
+    async def start(self):
+        parent_sock, child_sock = socket.socketpair()
+        env = dict(os.environ)
+        env[CLUSTER_WORKER_ENV] = str(self.index)
+        env[CLUSTER_FD_ENV] = str(child_sock.fileno())
+        main_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+        try:
+            # 独立会话：终端的 Ctrl+C 只发给主控进程，由主控进程依次关闭工作进程
+            self.process = await asyncio.create_subprocess_exec(
+                sys.executable, main_path, env=env, pass_fds=(child_sock.fileno(),),
+                cwd=os.path.dirname(main_path), start_new_session=True
+            )
+        except BaseException:
+            parent_sock.close()
+            raise
+        finally:
+            child_sock.close()
+        
+        reader, self.writer = await asyncio.open_connection(sock=parent_sock)
+        self._ready_future = asyncio.get_running_loop().create_future()
+        self._reader_task = asyncio.create_task(self._read_loop(reader, self.process))
+        try:
+            await asyncio.wait_for(asyncio.shield(self._ready_future), Config.CLUSTER_WORKER_START_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.process.kill()
+            raise RuntimeError(f"工作进程 {self.index} 在 {Config.CLUSTER_WORKER_START_TIMEOUT} 秒内未就绪")
+        self.started_at = time.time()
+    
+    async def _read_loop(self, reader, process):
+        try:
+            while True:
+                message = await read_frame(reader)
+                if message[0] == "metrics":
+                    future = self._metrics_requests.pop(message[1], None)
+                    if future is not None and not future.done():
+                        future.set_result(message[2])
+                elif message[0] == "lost":
+                    self.events_lost += message[1]
+                elif message[0] == "ready":
+                    self.ready = True
+                    if not self._ready_future.done():
+                        self._ready_future.set_result(message[1])
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            self.logger.error(f"集群工作进程 {self.index} 的IPC通道出错: {str(e)}")
+        finally:
+            await self._on_exit(process)
+    
+    async def _on_exit(self, process):
+        self.ready = False
+        try:
+            returncode = await asyncio.wait_for(process.wait(), Config.CLUSTER_WORKER_STOP_TIMEOUT)
+        except asyncio.TimeoutError:
+            process.kill()
+            returncode = await process.wait()
+        
+        if self.writer is not None:
+            self.writer.close()
+        for future in self._metrics_requests.values():
+            if not future.done():
+                future.set_result("")
+        self._metrics_requests.clear()
+        if self._ready_future is not None and not self._ready_future.done():
+            self._ready_future.set_exception(RuntimeError(f"工作进程 {self.index} 启动失败(返回码 {returncode})"))
+        
+        if self._stopping or self.started_at is None:
+            return
+        
+        if time.time() - self.started_at > 60:
+            self._consecutive_crashes = 0
+        delay = min(Config.CLUSTER_WORKER_RESTART_DELAY * 2 ** self._consecutive_crashes, 60)
+        self._consecutive_crashes += 1
+        self.logger.error(f"集群工作进程 {self.index} 意外退出(返回码 {returncode})，其会话暂由其他工作进程接管，{delay} 秒后重启")
+        self._restart_task = asyncio.create_task(self._restart_after(delay))
+    
+    async def _restart_after(self, delay):
+        await asyncio.sleep(delay)
+        try:
+            await self.start()
+        except Exception as e:
+            self.logger.error(f"集群工作进程 {self.index} 重启失败: {str(e)}")
+            return
+        self.restarts_total += 1
+        self.logger.info(f"集群工作进程 {self.index} 已重启 (进程 {self.pid})")
+    
+    def send_event(self, event):
+        """写入IPC通道；工作进程来不及读取、积压超过 CLUSTER_MAX_PENDING_BYTES 时丢弃"""
+        if not self.ready or self.writer.is_closing():
+            self.events_dropped += 1
+            return False
+        if self.writer.transport.get_write_buffer_size() > Config.CLUSTER_MAX_PENDING_BYTES:
+            self.events_dropped += 1
+            return False
+        self.writer.write(encode_frame(("event", event)))
+        self.events_routed += 1
+        return True
+    
+    async def fetch_metrics(self, timeout):
+        if not self.ready:
+            return ""
+        self._request_id += 1
+        request_id = self._request_id
+        future = asyncio.get_running_loop().create_future()
+        self._metrics_requests[request_id] = future
+        try:
+            self.writer.write(encode_frame(("metrics", request_id)))
+            return await asyncio.wait_for(future, timeout)
+        except (asyncio.TimeoutError, ConnectionError):
+            return ""
+        finally:
+            self._metrics_requests.pop(request_id, None)
+    
+    async def stop(self):
+        self._stopping = True
+        if self._restart_task is not None and not self._restart_task.done():
+            self._restart_task.cancel()
+        
+        process = self.process
+        if process is not None and process.returncode is None:
+            try:
+                if self.writer is not None and not self.writer.is_closing():
+                    self.writer.write(encode_frame(("shutdown",)))
+                await asyncio.wait_for(process.wait(), Config.CLUSTER_WORKER_STOP_TIMEOUT)
+            except (asyncio.TimeoutError, ConnectionError):
+                self.logger.warning(f"集群工作进程 {self.index} 关闭超时，强制结束")
+                process.kill()
+        if self._reader_task is not None:
+            await asyncio.gather(self._reader_task, return_exceptions=True)
+    
+    def get_stats(self):
+        return {
+            "pid": self.pid,
+            "ready": self.ready,
+            "events_routed": self.events_routed,
+            "events_dropped": self.events_dropped,
+            "events_lost": self.events_lost,
+            "restarts_total": self.restarts_total
+        }
+
+class ClusterSupervisor:
+    """集群主控进程：监听事件端口，按会话一致性哈希把事件分给工作进程，汇总监控指标"""
+    def __init__(self, logger, worker_count=None):
+        self.logger = logger
+        self.worker_count = max(1, int(worker_count or Config.CLUSTER_WORKERS))
+        self.workers = [ClusterWorkerHandle(index, logger) for index in range(self.worker_count)]
+        self.ring = ConsistentHashRing(range(self.worker_count))
+        self.stop_event = asyncio.Event()
+        self.ws_transport = WebSocketEventTransport(logger, self.route_event)
+        
+        self.events_received = 0
+        self.events_broadcast = 0
+        self.events_unroutable = 0
+    
+    def route_event(self, event):
+        """返回 queued / rejected，与单进程模式的事件入口一致"""
+        self.events_received += 1
+        available = {worker.index for worker in self.workers if worker.ready}
+        
+        key = get_routing_key(event)
+        if key is None:
+            self.events_broadcast += 1
+            sent = [self.workers[index].send_event(event) for index in available]
+            return "queued" if any(sent) else "rejected"
+        
+        index = self.ring.get(key, available)
+        if index is None:
+            self.events_unroutable += 1
+            return "rejected"
+        return "queued" if self.workers[index].send_event(event) else "rejected"
+    
+    async def handle_event(self, request):
+        try:
+            data = await request.json()
+            if self.route_event(data) == "rejected":
+                return web.json_response({"error": "event queue full"}, status=503)
+            return web.json_response({})
+        except Exception as e:
+            self.logger.error(f"处理事件时出错: {str(e)}", exc_info=Config.ENABLE_DEBUG)
+            return web.json_response({"error": str(e)}, status=500)
+    
+    def render_metrics(self):
+        writer = PrometheusWriter()
+        writer.gauge("nebula_cluster_workers", "集群工作进程数", self.worker_count)
+        writer.gauge("nebula_cluster_workers_ready", "就绪的集群工作进程数", sum(1 for worker in self.workers if worker.ready))
+        writer.counter("nebula_cluster_events_received_total", "主控进程收到的事件数", self.events_received)
+        writer.counter("nebula_cluster_events_broadcast_total", "广播给所有工作进程的元事件数", self.events_broadcast)
+        writer.counter("nebula_cluster_events_unroutable_total", "没有可用工作进程而拒绝的事件数", self.events_unroutable)
+        for worker in self.workers:
+            labels = {"worker": worker.index}
+            writer.gauge("nebula_cluster_worker_up", "工作进程是否就绪", 1 if worker.ready else 0, labels)
+            writer.counter("nebula_cluster_events_routed_total", "转发给工作进程的事件数", worker.events_routed, labels)
+            writer.counter("nebula_cluster_events_dropped_total", "工作进程积压或不可用时丢弃的事件数", worker.events_dropped, labels)
+            writer.counter("nebula_cluster_events_lost_total", "已转发但被工作进程事件接收队列丢弃或拒绝的事件数", worker.events_lost, labels)
+            writer.counter("nebula_cluster_worker_restarts_total", "工作进程崩溃后重启次数", worker.restarts_total, labels)
+        return writer.render()
+    
+    async def handle_metrics(self, request):
+        texts = await asyncio.gather(*(worker.fetch_metrics(Config.CLUSTER_METRICS_TIMEOUT) for worker in self.workers))
+        sources = [({}, self.render_metrics())]
+        sources.extend(({"worker": worker.index}, text) for worker, text in zip(self.workers, texts) if text)
+        return web.Response(body=merge_prometheus_texts(sources).encode("utf-8"),
+                            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+    
+    def get_stats(self):
+        return {
+            "workers": {worker.index: worker.get_stats() for worker in self.workers},
+            "events_received": self.events_received,
+            "events_broadcast": self.events_broadcast,
+            "events_unroutable": self.events_unroutable
+        }
+    
+    async def run(self):
+        self.logger.info(f"集群模式: 启动 {self.worker_count} 个工作进程")
+        results = await asyncio.gather(*(worker.start() for worker in self.workers), return_exceptions=True)
+        for worker, result in zip(self.workers, results):
+            if isinstance(result, BaseException):
+                self.logger.error(f"集群工作进程 {worker.index} 启动失败: {str(result)}")
+            else:
+                self.logger.info(f"集群工作进程 {worker.index} 已就绪 (进程 {worker.pid})")
+        if not any(worker.ready for worker in self.workers):
+            self.logger.critical("没有可用的集群工作进程，启动中止")
+            await self.shutdown()
+            return
+        
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, self.stop_event.set)
+        
+        app = web.Application()
+        app.router.add_post('/onebot', self.handle_event)
+        if Config.ENABLE_METRICS_ENDPOINT:
+            app.router.add_get(Config.METRICS_PATH, self.handle_metrics)
+        if Config.ENABLE_REVERSE_WS:
+            app.router.add_get(Config.REVERSE_WS_PATH, self.ws_transport.reverse_ws_handler)
+        
+        forward_ws_task = None
+        if Config.ENABLE_FORWARD_WS:
+            forward_ws_task = asyncio.create_task(self.ws_transport.forward_ws_worker(self.stop_event))
+        
+        runner = web.AppRunner(app)
+        try:
+            await runner.setup()
+            site = web.TCPSite(runner, Config.EVENT_SERVER_HOST, Config.EVENT_SERVER_PORT)
+            await site.start()
+            self.logger.info(f"集群主控进程已启动: {Config.EVENT_SERVER_HOST}:{Config.EVENT_SERVER_PORT}")
+            await self.stop_event.wait()
+        except Exception as e:
+            self.logger.critical(f"集群主控进程启动失败: {str(e)}", exc_info=True)
+        finally:
+            self.stop_event.set()
+            if forward_ws_task is not None:
+                forward_ws_task.cancel()
+                await asyncio.gather(forward_ws_task, return_exceptions=True)
+            await self.ws_transport.close()
+            await runner.cleanup()
+            await self.shutdown()
+    
+    async def shutdown(self):
+        self.logger.info("正在关闭集群工作进程...")
+        await asyncio.gather(*(worker.stop() for worker in self.workers), return_exceptions=True)
+
+class ClusterWorkerChannel:
+    """工作进程一侧：从主控进程接收事件交给 BotApplication，按需回传监控指标"""
+    def __init__(self, index, fd):
+        self.index = index
+        self.fd = fd
+        self.writer = None
+        self._lost_reported = 0
+    
+    @classmethod
+    def from_environment(cls):
+        index = get_cluster_worker_index()
+        if index is None:
+            return None
+        # 事件端口与 WebSocket 连接都在主控进程，工作进程只通过 HTTP 调用 API
+        Config.ENABLE_REVERSE_WS = False
+        Config.ENABLE_FORWARD_WS = False
+        return cls(index, int(os.environ[CLUSTER_FD_ENV]))
+    
+    async def serve(self, app):
+        """处理主控进程发来的消息，主控进程要求关闭或通道断开时返回"""
+        reader, self.writer = await asyncio.open_connection(sock=socket.socket(fileno=self.fd))
+        self.writer.write(encode_frame(("ready", os.getpid())))
+        app.logger.info(f"集群工作进程 {self.index} 已就绪")
+        
+        try:
+            while not app.global_stop_event.is_set():
+                message = await read_frame(reader)
+                kind = message[0]
+                if kind == "event":
+                    app.dispatch_event(message[1])
+                    self._report_lost(app.event_queue)
+                elif kind == "metrics":
+                    self.writer.write(encode_frame(("metrics", message[1], app.render_metrics())))
+                elif kind == "shutdown":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            app.logger.warning(f"集群工作进程 {self.index} 与主控进程的连接已断开")
+        finally:
+            self.writer.close()
+    
+    def _report_lost(self, event_queue):
+        """主控进程转发时已应答上报方，接收队列丢弃或拒绝的事件只能事后回报给主控进程计数"""
+        lost = event_queue.dropped_total + event_queue.rejected_total
+        if lost > self._lost_reported:
+            self.writer.write(encode_frame(("lost", lost - self._lost_reported)))
+            self._lost_reported = lost
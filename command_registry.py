@@ -0,0 +1,298 @@
+import asyncio
+import re
+import threading
+from collections import deque
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+class CommandMatch:
+    """一次命令匹配结果，作为第二个参数传给命令处理函数"""
+    __slots__ = ("kind", "plugin_name", "pattern", "command", "args", "argv", "match", "keyword")
+    
+    def __init__(self, kind, plugin_name, pattern, command="", args="", match=None, keyword=None):
+        self.kind = kind
+        self.plugin_name = plugin_name
+        self.pattern = pattern
+        self.command = command
+        self.args = args
+        self.argv = args.split() if args else []
+        self.match = match
+        self.keyword = keyword
+    
+    def __repr__(self):
+        return f"CommandMatch(kind={self.kind!r}, plugin={self.plugin_name!r}, pattern={self.pattern!r}, args={self.args!r})"
+
+class CommandEntry:
+    __slots__ = ("kind", "plugin_name", "pattern", "handler", "regex")
+    
+    def __init__(self, kind, plugin_name, pattern, handler, regex=None):
+        self.kind = kind
+        self.plugin_name = plugin_name
+        self.pattern = pattern
+        self.handler = handler
+        self.regex = regex
+
+class _TrieNode:
+    __slots__ = ("children", "exact", "prefix")
+    
+    def __init__(self):
+        self.children = {}
+        self.exact = []
+        self.prefix = []
+
+class _KeywordAutomaton:
+    """Aho-Corasick 自动机，一次扫描找出消息中出现的所有关键词"""
+    def __init__(self, keyword_entries):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+        
+        for keyword, entries in keyword_entries.items():
+            state = 0
+            for char in keyword:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                    self.goto[state][char] = next_state
+                state = next_state
+            self.output[state].extend(entries)
+        
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                candidate = self.goto[fallback].get(char, 0)
+                self.fail[next_state] = candidate if candidate != next_state else 0
+                self.output[next_state] = self.output[next_state] + self.output[self.fail[next_state]]
+    
+    def search(self, text):
+        found = []
+        state = 0
+        goto = self.goto
+        fail = self.fail
+        output = self.output
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                found.extend(output[state])
+        return found
+
+class CommandRegistry:
+    """框架级命令注册表
+    
+    插件注册的精确命令/前缀编译为一棵字典树，关键词编译为 Aho-Corasick 自动机，
+    正则合并为一个预过滤表达式，每条消息只扫描一遍即可得到需要调用的插件。
+    """
+    KINDS = ("command", "prefix", "keyword", "regex")
+    INLINE_FLAGS = ((re.ASCII, "a"), (re.IGNORECASE, "i"), (re.MULTILINE, "m"), (re.DOTALL, "s"), (re.VERBOSE, "x"))
+    
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._entries: List[CommandEntry] = []
+        self._dirty = True
+        self._trie = _TrieNode()
+        self._automaton: Optional[_KeywordAutomaton] = None
+        self._regex_entries: List[CommandEntry] = []
+        self._regex_prefilter = None
+    
+    def register(self, plugin_name: str, kind: str, pattern: Any, handler: Callable, flags: int = 0) -> CommandEntry:
+        if kind not in self.KINDS:
+            raise ValueError(f"未知的命令类型: {kind}")
+        if not asyncio.iscoroutinefunction(handler):
+            raise TypeError(f"插件 {plugin_name} 的命令处理函数必须是异步函数: {pattern}")
+        
+        regex = None
+        if kind == "regex":
+            regex = pattern if isinstance(pattern, re.Pattern) else re.compile(pattern, flags)
+            pattern = regex.pattern
+        elif not isinstance(pattern, str) or not pattern.strip():
+            raise ValueError(f"插件 {plugin_name} 注册了空命令")
+        else:
+            pattern = pattern.strip()
+        
+        entry = CommandEntry(kind, plugin_name, pattern, handler, regex)
+        with self._lock:
+            self._entries.append(entry)
+            self._dirty = True
+        return entry
+    
+    def unregister(self, entry: CommandEntry):
+        with self._lock:
+            if entry in self._entries:
+                self._entries.remove(entry)
+                self._dirty = True
+    
+    def unregister_plugin(self, plugin_name: str) -> int:
+        with self._lock:
+            before = len(self._entries)
+            self._entries = [entry for entry in self._entries if entry.plugin_name != plugin_name]
+            removed = before - len(self._entries)
+            if removed:
+                self._dirty = True
+            return removed
+    
+    def get_plugin_entries(self, plugin_name: str) -> List[CommandEntry]:
+        with self._lock:
+            return [entry for entry in self._entries if entry.plugin_name == plugin_name]
+    
+    def has_commands(self) -> bool:
+        return bool(self._entries)
+    
+    def _build_regex_prefilter(self, regex_entries):
+        parts = []
+        for entry in regex_entries:
+            source = entry.regex.pattern
+            if isinstance(source, bytes) or re.search(r"\\\d|\(\?P=", source):
+                return None
+            source = re.sub(r"^\(\?[aiLmsux]+\)", "", source)
+            flag_letters = "".join(letter for flag, letter in self.INLINE_FLAGS if entry.regex.flags & flag)
+            parts.append(f"(?{flag_letters}:{source})" if flag_letters else f"(?:{source})")
+        
+        if not parts:
+            return None
+        
+        try:
+            return re.compile("|".join(parts))
+        except re.error:
+            return None
+    
+    def _compile(self):
+        trie = _TrieNode()
+        keyword_entries: Dict[str, List[CommandEntry]] = {}
+        regex_entries = []
+        
+        for entry in self._entries:
+            if entry.kind in ("command", "prefix"):
+                node = trie
+                for char in entry.pattern:
+                    child = node.children.get(char)
+                    if child is None:
+                        child = _TrieNode()
+                        node.children[char] = child
+                    node = child
+                if entry.kind == "command":
+                    node.exact.append(entry)
+                else:
+                    node.prefix.append(entry)
+            elif entry.kind == "keyword":
+                keyword_entries.setdefault(entry.pattern, []).append(entry)
+            else:
+                regex_entries.append(entry)
+        
+        self._trie = trie
+        self._automaton = _KeywordAutomaton(keyword_entries) if keyword_entries else None
+        self._regex_entries = regex_entries
+        self._regex_prefilter = self._build_regex_prefilter(regex_entries)
+        self._dirty = False
+    
+    def match(self, message: str) -> List[Tuple[CommandEntry, CommandMatch]]:
+        """匹配一条消息，返回 (命令条目, 匹配结果) 列表
+        
+        同一插件的精确命令命中时不再触发其前缀命令，多个前缀命中时只保留最长的一个。
+        """
+        if not self._entries or not isinstance(message, str):
+            return []
+        
+        with self._lock:
+            if self._dirty:
+                self._compile()
+            trie = self._trie
+            automaton = self._automaton
+            regex_entries = self._regex_entries
+            regex_prefilter = self._regex_prefilter
+        
+        text = message.strip()
+        if not text:
+            return []
+        
+        results = []
+        
+        exact_plugins = set()
+        longest_prefix = {}
+        node = trie
+        for position, char in enumerate(text):
+            node = node.children.get(char)
+            if node is None:
+                break
+            if node.prefix:
+                for entry in node.prefix:
+                    longest_prefix[entry.plugin_name] = (position + 1, [])
+                for entry in node.prefix:
+                    longest_prefix[entry.plugin_name][1].append(entry)
+        else:
+            for entry in node.exact:
+                exact_plugins.add(entry.plugin_name)
+                results.append((entry, CommandMatch("command", entry.plugin_name, entry.pattern, command=entry.pattern)))
+        
+        for plugin_name, (length, entries) in longest_prefix.items():
+            if plugin_name in exact_plugins:
+                continue
+            args = text[length:].strip()
+            for entry in entries:
+                results.append((entry, CommandMatch(
+                    "prefix", plugin_name, entry.pattern, command=entry.pattern, args=args
+                )))
+        
+        if automaton is not None:
+            seen = set()
+            for entry in automaton.search(text):
+                if id(entry) in seen:
+                    continue
+                seen.add(id(entry))
+                results.append((entry, CommandMatch(
+                    "keyword", entry.plugin_name, entry.pattern, args=text, keyword=entry.pattern
+                )))
+        
+        if regex_entries and (regex_prefilter is None or regex_prefilter.search(text)):
+            for entry in regex_entries:
+                regex_match = entry.regex.search(text)
+                if regex_match:
+                    results.append((entry, CommandMatch(
+                        "regex", entry.plugin_name, entry.pattern,
+                        command=regex_match.group(0), args=text[regex_match.end():].strip(), match=regex_match
+                    )))
+        
+        return results
+
+class PluginCommandRegistrar:
+    """插件命令注册器，通过 context.commands 访问"""
+    def __init__(self, plugin_name: str, registry: CommandRegistry):
+        self.plugin_name = plugin_name
+        self._registry = registry
+    
+    def register_command(self, command: str, handler: Callable) -> CommandEntry:
+        """注册精确命令，消息去掉首尾空白后与命令完全相同时触发"""
+        return self._registry.register(self.plugin_name, "command", command, handler)
+    
+    def register_prefix(self, prefix: str, handler: Callable) -> CommandEntry:
+        """注册前缀命令，前缀之后的内容作为参数 (match.args / match.argv)"""
+        return self._registry.register(self.plugin_name, "prefix", prefix, handler)
+    
+    def register_keyword(self, keyword: str, handler: Callable) -> CommandEntry:
+        """注册关键词，消息中包含关键词时触发"""
+        return self._registry.register(self.plugin_name, "keyword", keyword, handler)
+    
+    def register_regex(self, pattern, handler: Callable, flags: int = 0) -> CommandEntry:
+        """注册正则，re.search 命中时触发，match.match 为匹配对象"""
+        return self._registry.register(self.plugin_name, "regex", pattern, handler, flags)
+    
+    def unregister(self, entry: CommandEntry):
+        self._registry.unregister(entry)
+    
+    def clear(self) -> int:
+        """清空本插件注册的所有命令"""
+        return self._registry.unregister_plugin(self.plugin_name)
+    
+    def get_commands(self) -> List[Dict[str, Any]]:
+        return [
+            {"kind": entry.kind, "pattern": entry.pattern}
+            for entry in self._registry.get_plugin_entries(self.plugin_name)
+        ]
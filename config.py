@@ -65,6 +65,17 @@ class Config:
     EVENT_SERVER_HOST = "127.0.0.1"
     EVENT_SERVER_PORT = 8080   #端口/ip这些尽量别动
     
+    # WebSocket事件通道(与HTTP上报可同时开启)
+    ENABLE_REVERSE_WS = False   #反向WebSocket开关(NapCat主动连接框架)
+    REVERSE_WS_PATH = "/onebot/ws"   #反向WebSocket路径
+    ENABLE_FORWARD_WS = False   #正向WebSocket开关(框架主动连接NapCat)
+    FORWARD_WS_URL = "ws://localhost:3001"   #NapCat正向WebSocket地址
+    WS_HEARTBEAT_INTERVAL = 30   #WebSocket心跳间隔（秒）
+    WS_MAX_MSG_SIZE = 32 * 1024 * 1024   #单条WebSocket消息的最大字节数，超过时断开连接（大群成员列表的响应可达数MB）
+    WS_RECONNECT_INTERVAL = 3   #正向WebSocket初始重连间隔（秒）
+    WS_RECONNECT_MAX_INTERVAL = 60   #正向WebSocket最大重连间隔（秒）
+    API_USE_WEBSOCKET = True   #有可用WebSocket连接时API调用走WebSocket，连接断开时自动回退HTTP
+    
     PLUGINS_DIR = "plugins"
     
     LOG_LEVEL = "INFO"
@@ -72,6 +83,21 @@ class Config:
     LOG_FILE_MAX_DAYS = 1   #日志保留时间
     
     PLUGIN_EVENT_TIMEOUT = 120    #插件超时时间
+    PLUGIN_TIMEOUT_OVERRIDES = {}   #按插件单独设置超时时间，如 {"my_plugin": 30}；插件也可用类属性 EVENT_TIMEOUT 声明
+    PLUGIN_CONCURRENCY_LIMITS = {}   #按插件限制并发，如 {"my_plugin": {"max_concurrency": 2, "max_queue": 100, "policy": "coalesce"}}；插件也可用类属性 CONCURRENCY_LIMIT 声明
+    PLUGIN_DEFAULT_MAX_QUEUE = 1000   #设置了并发上限的插件默认等待队列长度
+    PLUGIN_DEFAULT_QUEUE_POLICY = "drop_oldest"   #等待队列满时的默认策略: drop / drop_oldest / coalesce
+    ENABLE_PLUGIN_CIRCUIT_BREAKER = True   #插件熔断开关，插件可用类属性 CIRCUIT_BREAKER = False 单独关闭
+    PLUGIN_BREAKER_FAILURE_THRESHOLD = 5   #统计窗口内出错或超时达到该次数后熔断
+    PLUGIN_BREAKER_WINDOW = 300   #失败次数统计窗口（秒）
+    PLUGIN_BREAKER_COOLDOWN = 60   #熔断后跳过该插件的冷却时间（秒）
+    PLUGIN_BREAKER_HALF_OPEN_TRIALS = 3   #冷却结束后放行的试探调用数，全部成功才恢复
+    ISOLATED_PLUGINS = []   #在独立子进程中运行的插件名，如 ["image_plugin"]，插件代码无需修改
+    ISOLATED_WORKER_START_TIMEOUT = 30   #隔离插件子进程启动并加载插件的超时时间（秒）
+    ISOLATED_WORKER_STOP_TIMEOUT = 3   #卸载或关闭时等待子进程退出的时间（秒），超时强制结束
+    ISOLATED_CANCEL_TIMEOUT = 2   #超时调用取消后子进程仍未结束该调用时，等待该时间（秒）后强制结束并重启子进程
+    ISOLATED_WORKER_RESTART_DELAY = 1   #子进程崩溃后首次重启等待（秒），连续崩溃时翻倍，最长60秒
+    ISOLATED_MAX_PENDING_BYTES = 8 * 1024 * 1024   #对端来不及读取的IPC积压上限（字节），超过后新的事件/命令调用和子进程的API调用直接失败
     
     
     BOT_QQ = 123456789   #机器人qq号
@@ -95,7 +121,84 @@ class Config:
     REQUEST_EXPIRE_TIME = 360
     REQUEST_WAIT_TIMEOUT = 5
     EVENT_DEDUPLICATION_WINDOW = 5  # 事件去重时间窗口（秒）
+    DEDUPLICATION_MODE = "exact"   #去重方式: exact(精确，内存随流量增长) / bloom(分段轮换布隆过滤器，内存固定，极少数新事件会被误判为重复)
+    DEDUP_BLOOM_MEMORY = 4 * 1024 * 1024   #bloom模式下事件去重过滤器的内存上限（字节）
+    DEDUP_BLOOM_FALSE_POSITIVE_RATE = 0.0001   #bloom模式的目标误判率
+    DEDUP_BLOOM_SLICES = 4   #bloom模式的时间分段数，分段越多过期越平滑
+    DEDUPLICATION_BACKEND = "memory"   #事件去重存储: memory(进程内) / sqlite(同一台机器上的多个进程共享) / redis(多台机器共享，兼容Redis协议的服务均可)
+    DEDUP_SQLITE_PATH = "dedup.sqlite3"   #sqlite存储文件路径，相对路径以框架目录为准
+    DEDUP_REDIS_URL = "redis://127.0.0.1:6379/0"   #redis存储地址，如 redis://:密码@127.0.0.1:6379/0
+    DEDUP_KEY_PREFIX = "nebula:dedup:"   #redis存储中键的前缀
+    DEDUP_STORE_TIMEOUT = 0.5   #共享存储单次操作超时（秒）
+    DEDUP_STORE_RETRY_INTERVAL = 5   #共享存储出错后改用进程内去重的时间（秒），之后再重试
+    DEDUP_STORE_CLEANUP_INTERVAL = 10   #sqlite存储批量删除过期键的间隔（秒）
+    
+    # API响应缓存配置(只缓存下表中的只读接口，发送消息等有副作用的接口永远不走缓存)
+    ENABLE_API_RESPONSE_CACHE = True   #响应缓存开关，调用时传 no_cache=True 可跳过缓存
+    API_CACHE_POLICIES = {   #接口: {"ttl": 缓存秒数, "max_size": 最多缓存条数(超出按最近最少使用淘汰)}
+        "/get_group_member_info": {"ttl": 600, "max_size": 4096},
+        "/get_group_member_list": {"ttl": 120, "max_size": 8},   #整份成员列表占内存大，只缓存少数几个群；查成员请优先用 context.members
+        "/get_group_info": {"ttl": 600, "max_size": 512},
+        "/get_group_list": {"ttl": 120, "max_size": 4},
+        "/get_friend_list": {"ttl": 120, "max_size": 4},
+        "/get_stranger_info": {"ttl": 300, "max_size": 2048},
+        "/get_login_info": {"ttl": 600, "max_size": 1}
+    }
+    ENABLE_MEMBER_STORE = True   #群成员列式存储开关，get_group_member_list 的结果会写入 context.members 供插件只读查询
+
+    # 事件接收队列配置
+    EVENT_QUEUE_MAX_SIZE = 5000   #事件队列最大长度，超出后按溢出策略处理
+    EVENT_QUEUE_WORKERS = 32   #并发处理事件的工作协程数
+    EVENT_QUEUE_OVERFLOW_POLICY = "drop_oldest"   #溢出策略: drop_oldest(丢弃最早) / priority(按事件类型优先级丢弃) / reject(返回503)
+    EVENT_QUEUE_PRIORITIES = {   #priority策略下各post_type的优先级，数值越小越先被丢弃
+        "message": 3,
+        "request": 2,
+        "notice": 1,
+        "meta_event": 0,
+        "default": 1
+    }
+
+    # 会话顺序处理配置
+    ENABLE_CONVERSATION_ORDERING = True   #同一群/私聊的事件按顺序处理，不同会话并行
+    MAX_ACTIVE_CONVERSATIONS = 256   #同时处理的会话数上限
+    MAX_PENDING_CONVERSATION_EVENTS = 0   #等待处理的事件总数上限，达到后对事件队列施加背压；0为事件队列长度的1/4，最大不超过事件队列长度
 
+    # HTTP连接池配置(BotAPI与插件共用)
+    HTTP_POOL_MAX_CONNECTIONS = 100   #连接总数上限
+    HTTP_POOL_LIMIT_PER_HOST = 32   #单个主机(如NapCat)的连接上限
+    HTTP_POOL_KEEPALIVE_TIMEOUT = 30   #空闲连接保持时间（秒），超时自动关闭
+    HTTP_POOL_PREWARM = 4   #启动时预先建立的NapCat连接数，0为不预热
+    
+    # 进程池配置(插件通过 context.run_in_process 或 @process_task 执行CPU密集计算)
+    PROCESS_POOL_MAX_WORKERS = 0   #工作进程数，0为CPU核心数
+    PROCESS_POOL_PLUGIN_QUOTA = 2   #单个插件同时占用的工作进程数上限，超出的任务排队
+    PROCESS_POOL_QUOTAS = {}   #按插件单独设置配额，如 {"image_plugin": 4}
+    PROCESS_POOL_START_METHOD = ""   #工作进程启动方式，留空使用系统默认(Linux为fork)
+    PROCESS_POOL_SHUTDOWN_TIMEOUT = 5   #关闭时等待工作进程退出的时间（秒），超时强制结束
+    
+    # 集群模式配置(主控进程监听事件端口，按群号/QQ号把会话固定分给工作进程，每个工作进程运行完整的框架)
+    CLUSTER_WORKERS = 0   #工作进程数，0为关闭集群模式(单进程运行)
+    CLUSTER_HASH_REPLICAS = 160   #一致性哈希每个工作进程的虚拟节点数
+    CLUSTER_MAX_PENDING_BYTES = 8 * 1024 * 1024   #单个工作进程未读取的事件积压上限（字节），超过后丢弃新事件
+    CLUSTER_WORKER_START_TIMEOUT = 60   #等待工作进程加载完插件并就绪的时间（秒）
+    CLUSTER_WORKER_STOP_TIMEOUT = 15   #关闭时等待工作进程退出的时间（秒），超时强制结束
+    CLUSTER_WORKER_RESTART_DELAY = 1   #工作进程崩溃后的初始重启间隔（秒），连续崩溃时翻倍，最长60秒
+    CLUSTER_METRICS_TIMEOUT = 2   #汇总监控指标时等待单个工作进程的时间（秒）
+    
+    # 监控指标配置
+    ENABLE_METRICS_ENDPOINT = True   #在事件服务器上提供 Prometheus 格式的 /metrics 接口
+    METRICS_PATH = "/metrics"   #监控指标路径
+    ENABLE_LOOP_WATCHDOG = True   #事件循环看门狗，插件阻塞事件循环时记录堆栈并告警
+    LOOP_LAG_SAMPLE_INTERVAL = 0.5   #事件循环延迟采样间隔（秒）
+    LOOP_LAG_WARN_THRESHOLD = 1.0   #事件循环阻塞超过该时间（秒）时抓取堆栈告警
+    LOOP_LAG_WARN_INTERVAL = 60   #同一来源的阻塞告警最短间隔（秒），期间只计数不打印
+    
+    # 插件耗时统计配置
+    PLUGIN_SLOW_THRESHOLD = 1.0   #插件单次处理超过该时间（秒）记为慢处理，写入 logs/slow_handler.log
+    PLUGIN_SLOW_LOG_SIZE = 200   #内存中保留的最近慢处理记录条数
+    ENABLE_ADMIN_ENDPOINT = True   #本机管理接口开关(只允许127.0.0.1访问)
+    ADMIN_PLUGINS_PATH = "/admin/plugins"   #插件耗时统计接口路径
+    
     # API请求超时配置
     API_REQUEST_TIMEOUT_NORMAL = 10  # 普通API请求超时时间（秒）
     API_REQUEST_TIMEOUT_LONG = 60    # 长操作API请求超时时间（秒）
@@ -110,7 +213,18 @@ class Config:
     # 插件超时取消配置(别瞎搞)
     PLUGIN_CANCEL_WAIT_TIMEOUT = 1.0  # 插件取消等待时间（秒）- 改为1秒
     PLUGIN_FORCE_RELOAD_TIMEOUT = 0.5  # 插件强制重载超时时间（秒）
+    PLUGIN_TIMEOUT_RESOLUTION = 0.5  # 插件超时时间轮精度（秒）
 
+    @staticmethod
+    def get_logs_dir():
+        """日志目录；集群工作进程（环境变量 NEBULA_CLUSTER_WORKER，见 cluster.py）各自使用 logs/worker<编号>，
+        不与其他进程追加同一个日志文件，日志清理也只处理自己的文件"""
+        logs_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs")
+        worker_index = os.environ.get("NEBULA_CLUSTER_WORKER")
+        if worker_index is not None:
+            logs_dir = os.path.join(logs_dir, f"worker{worker_index}")
+        return logs_dir
+    
     @staticmethod
     def get_log_filename():
         return "logs/bot_server.log"
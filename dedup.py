@@ -0,0 +1,437 @@
+import os
+import math
+import time
+import asyncio
+import sqlite3
+import logging
+from collections import deque
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from config import Config
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+class ExactKeyTracker:
+    """精确去重：保存窗口内的全部键，内存随流量增长"""
+    mode = "exact"
+    
+    def __init__(self, window):
+        self.window = window
+        self._keys = set()
+        self._expiry = deque()
+    
+    def _expire(self, now):
+        """键按到达顺序过期，只需从队头弹出"""
+        expiry = self._expiry
+        keys = self._keys
+        while expiry and expiry[0][0] <= now:
+            keys.discard(expiry.popleft()[1])
+    
+    def check_and_add(self, key, now=None):
+        """键已存在返回 True，否则记录并返回 False；键不可哈希时抛出 TypeError"""
+        now = time.monotonic() if now is None else now
+        self._expire(now)
+        if key in self._keys:
+            return True
+        self._keys.add(key)
+        self._expiry.append((now + self.window, key))
+        return False
+    
+    def __len__(self):
+        return len(self._keys)
+    
+    def get_stats(self):
+        return {"mode": self.mode, "entries": len(self._keys)}
+
+class _BloomSlice:
+    __slots__ = ("bits", "items", "bits_set", "created")
+    
+    def __init__(self, num_bytes, created):
+        self.bits = bytearray(num_bytes)
+        self.items = 0
+        self.bits_set = 0
+        self.created = created
+
+class RotatingBloomFilter:
+    """按时间分段轮换的布隆过滤器，内存固定为 memory_bytes
+    
+    时间窗口分成 slices-1 段，保留 slices 个分段，新键写入最新分段，查询时检查所有分段，
+    最旧的分段整体丢弃，因此任何键至少被记住 window 秒。某个分段写满设计容量时提前轮换，
+    流量过大时有效窗口缩短，误判率保持在 false_positive_rate 附近而不是随流量上升。
+    """
+    mode = "bloom"
+    
+    def __init__(self, memory_bytes, false_positive_rate, window, slices=4):
+        self.slice_count = max(2, int(slices))
+        self.window = window
+        self.slice_duration = window / (self.slice_count - 1)
+        self.slice_bytes = max(8, int(memory_bytes) // self.slice_count)
+        self.num_bits = self.slice_bytes * 8
+        self.false_positive_rate = false_positive_rate
+        # 查询要检查所有分段，单个分段的误判率按分段数分摊
+        slice_rate = min(max(false_positive_rate / self.slice_count, 1e-12), 0.5)
+        self.num_hashes = max(1, round(-math.log2(slice_rate)))
+        self.slice_capacity = max(1, int(self.num_bits * math.log(2) ** 2 / -math.log(slice_rate)))
+        self._slices = deque([_BloomSlice(self.slice_bytes, time.monotonic())])
+        
+        self.rotations_total = 0
+        self.early_rotations_total = 0
+    
+    def _positions(self, key):
+        """增强双重哈希：由一个64位哈希值派生 num_hashes 个位置"""
+        value = hash(key) & 0xFFFFFFFFFFFFFFFF
+        h1 = value & 0xFFFFFFFF
+        h2 = value >> 32
+        num_bits = self.num_bits
+        positions = []
+        for i in range(self.num_hashes):
+            positions.append(h1 % num_bits)
+            h1 += h2
+            h2 += i
+        return positions
+    
+    def _rotate(self, now):
+        slices = self._slices
+        newest = slices[-1]
+        if now - newest.created >= self.slice_duration * self.slice_count:
+            # 长时间没有新键，所有分段都已过期
+            slices.clear()
+            slices.append(_BloomSlice(self.slice_bytes, now))
+            self.rotations_total += 1
+            return
+        
+        while now - slices[-1].created >= self.slice_duration:
+            slices.append(_BloomSlice(self.slice_bytes, slices[-1].created + self.slice_duration))
+            self.rotations_total += 1
+        
+        if slices[-1].items >= self.slice_capacity:
+            slices.append(_BloomSlice(self.slice_bytes, now))
+            self.rotations_total += 1
+            self.early_rotations_total += 1
+        
+        while len(slices) > self.slice_count:
+            slices.popleft()
+    
+    def check_and_add(self, key, now=None):
+        """键（可能）已存在返回 True，否则写入最新分段并返回 False"""
+        now = time.monotonic() if now is None else now
+        self._rotate(now)
+        positions = self._positions(key)
+        
+        for bloom in self._slices:
+            bits = bloom.bits
+            for position in positions:
+                if not bits[position >> 3] & (1 << (position & 7)):
+                    break
+            else:
+                return True
+        
+        newest = self._slices[-1]
+        bits = newest.bits
+        for position in positions:
+            index = position >> 3
+            mask = 1 << (position & 7)
+            if not bits[index] & mask:
+                bits[index] |= mask
+                newest.bits_set += 1
+        newest.items += 1
+        return False
+    
+    def __len__(self):
+        return sum(bloom.items for bloom in self._slices)
+    
+    def fill_ratio(self):
+        """最新分段已置位的比例"""
+        return self._slices[-1].bits_set / self.num_bits
+    
+    def estimated_false_positive_rate(self):
+        """按各分段当前置位比例估算的误判率"""
+        miss = 1.0
+        for bloom in self._slices:
+            miss *= 1.0 - (bloom.bits_set / self.num_bits) ** self.num_hashes
+        return 1.0 - miss
+    
+    def get_stats(self):
+        return {
+            "mode": self.mode,
+            "entries": len(self),
+            "slices": len(self._slices),
+            "memory_bytes": self.slice_bytes * self.slice_count,
+            "num_hashes": self.num_hashes,
+            "slice_capacity": self.slice_capacity,
+            "fill_ratio": round(self.fill_ratio(), 6),
+            "estimated_fpr": self.estimated_false_positive_rate(),
+            "target_fpr": self.false_positive_rate,
+            "rotations_total": self.rotations_total,
+            "early_rotations_total": self.early_rotations_total
+        }
+
+def serialize_key(key):
+    """共享存储的键必须在不同进程中一致，标识元组按字段拼接，指纹直接使用"""
+    if isinstance(key, tuple):
+        return "|".join("" if value is None else str(value) for value in key)
+    return str(key)
+
+class SQLiteDedupStore:
+    """同一台机器上多个进程共享的去重存储（SQLite WAL 模式）
+    
+    一条 UPSERT 语句完成检查并写入：键不存在或已过期时写入并视为新事件，否则视为重复。
+    数据库操作在专用线程中执行，避免其他进程持有写锁时阻塞事件循环；过期键按间隔分批删除。
+    """
+    name = "sqlite"
+    CLEANUP_BATCH_SIZE = 1000
+    
+    def __init__(self, path, window, timeout, cleanup_interval, logger=None):
+        self.path = path if os.path.isabs(path) else os.path.join(BASE_DIR, path)
+        self.window = window
+        self.timeout = timeout
+        self.cleanup_interval = cleanup_interval
+        self.logger = logger or logging.getLogger("Dedup")
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="dedup-sqlite")
+        self._connection = None
+        self._last_cleanup = 0.0
+        
+        self.checks_total = 0
+        self.duplicates_total = 0
+        self.expired_total = 0
+    
+    def _connect(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS event_dedup (key TEXT PRIMARY KEY, expires_at REAL NOT NULL) WITHOUT ROWID"
+        )
+        connection.execute("CREATE INDEX IF NOT EXISTS event_dedup_expires ON event_dedup(expires_at)")
+        return connection
+    
+    def _check_and_add_sync(self, key, now):
+        if self._connection is None:
+            self._connection = self._connect()
+        cursor = self._connection.execute(
+            "INSERT INTO event_dedup(key, expires_at) VALUES(?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET expires_at = excluded.expires_at WHERE event_dedup.expires_at <= ?",
+            (key, now + self.window, now)
+        )
+        duplicate = cursor.rowcount == 0
+        
+        if now - self._last_cleanup >= self.cleanup_interval:
+            self._last_cleanup = now
+            self._cleanup_sync(now)
+        return duplicate
+    
+    def _cleanup_sync(self, now):
+        """分批删除过期键，每批一个短事务，避免长时间占用写锁"""
+        while True:
+            cursor = self._connection.execute(
+                "DELETE FROM event_dedup WHERE key IN "
+                "(SELECT key FROM event_dedup WHERE expires_at <= ? LIMIT ?)",
+                (now, self.CLEANUP_BATCH_SIZE)
+            )
+            self.expired_total += max(cursor.rowcount, 0)
+            if cursor.rowcount < self.CLEANUP_BATCH_SIZE:
+                return
+    
+    async def check_and_add(self, key):
+        """键在窗口内已存在返回 True，否则写入并返回 False"""
+        self.checks_total += 1
+        loop = asyncio.get_running_loop()
+        duplicate = await loop.run_in_executor(self._executor, self._check_and_add_sync, key, time.time())
+        if duplicate:
+            self.duplicates_total += 1
+        return duplicate
+    
+    def _close_sync(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+    
+    async def close(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._executor, self._close_sync)
+        self._executor.shutdown(wait=False)
+    
+    def get_stats(self):
+        return {
+            "backend": self.name,
+            "path": self.path,
+            "checks_total": self.checks_total,
+            "duplicates_total": self.duplicates_total,
+            "expired_total": self.expired_total
+        }
+
+class RedisProtocolError(Exception):
+    pass
+
+class RedisDedupStore:
+    """多台机器共享的去重存储，使用 Redis 协议(RESP)，只用到 SET NX PX、AUTH、SELECT 命令
+    
+    SET key 1 NX PX 窗口 由服务端原子完成检查并写入，过期由服务端按 TTL 处理。
+    同一条连接上的并发检查以流水线方式发送，按顺序读取响应。
+    """
+    name = "redis"
+    
+    def __init__(self, url, window, timeout, key_prefix="", logger=None):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.username = parsed.username
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.window_ms = max(1, int(window * 1000))
+        self.timeout = timeout
+        self.key_prefix = key_prefix
+        self.logger = logger or logging.getLogger("Dedup")
+        self._writer = None
+        self._handshake_writer = None
+        self._reader_task = None
+        self._pending = deque()
+        self._connect_lock = asyncio.Lock()
+        
+        self.checks_total = 0
+        self.duplicates_total = 0
+        self.reconnects_total = 0
+    
+    @staticmethod
+    def _encode(*args):
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode("utf-8")
+            parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        return b"".join(parts)
+    
+    async def _read_reply(self, reader):
+        line = await reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("连接已断开")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload.decode("utf-8")
+        if kind == b"-":
+            return RedisProtocolError(payload.decode("utf-8", "replace"))
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            length = int(payload)
+            if length < 0:
+                return None
+            data = await reader.readexactly(length + 2)
+            return data[:-2]
+        if kind == b"*":
+            length = int(payload)
+            if length < 0:
+                return None
+            return [await self._read_reply(reader) for _ in range(length)]
+        raise RedisProtocolError(f"无法解析的响应: {line[:32]!r}")
+    
+    async def _read_loop(self, reader, writer):
+        try:
+            while True:
+                reply = await self._read_reply(reader)
+                if self._pending:
+                    future = self._pending.popleft()
+                    if not future.done():
+                        future.set_result(reply)
+        except (asyncio.IncompleteReadError, ConnectionError, RedisProtocolError, ValueError) as e:
+            self._disconnect(writer, e)
+        except asyncio.CancelledError:
+            pass
+    
+    def _disconnect(self, writer, error=None):
+        """关闭连接并让等待中的请求失败；已被新连接替换的旧连接只关闭不影响新连接"""
+        if writer is None:
+            return
+        writer.close()
+        if writer is not self._writer and writer is not self._handshake_writer:
+            return
+        if writer is self._writer:
+            self._writer = None
+        while self._pending:
+            future = self._pending.popleft()
+            if not future.done():
+                future.set_exception(ConnectionError(str(error) if error else "连接已关闭"))
+    
+    async def _ensure_connected(self):
+        if self._writer is not None and not self._writer.is_closing():
+            return
+        async with self._connect_lock:
+            if self._writer is not None and not self._writer.is_closing():
+                return
+            if self._reader_task is not None:
+                self._reader_task.cancel()
+                self.reconnects_total += 1
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+            self._handshake_writer = writer
+            self._reader_task = asyncio.create_task(self._read_loop(reader, writer))
+            try:
+                if self.password:
+                    await self._send(writer, *(("AUTH", self.username, self.password) if self.username else ("AUTH", self.password)))
+                if self.db:
+                    await self._send(writer, "SELECT", self.db)
+            except BaseException as e:
+                self._disconnect(writer, e)
+                raise
+            finally:
+                self._handshake_writer = None
+            # AUTH/SELECT 完成后才公开连接，其他协程在此之前等待 _connect_lock，不会在未认证的连接上发送命令
+            self._writer = writer
+    
+    async def _send(self, writer, *args):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append(future)
+        writer.write(self._encode(*args))
+        try:
+            reply = await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            # 响应按顺序对应请求，超时后连接上的后续响应已无法对应，直接断开重连
+            self._disconnect(writer, TimeoutError("响应超时"))
+            raise
+        if isinstance(reply, RedisProtocolError):
+            raise reply
+        return reply
+    
+    async def check_and_add(self, key):
+        """键在窗口内已存在返回 True，否则写入并返回 False"""
+        self.checks_total += 1
+        await self._ensure_connected()
+        reply = await self._send(self._writer, "SET", self.key_prefix + key, "1", "NX", "PX", self.window_ms)
+        duplicate = reply is None
+        if duplicate:
+            self.duplicates_total += 1
+        return duplicate
+    
+    async def close(self):
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            await asyncio.gather(self._reader_task, return_exceptions=True)
+            self._reader_task = None
+        self._disconnect(self._writer)
+    
+    def get_stats(self):
+        return {
+            "backend": self.name,
+            "address": f"{self.host}:{self.port}/{self.db}",
+            "connected": self._writer is not None and not self._writer.is_closing(),
+            "checks_total": self.checks_total,
+            "duplicates_total": self.duplicates_total,
+            "reconnects_total": self.reconnects_total
+        }
+
+def create_shared_store(backend, window, logger=None):
+    """按配置创建跨进程共享的去重存储，memory 返回 None"""
+    if backend == "sqlite":
+        return SQLiteDedupStore(Config.DEDUP_SQLITE_PATH, window, Config.DEDUP_STORE_TIMEOUT,
+                                Config.DEDUP_STORE_CLEANUP_INTERVAL, logger)
+    if backend == "redis":
+        return RedisDedupStore(Config.DEDUP_REDIS_URL, window, Config.DEDUP_STORE_TIMEOUT,
+                               Config.DEDUP_KEY_PREFIX, logger)
+    return None
+
+def create_key_tracker(mode, window, memory_bytes, false_positive_rate, slices):
+    """按配置的去重方式创建键跟踪器"""
+    if mode == "bloom":
+        return RotatingBloomFilter(memory_bytes, false_positive_rate, window, slices)
+    return ExactKeyTracker(window)
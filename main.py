@@ -23,6 +23,7 @@ import subprocess
 import signal
 from shared_state import global_state, readonly_global_state, PluginStateAccessor
 from app import BotApplication
+from cluster import ClusterSupervisor, ClusterWorkerChannel, get_cluster_worker_index
 
 def check_system_platform():
     platform = sys.platform.lower()
@@ -85,7 +86,7 @@ if not token_valid:
 Config.validate_startup_duration()
 
 base_dir = os.path.dirname(os.path.abspath(__file__))
-logs_dir = os.path.join(base_dir, 'logs')
+logs_dir = Config.get_logs_dir()
 if not os.path.exists(logs_dir):
     os.makedirs(logs_dir)
 
@@ -255,9 +256,15 @@ async def main():
         else:
             logger.warning(f"未知运行环境: {platform_info}")
         
-        clean_old_logs_on_startup()
+        cluster_channel = ClusterWorkerChannel.from_environment()
+        if cluster_channel is None:
+            clean_old_logs_on_startup()
         
-        app = BotApplication(logger, api_logger)
+        if cluster_channel is None and Config.CLUSTER_WORKERS > 0:
+            await ClusterSupervisor(logger).run()
+            return
+        
+        app = BotApplication(logger, api_logger, cluster_channel=cluster_channel)
         
         await app.initialize()
         
@@ -267,12 +274,13 @@ async def main():
         logger.critical(f"应用程序启动失败: {str(e)}", exc_info=True)
         raise
     finally:
-        clean_old_logs_on_shutdown()
+        if get_cluster_worker_index() is None:
+            clean_old_logs_on_shutdown()
 
 if __name__ == "__main__":
     logger, api_logger = setup_logging()
     
-    if Config.DAEMON_MODE:
+    if Config.DAEMON_MODE and get_cluster_worker_index() is None:
         daemonize()
         logger.info("以守护进程模式启动")
     
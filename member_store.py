@@ -0,0 +1,257 @@
+import sys
+import time
+import threading
+from array import array
+from collections import namedtuple
+
+GroupMember = namedtuple("GroupMember", ["user_id", "role", "join_time", "last_sent_time", "card"])
+
+ROLE_CODES = {"member": 0, "admin": 1, "owner": 2}
+ROLE_NAMES = ("member", "admin", "owner")
+
+def _to_int(value, default=0):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+class GroupMemberTable:
+    """单个群的成员表，按列存储，user_id -> 行号索引"""
+    __slots__ = ("group_id", "user_ids", "roles", "join_times", "last_sent_times", "cards", "index", "loaded_at")
+    
+    def __init__(self, group_id):
+        self.group_id = group_id
+        self.user_ids = array("q")
+        self.roles = array("b")
+        self.join_times = array("q")
+        self.last_sent_times = array("q")
+        self.cards = []
+        self.index = {}
+        self.loaded_at = 0.0
+    
+    @classmethod
+    def from_member_list(cls, group_id, members):
+        table = cls(group_id)
+        for member in members:
+            if isinstance(member, dict):
+                table.upsert(member)
+        table.loaded_at = time.time()
+        return table
+    
+    def __len__(self):
+        return len(self.user_ids)
+    
+    def __contains__(self, user_id):
+        return _to_int(user_id) in self.index
+    
+    def upsert(self, member):
+        user_id = _to_int(member.get("user_id"))
+        if not user_id:
+            return
+        
+        role = ROLE_CODES.get(member.get("role"), 0)
+        card = sys.intern(member.get("card") or "")
+        join_time = _to_int(member.get("join_time"))
+        last_sent_time = _to_int(member.get("last_sent_time"))
+        
+        row = self.index.get(user_id)
+        if row is None:
+            self.index[user_id] = len(self.user_ids)
+            self.user_ids.append(user_id)
+            self.roles.append(role)
+            self.join_times.append(join_time)
+            self.last_sent_times.append(last_sent_time)
+            self.cards.append(card)
+        else:
+            self.roles[row] = role
+            self.cards[row] = card
+            if join_time:
+                self.join_times[row] = join_time
+            if last_sent_time:
+                self.last_sent_times[row] = last_sent_time
+    
+    def remove(self, user_id):
+        """删除成员，用最后一行填补空位保持各列紧凑"""
+        row = self.index.pop(_to_int(user_id), None)
+        if row is None:
+            return False
+        
+        last = len(self.user_ids) - 1
+        if row != last:
+            moved_user = self.user_ids[last]
+            self.user_ids[row] = moved_user
+            self.roles[row] = self.roles[last]
+            self.join_times[row] = self.join_times[last]
+            self.last_sent_times[row] = self.last_sent_times[last]
+            self.cards[row] = self.cards[last]
+            self.index[moved_user] = row
+        
+        self.user_ids.pop()
+        self.roles.pop()
+        self.join_times.pop()
+        self.last_sent_times.pop()
+        self.cards.pop()
+        return True
+    
+    def set_role(self, user_id, role):
+        row = self.index.get(_to_int(user_id))
+        if row is not None:
+            self.roles[row] = ROLE_CODES.get(role, 0)
+    
+    def set_card(self, user_id, card):
+        row = self.index.get(_to_int(user_id))
+        if row is not None:
+            self.cards[row] = sys.intern(card or "")
+    
+    def touch(self, user_id, timestamp, card=None, role=None):
+        row = self.index.get(_to_int(user_id))
+        if row is None:
+            return
+        self.last_sent_times[row] = timestamp
+        if card is not None and card != self.cards[row]:
+            self.cards[row] = sys.intern(card)
+        if role in ROLE_CODES:
+            self.roles[row] = ROLE_CODES[role]
+    
+    def get(self, user_id):
+        row = self.index.get(_to_int(user_id))
+        if row is None:
+            return None
+        return self._row(row)
+    
+    def _row(self, row):
+        return GroupMember(
+            self.user_ids[row],
+            ROLE_NAMES[self.roles[row]],
+            self.join_times[row],
+            self.last_sent_times[row],
+            self.cards[row]
+        )
+    
+    def iter_members(self):
+        row = 0
+        while row < len(self.user_ids):
+            yield self._row(row)
+            row += 1
+    
+    def memory_bytes(self):
+        size = (self.user_ids.itemsize * len(self.user_ids) + self.roles.itemsize * len(self.roles) +
+                self.join_times.itemsize * len(self.join_times) + self.last_sent_times.itemsize * len(self.last_sent_times))
+        return size + sys.getsizeof(self.cards) + sys.getsizeof(self.index)
+
+class GroupMemberStore:
+    """框架维护的群成员表，由 get_group_member_list 的结果填充，并随消息和通知增量更新"""
+    def __init__(self):
+        self._tables = {}
+        self._lock = threading.Lock()
+        self.stats = {"loads": 0, "notice_updates": 0}
+    
+    def load(self, group_id, members):
+        table = GroupMemberTable.from_member_list(_to_int(group_id), members)
+        with self._lock:
+            self._tables[table.group_id] = table
+            self.stats["loads"] += 1
+        return table
+    
+    def drop(self, group_id):
+        with self._lock:
+            return self._tables.pop(_to_int(group_id), None) is not None
+    
+    def clear(self):
+        with self._lock:
+            self._tables.clear()
+    
+    def get_table(self, group_id):
+        return self._tables.get(_to_int(group_id))
+    
+    def handle_message(self, event):
+        """群消息更新发言时间，顺带同步 sender 中的群名片和身份"""
+        table = self._tables.get(_to_int(event.get("group_id")))
+        if table is None:
+            return
+        sender = event.get("sender") or {}
+        table.touch(event.get("user_id"), _to_int(event.get("time"), int(time.time())),
+                    card=sender.get("card"), role=sender.get("role"))
+    
+    def handle_notice(self, event):
+        notice_type = event.get("notice_type")
+        group_id = _to_int(event.get("group_id"))
+        user_id = event.get("user_id")
+        
+        if notice_type == "group_decrease" and (user_id == event.get("self_id") or event.get("sub_type") == "kick_me"):
+            self.drop(group_id)
+            return
+        
+        table = self._tables.get(group_id)
+        if table is None:
+            return
+        
+        if notice_type == "group_increase":
+            if user_id in table:
+                return
+            table.upsert({"user_id": user_id, "join_time": event.get("time")})
+        elif notice_type == "group_decrease":
+            table.remove(user_id)
+        elif notice_type == "group_admin":
+            table.set_role(user_id, "admin" if event.get("sub_type") == "set" else "member")
+        elif notice_type == "group_card":
+            table.set_card(user_id, event.get("card_new", ""))
+        else:
+            return
+        
+        self.stats["notice_updates"] += 1
+    
+    def get_stats(self):
+        tables = list(self._tables.values())
+        return dict(
+            self.stats,
+            groups=len(tables),
+            members=sum(len(table) for table in tables),
+            memory_bytes=sum(table.memory_bytes() for table in tables)
+        )
+
+class ReadOnlyMemberStore:
+    """插件通过 context.members 访问的只读视图"""
+    __slots__ = ("_store",)
+    
+    def __init__(self, store):
+        self._store = store
+    
+    def is_loaded(self, group_id):
+        return self._store.get_table(group_id) is not None
+    
+    def get_member(self, group_id, user_id):
+        """返回 GroupMember(user_id, role, join_time, last_sent_time, card)，未知时返回 None"""
+        table = self._store.get_table(group_id)
+        return table.get(user_id) if table is not None else None
+    
+    def get_role(self, group_id, user_id):
+        member = self.get_member(group_id, user_id)
+        return member.role if member is not None else None
+    
+    def is_admin(self, group_id, user_id):
+        return self.get_role(group_id, user_id) in ("admin", "owner")
+    
+    def has_member(self, group_id, user_id):
+        table = self._store.get_table(group_id)
+        return table is not None and user_id in table
+    
+    def member_count(self, group_id):
+        table = self._store.get_table(group_id)
+        return len(table) if table is not None else 0
+    
+    def get_user_ids(self, group_id):
+        table = self._store.get_table(group_id)
+        return tuple(table.user_ids) if table is not None else ()
+    
+    def iter_members(self, group_id):
+        table = self._store.get_table(group_id)
+        if table is None:
+            return iter(())
+        return table.iter_members()
+    
+    def get_stats(self):
+        return self._store.get_stats()
+
+member_store = GroupMemberStore()
+readonly_member_store = ReadOnlyMemberStore(member_store)
@@ -0,0 +1,238 @@
+import time
+from array import array
+from bisect import bisect_left
+
+# 固定的延迟分桶上界（毫秒），最后一个桶收集超出上界的样本
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000, 120000)
+
+class LatencyHistogram:
+    """固定分桶的延迟直方图，内存占用与样本数无关"""
+    __slots__ = ("bounds", "counts", "count", "total", "max")
+    
+    def __init__(self, bounds=LATENCY_BUCKETS_MS):
+        self.bounds = bounds
+        self.counts = array("Q", [0] * (len(bounds) + 1))
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+    
+    def record(self, seconds):
+        ms = seconds * 1000.0
+        self.counts[bisect_left(self.bounds, ms)] += 1
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+    
+    def percentile(self, p):
+        """按桶内线性插值估算分位数（毫秒）"""
+        if self.count == 0:
+            return 0.0
+        
+        target = p * self.count
+        cumulative = 0
+        for i, bucket_count in enumerate(self.counts):
+            if bucket_count == 0:
+                continue
+            if cumulative + bucket_count >= target:
+                lower = self.bounds[i - 1] if i > 0 else 0.0
+                upper = self.bounds[i] if i < len(self.bounds) else self.max
+                fraction = (target - cumulative) / bucket_count
+                return round(min(lower + (upper - lower) * fraction, self.max), 3)
+            cumulative += bucket_count
+        return round(self.max, 3)
+    
+    def reset(self):
+        for i in range(len(self.counts)):
+            self.counts[i] = 0
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+    
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total / self.count, 3) if self.count else 0.0,
+            "max_ms": round(self.max, 3),
+            "p50_ms": self.percentile(0.50),
+            "p95_ms": self.percentile(0.95),
+            "p99_ms": self.percentile(0.99),
+            "buckets": {("+Inf" if i == len(self.bounds) else str(self.bounds[i])): c
+                        for i, c in enumerate(self.counts) if c}
+        }
+
+class EndpointMetrics:
+    __slots__ = ("calls", "requests", "failures", "failures_by_retcode", "retries",
+                 "coalesced", "cache_hits", "latency", "last_call_time")
+    
+    def __init__(self):
+        self.calls = 0
+        self.requests = 0
+        self.failures = 0
+        self.failures_by_retcode = {}
+        self.retries = 0
+        self.coalesced = 0
+        self.cache_hits = 0
+        self.latency = LatencyHistogram()
+        self.last_call_time = None
+    
+    def snapshot(self):
+        return {
+            "calls": self.calls,
+            "requests": self.requests,
+            "failures": self.failures,
+            "failures_by_retcode": dict(self.failures_by_retcode),
+            "retries": self.retries,
+            "coalesced": self.coalesced,
+            "cache_hits": self.cache_hits,
+            "latency": self.latency.snapshot(),
+            "last_call_time": self.last_call_time
+        }
+
+class ApiMetrics:
+    """BotAPI 按接口统计调用次数、失败返回码、重试、去重命中和延迟分布"""
+    def __init__(self):
+        self._endpoints = {}
+    
+    def _get(self, endpoint):
+        metrics = self._endpoints.get(endpoint)
+        if metrics is None:
+            metrics = self._endpoints[endpoint] = EndpointMetrics()
+        return metrics
+    
+    def record_cache_hit(self, endpoint):
+        metrics = self._get(endpoint)
+        metrics.calls += 1
+        metrics.cache_hits += 1
+        metrics.last_call_time = time.time()
+    
+    def record_coalesced(self, endpoint, result):
+        metrics = self._get(endpoint)
+        metrics.calls += 1
+        metrics.coalesced += 1
+        metrics.last_call_time = time.time()
+        self._record_failure(metrics, result)
+    
+    def record_retry(self, endpoint):
+        self._get(endpoint).retries += 1
+    
+    def record_request(self, endpoint, seconds, result):
+        metrics = self._get(endpoint)
+        metrics.calls += 1
+        metrics.requests += 1
+        metrics.latency.record(seconds)
+        metrics.last_call_time = time.time()
+        self._record_failure(metrics, result)
+    
+    @staticmethod
+    def _record_failure(metrics, result):
+        if isinstance(result, dict) and result.get("status") == "ok" and result.get("retcode") == 0:
+            return
+        retcode = str(result.get("retcode", "unknown")) if isinstance(result, dict) else "exception"
+        metrics.failures += 1
+        metrics.failures_by_retcode[retcode] = metrics.failures_by_retcode.get(retcode, 0) + 1
+    
+    def endpoints(self):
+        return list(self._endpoints.items())
+    
+    def snapshot(self):
+        return {endpoint: metrics.snapshot() for endpoint, metrics in self._endpoints.items()}
+
+class PluginMetrics:
+    """按插件统计调用次数、出错、超时和处理耗时"""
+    __slots__ = ("invocations", "errors", "timeouts", "slow_calls", "latency")
+    
+    def __init__(self):
+        self.invocations = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.slow_calls = 0
+        self.latency = LatencyHistogram()
+    
+    def snapshot(self):
+        return {
+            "invocations": self.invocations,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "slow_calls": self.slow_calls,
+            "latency": self.latency.snapshot()
+        }
+
+def _escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+class PrometheusWriter:
+    """生成 Prometheus 文本格式(0.0.4)的指标输出，同名指标的样本会归并输出"""
+    def __init__(self):
+        self._families = {}
+    
+    def _family(self, name, metric_type, help_text):
+        family = self._families.get(name)
+        if family is None:
+            family = self._families[name] = [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+        return family
+    
+    @staticmethod
+    def _labels(labels):
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{key}="{_escape_label(value)}"' for key, value in labels.items()) + "}"
+    
+    def counter(self, name, help_text, value, labels=None):
+        self._family(name, "counter", help_text).append(f"{name}{self._labels(labels)} {float(value or 0)}")
+    
+    def gauge(self, name, help_text, value, labels=None):
+        self._family(name, "gauge", help_text).append(f"{name}{self._labels(labels)} {float(value or 0)}")
+    
+    def histogram(self, name, help_text, histogram, labels=None):
+        """LatencyHistogram 以秒为单位输出累计分桶"""
+        family = self._family(name, "histogram", help_text)
+        labels = dict(labels or {})
+        cumulative = 0
+        for i, bound in enumerate(histogram.bounds):
+            cumulative += histogram.counts[i]
+            family.append(f"{name}_bucket{self._labels(dict(labels, le=bound / 1000.0))} {cumulative}")
+        family.append(f"{name}_bucket{self._labels(dict(labels, le='+Inf'))} {histogram.count}")
+        family.append(f"{name}_sum{self._labels(labels)} {histogram.total / 1000.0}")
+        family.append(f"{name}_count{self._labels(labels)} {histogram.count}")
+    
+    def render(self):
+        lines = []
+        for family in self._families.values():
+            lines.extend(family)
+        return "\n".join(lines) + "\n"
+
+def merge_prometheus_texts(sources):
+    """合并多份 Prometheus 文本：sources 为 [(附加标签, 文本)]，同名指标只保留一份 HELP/TYPE"""
+    families = {}
+    for extra_labels, text in sources:
+        injected = ",".join(f'{key}="{_escape_label(value)}"' for key, value in extra_labels.items())
+        family = None
+        for line in text.splitlines():
+            if not line:
+                continue
+            if line.startswith("#"):
+                parts = line.split(" ", 3)
+                if len(parts) >= 3 and parts[1] in ("HELP", "TYPE"):
+                    family = families.get(parts[2])
+                    if family is None:
+                        family = families[parts[2]] = {"meta": [], "samples": []}
+                    if len(family["meta"]) < 2 and line not in family["meta"]:
+                        family["meta"].append(line)
+                continue
+            if family is None:
+                family = families.setdefault("", {"meta": [], "samples": []})
+            if injected:
+                name, sep, rest = line.partition("{")
+                if sep:
+                    line = f"{name}{{{injected},{rest}" if not rest.startswith("}") else f"{name}{{{injected}{rest}"
+                else:
+                    name, _, value = line.partition(" ")
+                    line = f"{name}{{{injected}}} {value}"
+            family["samples"].append(line)
+    
+    lines = []
+    for family in families.values():
+        lines.extend(family["meta"])
+        lines.extend(family["samples"])
+    return "\n".join(lines) + "\n"
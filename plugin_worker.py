@@ -0,0 +1,517 @@
+"""
+隔离插件工作进程
+
+Config.ISOLATED_PLUGINS 中的插件不在主进程中导入，而是各自运行在一个子进程里：
+主进程用 IsolatedPluginHost 管理子进程，事件和命令通过 socketpair 上的长度前缀 + marshal 帧转发过去，
+插件在子进程中调用的 bot_api 异步接口会转发回主进程执行。子进程崩溃后自动重启；
+超时调用取消后子进程仍不结束时直接结束整个子进程。
+
+直接运行本文件即为子进程入口: python plugin_worker.py <插件名> <socket fd>
+"""
+
+import os
+import sys
+import time
+import signal
+import socket
+import struct
+import marshal
+import asyncio
+import inspect
+import logging
+import functools
+import importlib
+import itertools
+import traceback
+from config import Config
+from api import bot_api
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 帧格式: 4 字节大端长度 + marshal 序列化的元组
+_HEADER = struct.Struct("!I")
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+# 子进程加载插件后回传给主进程的类属性，主进程据此建立订阅索引、超时、并发与熔断设置
+FORWARDED_ATTRIBUTES = ("EVENT_SUBSCRIPTIONS", "EVENT_TIMEOUT", "CONCURRENCY_LIMIT", "CIRCUIT_BREAKER")
+
+class IsolatedPluginError(Exception):
+    pass
+
+def encode_frame(message):
+    payload = marshal.dumps(message)
+    return _HEADER.pack(len(payload)) + payload
+
+async def read_frame(reader):
+    (length,) = _HEADER.unpack(await reader.readexactly(_HEADER.size))
+    if length > MAX_FRAME_SIZE:
+        raise IsolatedPluginError(f"IPC 消息过大: {length} 字节")
+    return marshal.loads(await reader.readexactly(length))
+
+class IsolatedPluginHost:
+    """主进程一侧：管理一个隔离插件的子进程，转发事件与命令，并代理子进程的 bot_api 调用"""
+    def __init__(self, plugin_name, logger, command_registry):
+        self.plugin_name = plugin_name
+        self.logger = logger
+        self.command_registry = command_registry
+        self.process = None
+        self.writer = None
+        self.ready = False
+        self.attributes = {}
+        self._ready_future = None
+        self._reader_task = None
+        self._restart_task = None
+        self._stopping = False
+        self._calls = {}
+        self._cancelling = {}
+        self._call_ids = itertools.count(1)
+        self._api_tasks = set()
+        self._consecutive_crashes = 0
+        self.started_at = None
+        
+        self.calls_total = 0
+        self.api_calls_total = 0
+        self.crashes_total = 0
+        self.restarts_total = 0
+        self.killed_total = 0
+        self.rejected_total = 0
+    
+    @property
+    def pid(self):
+        return self.process.pid if self.process is not None else None
+    
+    async def start(self):
+        parent_sock, child_sock = socket.socketpair()
+        try:
+            self.process = await asyncio.create_subprocess_exec(
+                sys.executable, os.path.abspath(__file__), self.plugin_name, str(child_sock.fileno()),
+                pass_fds=(child_sock.fileno(),), cwd=BASE_DIR
+            )
+        except BaseException:
+            parent_sock.close()
+            raise
+        finally:
+            child_sock.close()
+        
+        reader, self.writer = await asyncio.open_connection(sock=parent_sock)
+        self._ready_future = asyncio.get_running_loop().create_future()
+        self._reader_task = asyncio.create_task(self._read_loop(reader, self.process))
+        
+        try:
+            self.attributes = await asyncio.wait_for(asyncio.shield(self._ready_future), Config.ISOLATED_WORKER_START_TIMEOUT)
+        except asyncio.TimeoutError:
+            self._kill()
+            raise IsolatedPluginError(f"工作进程 {Config.ISOLATED_WORKER_START_TIMEOUT} 秒内未就绪")
+        except BaseException:
+            self._kill()
+            raise
+        
+        self.started_at = time.time()
+        return self.attributes
+    
+    def _write(self, frame):
+        if self.writer is None or self.writer.is_closing():
+            raise IsolatedPluginError(f"隔离插件 {self.plugin_name} 的工作进程连接已断开")
+        self.writer.write(frame)
+    
+    def _send(self, message):
+        self._write(encode_frame(message))
+    
+    def _kill(self):
+        if self.process is not None and self.process.returncode is None:
+            self.process.kill()
+    
+    async def _read_loop(self, reader, process):
+        try:
+            while True:
+                self._handle_message(await read_frame(reader))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            self.logger.error(f"隔离插件 {self.plugin_name} 的IPC通道出错: {str(e)}")
+        finally:
+            await self._on_worker_exit(process)
+    
+    def _handle_message(self, message):
+        kind = message[0]
+        if kind == "done":
+            _, call_id, error = message
+            handle = self._cancelling.pop(call_id, None)
+            if handle is not None:
+                handle.cancel()
+            future = self._calls.pop(call_id, None)
+            if future is not None and not future.done():
+                future.set_result(error)
+        elif kind == "api":
+            task = asyncio.create_task(self._proxy_api(*message[1:]))
+            self._api_tasks.add(task)
+            task.add_done_callback(self._api_tasks.discard)
+        elif kind == "commands":
+            self._sync_commands(message[1])
+        elif kind == "ready":
+            self.ready = True
+            self._sync_commands(message[2])
+            if not self._ready_future.done():
+                self._ready_future.set_result(message[1])
+        elif kind == "error":
+            if not self._ready_future.done():
+                self._ready_future.set_exception(IsolatedPluginError(message[1]))
+    
+    def _sync_commands(self, commands):
+        """子进程中注册的命令在主进程命令表中登记为转发函数，命令匹配仍在主进程完成"""
+        self.command_registry.unregister_plugin(self.plugin_name)
+        for entry_id, kind, pattern, flags in commands:
+            try:
+                self.command_registry.register(self.plugin_name, kind, pattern,
+                                               functools.partial(self.run_command, entry_id), flags)
+            except Exception as e:
+                self.logger.warning(f"隔离插件 {self.plugin_name} 的命令 {pattern} 登记失败: {str(e)}")
+    
+    async def _proxy_api(self, request_id, name, args, kwargs):
+        self.api_calls_total += 1
+        method = None if name.startswith("_") else getattr(bot_api, name, None)
+        if not inspect.iscoroutinefunction(method):
+            frame = encode_frame(("api_result", request_id, False, f"bot_api 没有异步方法 {name}"))
+        else:
+            try:
+                # 返回值无法序列化时也按调用失败回复
+                frame = encode_frame(("api_result", request_id, True, await method(*args, **kwargs)))
+            except Exception as e:
+                frame = encode_frame(("api_result", request_id, False, f"{type(e).__name__}: {str(e)}"))
+        try:
+            self._write(frame)
+        except IsolatedPluginError:
+            pass
+    
+    async def call(self, message_type, *payload):
+        """转发一次调用并等待子进程处理完毕；被取消时通知子进程取消，宽限期后仍未结束则结束子进程"""
+        if not self.ready:
+            raise IsolatedPluginError(f"隔离插件 {self.plugin_name} 的工作进程未就绪")
+        if self.writer.transport.get_write_buffer_size() > Config.ISOLATED_MAX_PENDING_BYTES:
+            self.rejected_total += 1
+            raise IsolatedPluginError(f"隔离插件 {self.plugin_name} 的工作进程来不及读取，IPC积压超过 {Config.ISOLATED_MAX_PENDING_BYTES} 字节")
+        
+        call_id = next(self._call_ids)
+        future = asyncio.get_running_loop().create_future()
+        self._calls[call_id] = future
+        self.calls_total += 1
+        try:
+            self._send((message_type, call_id) + payload)
+            error = await future
+        except asyncio.CancelledError:
+            if self._calls.pop(call_id, None) is not None and self.ready:
+                try:
+                    self._send(("cancel", call_id))
+                    self._cancelling[call_id] = asyncio.get_running_loop().call_later(
+                        Config.ISOLATED_CANCEL_TIMEOUT, self._on_cancel_timeout, call_id)
+                except IsolatedPluginError:
+                    pass
+            raise
+        finally:
+            self._calls.pop(call_id, None)
+        
+        if error is not None:
+            raise IsolatedPluginError(error)
+    
+    async def run_command(self, entry_id, event, command_match):
+        await self.call("command", entry_id, event, (command_match.command, command_match.args, command_match.keyword))
+    
+    def _on_cancel_timeout(self, call_id):
+        self._cancelling.pop(call_id, None)
+        if self.process is None or self.process.returncode is not None:
+            return
+        self.killed_total += 1
+        self.logger.error(f"隔离插件 {self.plugin_name} 的工作进程 {Config.ISOLATED_CANCEL_TIMEOUT} 秒内未终止超时调用，强制结束进程")
+        self._kill()
+    
+    async def _on_worker_exit(self, process):
+        self.ready = False
+        try:
+            # 连接先于进程退出断开，给子进程一点时间正常退出
+            returncode = await asyncio.wait_for(process.wait(), Config.ISOLATED_WORKER_STOP_TIMEOUT)
+        except asyncio.TimeoutError:
+            process.kill()
+            returncode = await process.wait()
+        
+        if self.writer is not None:
+            self.writer.close()
+        for handle in self._cancelling.values():
+            handle.cancel()
+        self._cancelling.clear()
+        for future in self._calls.values():
+            if not future.done():
+                future.set_exception(IsolatedPluginError(f"工作进程已退出(返回码 {returncode})"))
+        self._calls.clear()
+        if self._ready_future is not None and not self._ready_future.done():
+            self._ready_future.set_exception(IsolatedPluginError(f"工作进程启动失败(返回码 {returncode})"))
+        
+        if self._stopping or self.started_at is None:
+            return
+        
+        self.crashes_total += 1
+        if self.started_at and time.time() - self.started_at > 60:
+            self._consecutive_crashes = 0
+        delay = min(Config.ISOLATED_WORKER_RESTART_DELAY * 2 ** self._consecutive_crashes, 60)
+        self._consecutive_crashes += 1
+        self.logger.error(f"隔离插件 {self.plugin_name} 的工作进程意外退出(返回码 {returncode})，{delay} 秒后重启")
+        self._restart_task = asyncio.create_task(self._restart_after(delay))
+    
+    async def _restart_after(self, delay):
+        await asyncio.sleep(delay)
+        try:
+            await self.start()
+        except Exception as e:
+            # 启动失败时子进程退出会再次触发重启
+            self.logger.error(f"隔离插件 {self.plugin_name} 的工作进程重启失败: {str(e)}")
+            return
+        self.restarts_total += 1
+        self.logger.info(f"隔离插件 {self.plugin_name} 的工作进程已重启 (进程 {self.pid})")
+    
+    async def stop(self):
+        self._stopping = True
+        if self._restart_task is not None and not self._restart_task.done():
+            self._restart_task.cancel()
+        
+        process = self.process
+        if process is not None and process.returncode is None:
+            try:
+                self._send(("shutdown",))
+                await asyncio.wait_for(process.wait(), Config.ISOLATED_WORKER_STOP_TIMEOUT)
+            except (IsolatedPluginError, asyncio.TimeoutError):
+                process.kill()
+        
+        tasks = [task for task in (self._reader_task, *self._api_tasks) if task is not None]
+        for task in self._api_tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    
+    def get_stats(self):
+        return {
+            "pid": self.pid,
+            "ready": self.ready,
+            "uptime_seconds": round(time.time() - self.started_at, 1) if self.ready and self.started_at else 0,
+            "in_flight": len(self._calls),
+            "cancelling": len(self._cancelling),
+            "calls_total": self.calls_total,
+            "api_calls_total": self.api_calls_total,
+            "crashes_total": self.crashes_total,
+            "restarts_total": self.restarts_total,
+            "killed_total": self.killed_total,
+            "rejected_total": self.rejected_total
+        }
+
+class IsolatedPlugin:
+    """隔离插件在主进程中的替身，事件转发给子进程处理"""
+    def __init__(self, host):
+        self.host = host
+    
+    async def handle_event_async(self, event):
+        await self.host.call("event", event)
+
+def create_isolated_plugin(host):
+    """按子进程回传的类属性生成替身实例，类的 __module__ 即插件名"""
+    namespace = {name: value for name, value in host.attributes.items() if name in FORWARDED_ATTRIBUTES}
+    namespace["__module__"] = host.plugin_name
+    return type("Plugin", (IsolatedPlugin,), namespace)(host)
+
+class _BotApiProxy:
+    """子进程中替换 api.bot_api，异步接口调用转发到主进程执行"""
+    def __init__(self, worker, api_class):
+        self._worker = worker
+        self._api_class = api_class
+    
+    def __getattr__(self, name):
+        if name.startswith("_") or not inspect.iscoroutinefunction(getattr(self._api_class, name, None)):
+            raise AttributeError(f"隔离插件中不能使用 bot_api.{name}")
+        
+        async def proxy(*args, **kwargs):
+            return await self._worker.request_api(name, args, kwargs)
+        
+        proxy.__name__ = name
+        setattr(self, name, proxy)
+        return proxy
+
+class PluginWorker:
+    """子进程一侧：加载插件，执行主进程转发来的事件和命令"""
+    def __init__(self, plugin_name, fd):
+        self.plugin_name = plugin_name
+        self.fd = fd
+        self.writer = None
+        self.plugin = None
+        self.context = None
+        self.registry = None
+        self.connection_pool = None
+        self._tasks = {}
+        self._api_calls = {}
+        self._api_ids = itertools.count(1)
+        self._commands_dirty = False
+    
+    def _send(self, message):
+        if self.writer is not None and not self.writer.is_closing():
+            self.writer.write(encode_frame(message))
+    
+    def _load_plugin(self):
+        import api
+        from server_manager import PluginContext, ConnectionPool
+        from shared_state import global_state, readonly_global_state, PluginStateAccessor
+        from command_registry import CommandRegistry, PluginCommandRegistrar
+        from process_pool import process_pool
+        
+        worker = self
+        
+        class WorkerCommandRegistry(CommandRegistry):
+            def register(self, *args, **kwargs):
+                entry = super().register(*args, **kwargs)
+                worker._on_commands_changed()
+                return entry
+            
+            def unregister(self, entry):
+                super().unregister(entry)
+                worker._on_commands_changed()
+            
+            def unregister_plugin(self, plugin_name):
+                removed = super().unregister_plugin(plugin_name)
+                worker._on_commands_changed()
+                return removed
+        
+        api.bot_api = _BotApiProxy(self, api.BotAPI)
+        sys.path.insert(0, os.path.join(BASE_DIR, Config.PLUGINS_DIR))
+        module = importlib.import_module(self.plugin_name)
+        
+        plugin_class = getattr(module, "Plugin", None)
+        if plugin_class is None:
+            raise IsolatedPluginError(f"插件 {self.plugin_name} 没有 Plugin 类")
+        if not inspect.iscoroutinefunction(getattr(plugin_class, "handle_event_async", None)):
+            raise IsolatedPluginError(f"插件 {self.plugin_name} 的 'handle_event_async' 方法不是异步函数")
+        
+        self.registry = WorkerCommandRegistry()
+        self.connection_pool = ConnectionPool()
+        self.context = PluginContext(self.plugin_name, readonly_global_state,
+                                     PluginStateAccessor(self.plugin_name, global_state),
+                                     command_registrar=PluginCommandRegistrar(self.plugin_name, self.registry),
+                                     connection_pool=self.connection_pool, process_pool=process_pool)
+        self.plugin = plugin_class(self.context)
+        
+        attributes = {}
+        for name in FORWARDED_ATTRIBUTES:
+            if not hasattr(self.plugin, name):
+                continue
+            value = getattr(self.plugin, name)
+            try:
+                marshal.dumps(value)
+            except ValueError:
+                self.context.logger.warning(f"类属性 {name} 无法传回主进程，已忽略")
+                continue
+            attributes[name] = value
+        return attributes
+    
+    def _command_list(self):
+        entries = self.registry.get_plugin_entries(self.plugin_name) if self.registry is not None else []
+        return [(id(entry), entry.kind, entry.pattern, entry.regex.flags if entry.regex is not None else 0)
+                for entry in entries]
+    
+    def _on_commands_changed(self):
+        """运行期间增删命令时合并到下一轮事件循环同步给主进程（初始化时注册的命令随 ready 一起发送）"""
+        if self.plugin is None or self._commands_dirty:
+            return
+        self._commands_dirty = True
+        
+        def flush():
+            self._commands_dirty = False
+            self._send(("commands", self._command_list()))
+        
+        asyncio.get_running_loop().call_soon(flush)
+    
+    async def request_api(self, name, args, kwargs):
+        if self.writer is not None and self.writer.transport.get_write_buffer_size() > Config.ISOLATED_MAX_PENDING_BYTES:
+            raise IsolatedPluginError(f"主进程来不及读取，IPC积压超过 {Config.ISOLATED_MAX_PENDING_BYTES} 字节")
+        request_id = next(self._api_ids)
+        future = asyncio.get_running_loop().create_future()
+        self._api_calls[request_id] = future
+        try:
+            self._send(("api", request_id, name, args, kwargs))
+            ok, result = await future
+        finally:
+            self._api_calls.pop(request_id, None)
+        if not ok:
+            raise RuntimeError(result)
+        return result
+    
+    async def _run(self, call_id, handler, args):
+        error = None
+        try:
+            await handler(*args)
+        except asyncio.CancelledError:
+            error = "已取消"
+        except Exception as e:
+            error = traceback.format_exc() if Config.ENABLE_DEBUG else str(e)
+        finally:
+            self._tasks.pop(call_id, None)
+            self._send(("done", call_id, error))
+    
+    def _find_command(self, entry_id):
+        for entry in self.registry.get_plugin_entries(self.plugin_name):
+            if id(entry) == entry_id:
+                return entry
+        return None
+    
+    def _handle_message(self, message):
+        from command_registry import CommandMatch
+        
+        kind = message[0]
+        if kind == "event":
+            _, call_id, event = message
+            self._tasks[call_id] = asyncio.create_task(self._run(call_id, self.plugin.handle_event_async, (event,)))
+        elif kind == "command":
+            _, call_id, entry_id, event, (command, args, keyword) = message
+            entry = self._find_command(entry_id)
+            if entry is None:
+                self._send(("done", call_id, "命令已注销"))
+                return True
+            match = entry.regex.search(event.get("raw_message", "")) if entry.regex is not None else None
+            command_match = CommandMatch(entry.kind, self.plugin_name, entry.pattern, command, args, match, keyword)
+            self._tasks[call_id] = asyncio.create_task(self._run(call_id, entry.handler, (event, command_match)))
+        elif kind == "cancel":
+            task = self._tasks.get(message[1])
+            if task is not None:
+                task.cancel()
+        elif kind == "api_result":
+            _, request_id, ok, result = message
+            future = self._api_calls.get(request_id)
+            if future is not None and not future.done():
+                future.set_result((ok, result))
+        elif kind == "shutdown":
+            return False
+        return True
+    
+    async def run(self):
+        sock = socket.socket(fileno=self.fd)
+        reader, self.writer = await asyncio.open_connection(sock=sock)
+        
+        try:
+            attributes = self._load_plugin()
+        except Exception as e:
+            self._send(("error", f"{type(e).__name__}: {str(e)}"))
+            await self.writer.drain()
+            self.writer.close()
+            return
+        
+        self._send(("ready", attributes, self._command_list()))
+        try:
+            while self._handle_message(await read_frame(reader)):
+                pass
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            await self.context.cleanup()
+            await self.connection_pool.close()
+            self.writer.close()
+
+def main():
+    # 终端的 Ctrl+C 由主进程处理，主进程退出后子进程读到 EOF 自行退出
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(level=Config.LOG_LEVEL, format=Config.LOG_FORMAT)
+    asyncio.run(PluginWorker(sys.argv[1], int(sys.argv[2])).run())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+import os
+import sys
+import time
+import signal
+import asyncio
+import logging
+import importlib
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from config import Config
+
+def _worker_init():
+    """工作进程不接收终端信号，由主进程统一关闭"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    try:
+        signal.set_wakeup_fd(-1)
+    except (ValueError, OSError):
+        pass
+
+def _run_process_task(module_name, qualname, args, kwargs):
+    """在工作进程中按模块名和限定名找回被 process_task 装饰的原函数并执行"""
+    target = sys.modules.get(module_name) or importlib.import_module(module_name)
+    for attr in qualname.split("."):
+        target = getattr(target, attr)
+    return target.func(*args, **kwargs)
+
+def _shutdown_executor(executor, wait):
+    """关闭进程池并取消还没开始的任务；Python 3.9 之前 shutdown 不支持 cancel_futures，由这里逐个取消"""
+    if sys.version_info >= (3, 9):
+        executor.shutdown(wait=wait, cancel_futures=True)
+        return
+    for work_item in list((getattr(executor, "_pending_work_items", None) or {}).values()):
+        work_item.future.cancel()
+    executor.shutdown(wait=wait)
+
+class _PluginQuota:
+    __slots__ = ("limit", "semaphore", "running", "waiting", "submitted", "completed", "failed", "busy_seconds")
+    
+    def __init__(self, limit):
+        self.limit = limit
+        self.semaphore = asyncio.Semaphore(limit)
+        self.running = 0
+        self.waiting = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.busy_seconds = 0.0
+    
+    def get_stats(self):
+        return {
+            "limit": self.limit,
+            "running": self.running,
+            "waiting": self.waiting,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "busy_seconds": round(self.busy_seconds, 3)
+        }
+
+class ProcessPoolManager:
+    """插件共用的进程池，用于图片处理、统计、加解密等会阻塞事件循环的计算
+    
+    首次提交时才创建工作进程；每个插件同时占用的工作进程数受配额限制，超出的提交排队等待。
+    工作进程异常退出导致进程池损坏时自动重建；提交过任务的插件重载后回收旧进程，避免执行旧版本代码。
+    """
+    def __init__(self, logger=None, max_workers=None):
+        self.logger = logger or logging.getLogger("ProcessPool")
+        self.max_workers = max_workers or Config.PROCESS_POOL_MAX_WORKERS or os.cpu_count() or 1
+        self._executor = None
+        self._quotas = {}
+        self._closed = False
+        
+        self.restarts_total = 0
+        self.recycles_total = 0
+    
+    def _get_executor(self):
+        if self._closed:
+            raise RuntimeError("进程池已关闭")
+        if self._executor is None:
+            start_method = Config.PROCESS_POOL_START_METHOD
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context(start_method) if start_method else None,
+                initializer=_worker_init
+            )
+        return self._executor
+    
+    def _get_quota(self, plugin_name):
+        quota = self._quotas.get(plugin_name)
+        if quota is None:
+            limit = Config.PROCESS_POOL_QUOTAS.get(plugin_name, Config.PROCESS_POOL_PLUGIN_QUOTA)
+            quota = self._quotas[plugin_name] = _PluginQuota(max(1, min(int(limit), self.max_workers)))
+        return quota
+    
+    async def run(self, plugin_name, func, *args, **kwargs):
+        """在工作进程中执行 func(*args, **kwargs)；func 与参数、返回值都必须可以被 pickle"""
+        quota = self._get_quota(plugin_name)
+        quota.submitted += 1
+        quota.waiting += 1
+        try:
+            await quota.semaphore.acquire()
+        finally:
+            quota.waiting -= 1
+        
+        quota.running += 1
+        start_time = time.perf_counter()
+        executor = None
+        try:
+            executor = self._get_executor()
+            call = functools.partial(func, *args, **kwargs) if kwargs else func
+            result = await asyncio.get_running_loop().run_in_executor(executor, call, *(() if kwargs else args))
+            quota.completed += 1
+            return result
+        except BrokenProcessPool:
+            quota.failed += 1
+            self._restart(executor, plugin_name)
+            raise
+        except Exception:
+            quota.failed += 1
+            raise
+        finally:
+            quota.busy_seconds += time.perf_counter() - start_time
+            quota.running -= 1
+            quota.semaphore.release()
+    
+    def _restart(self, broken, plugin_name):
+        """同一个损坏的进程池只重建一次，等待中的提交会用到新进程池"""
+        if broken is None or broken is not self._executor:
+            return
+        self.restarts_total += 1
+        self.logger.error(f"进程池工作进程异常退出(提交自插件 {plugin_name})，正在重建进程池")
+        self._executor = None
+        _shutdown_executor(broken, wait=False)
+    
+    def recycle(self, plugin_name):
+        """插件重载后调用：该插件用过进程池时换一批工作进程，正在执行的任务在旧进程中继续完成
+        
+        工作进程由所有插件共用，回收会替换整个进程池，其他插件随后的任务也在新进程中执行（首次提交时重新启动进程）。
+        """
+        if plugin_name not in self._quotas or self._executor is None:
+            return False
+        executor, self._executor = self._executor, None
+        executor.shutdown(wait=False)
+        self.recycles_total += 1
+        self.logger.info(f"插件 {plugin_name} 已重载，进程池将使用新的工作进程")
+        return True
+    
+    def _processes(self, executor):
+        return list((getattr(executor, "_processes", None) or {}).values())
+    
+    def terminate(self):
+        """立即结束所有工作进程（用于进程直接退出前）"""
+        self._closed = True
+        executor, self._executor = self._executor, None
+        if executor is None:
+            return
+        for process in self._processes(executor):
+            if process.is_alive():
+                process.terminate()
+        _shutdown_executor(executor, wait=False)
+    
+    async def shutdown(self, timeout=None):
+        """取消排队中的任务并等待工作进程退出，超时后强制结束"""
+        self._closed = True
+        executor, self._executor = self._executor, None
+        if executor is None:
+            return
+        
+        processes = self._processes(executor)
+        loop = asyncio.get_running_loop()
+        try:
+            await asyncio.wait_for(
+                loop.run_in_executor(None, functools.partial(_shutdown_executor, executor, wait=True)),
+                timeout=timeout or Config.PROCESS_POOL_SHUTDOWN_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            self.logger.warning("进程池关闭超时，强制结束工作进程")
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+    
+    def get_stats(self):
+        executor = self._executor
+        return {
+            "max_workers": self.max_workers,
+            "workers_alive": sum(1 for process in self._processes(executor) if process.is_alive()) if executor else 0,
+            "restarts_total": self.restarts_total,
+            "recycles_total": self.recycles_total,
+            "plugins": {plugin_name: quota.get_stats() for plugin_name, quota in list(self._quotas.items())}
+        }
+
+class ProcessTask:
+    """process_task 装饰后的函数：await 调用时在进程池中执行，直接调用 .func 则在当前进程执行"""
+    def __init__(self, func, pool):
+        self.func = func
+        self.pool = pool
+        self.module_name = func.__module__
+        self.qualname = func.__qualname__
+        functools.update_wrapper(self, func)
+    
+    def __call__(self, *args, **kwargs):
+        return self.pool.run(self.module_name, _run_process_task, self.module_name, self.qualname, args, kwargs)
+
+def process_task(func):
+    """把插件模块中的顶层函数标记为在进程池中执行，配额按函数所在插件计算
+    
+    @process_task
+    def render(text): ...
+    
+    image = await render(text)
+    """
+    return ProcessTask(func, process_pool)
+
+process_pool = ProcessPoolManager()
@@ -10,15 +10,25 @@ import gc
 import importlib
 import asyncio
 import aiohttp
+import traceback
+from collections import deque
 from datetime import datetime
 import logging
 from config import Config
+from shared_state import global_state
+from metrics import LatencyHistogram
+from process_pool import process_pool
 
 class PluginContext:
-    def __init__(self, plugin_name, global_state, plugin_state_accessor):
+    def __init__(self, plugin_name, global_state, plugin_state_accessor, command_registrar=None, member_store=None,
+                 connection_pool=None, process_pool=None):
         self.plugin_name = plugin_name
-        self.global_state = global_state  
-        self.shared = plugin_state_accessor 
+        self.global_state = global_state
+        self.shared = plugin_state_accessor
+        self.commands = command_registrar
+        self.members = member_store
+        self._connection_pool = connection_pool
+        self._process_pool = process_pool
         self.logger = self._setup_logger(plugin_name)
         self.active_tasks = set()
         
@@ -29,8 +39,7 @@ class PluginContext:
         for handler in logger.handlers[:]:
             logger.removeHandler(handler)
         
-        base_dir = os.path.dirname(os.path.abspath(__file__))
-        logs_dir = os.path.join(base_dir, 'logs')
+        logs_dir = Config.get_logs_dir()
         if not os.path.exists(logs_dir):
             os.makedirs(logs_dir)
         
@@ -46,6 +55,18 @@ class PluginContext:
         
         return logger
     
+    async def get_http_session(self):
+        """获取框架共享的 aiohttp 会话，用完不要关闭"""
+        if self._connection_pool is None:
+            raise RuntimeError("连接池不可用")
+        return await self._connection_pool.get_session()
+    
+    async def run_in_process(self, func, *args, **kwargs):
+        """在框架进程池中执行CPU密集的顶层函数，占用本插件的进程池配额；函数、参数和返回值须可 pickle"""
+        if self._process_pool is None:
+            raise RuntimeError("进程池不可用")
+        return await self._process_pool.run(self.plugin_name, func, *args, **kwargs)
+    
     def register_task(self, task):
         self.active_tasks.add(task)
         task.add_done_callback(lambda t: self.active_tasks.discard(t))
@@ -73,26 +94,113 @@ class PluginContext:
             del logging.Logger.manager.loggerDict[plugin_logger_name]
 
 class ConnectionPool:
-    def __init__(self, max_connections=100):
-        self.max_connections = max_connections
+    """BotAPI 与插件共用的HTTP连接池"""
+    def __init__(self, max_connections=None, limit_per_host=None, keepalive_timeout=None):
+        self.max_connections = max_connections or Config.HTTP_POOL_MAX_CONNECTIONS
+        self.limit_per_host = limit_per_host if limit_per_host is not None else Config.HTTP_POOL_LIMIT_PER_HOST
+        self.keepalive_timeout = keepalive_timeout or Config.HTTP_POOL_KEEPALIVE_TIMEOUT
         self.connector = None
         self.session = None
         self._lock = threading.Lock()
+        self._init_lock = None
+        self.stats = {
+            "waiting": 0,
+            "max_waiting": 0,
+            "connections_created": 0,
+            "connections_reused": 0,
+            "requests_in_flight": 0
+        }
+    
+    def _build_trace_config(self):
+        trace_config = aiohttp.TraceConfig()
+        stats = self.stats
+        
+        async def on_queued_start(session, ctx, params):
+            stats["waiting"] += 1
+            stats["max_waiting"] = max(stats["max_waiting"], stats["waiting"])
+        
+        async def on_queued_end(session, ctx, params):
+            stats["waiting"] = max(0, stats["waiting"] - 1)
+        
+        async def on_create_end(session, ctx, params):
+            stats["connections_created"] += 1
         
+        async def on_reuse(session, ctx, params):
+            stats["connections_reused"] += 1
+        
+        async def on_request_start(session, ctx, params):
+            stats["requests_in_flight"] += 1
+        
+        async def on_request_done(session, ctx, params):
+            stats["requests_in_flight"] = max(0, stats["requests_in_flight"] - 1)
+        
+        trace_config.on_connection_queued_start.append(on_queued_start)
+        trace_config.on_connection_queued_end.append(on_queued_end)
+        trace_config.on_connection_create_end.append(on_create_end)
+        trace_config.on_connection_reuseconn.append(on_reuse)
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_request_end.append(on_request_done)
+        trace_config.on_request_exception.append(on_request_done)
+        return trace_config
+    
     async def init_pool(self):
-        connector = aiohttp.TCPConnector(
+        if self.session is not None and not self.session.closed:
+            return self.session
+        
+        self.connector = aiohttp.TCPConnector(
             limit=self.max_connections,
-            limit_per_host=10,
+            limit_per_host=self.limit_per_host,
             ttl_dns_cache=300,
+            keepalive_timeout=self.keepalive_timeout,
             enable_cleanup_closed=True
         )
-        self.session = aiohttp.ClientSession(connector=connector)
+        self.session = aiohttp.ClientSession(connector=self.connector, trace_configs=[self._build_trace_config()])
         return self.session
     
+    async def get_session(self):
+        """获取共享会话，调用方不要关闭它"""
+        if self.session is None or self.session.closed:
+            if self._init_lock is None:
+                self._init_lock = asyncio.Lock()
+            async with self._init_lock:
+                await self.init_pool()
+        return self.session
+    
+    async def prewarm(self, url, count):
+        """启动时并发建立若干连接并放回池中，避免首批请求排队建连"""
+        if count <= 0:
+            return 0
+        
+        session = await self.get_session()
+        timeout = aiohttp.ClientTimeout(total=5)
+        
+        async def open_one():
+            async with session.head(url, timeout=timeout, allow_redirects=False) as response:
+                await response.read()
+        
+        results = await asyncio.gather(*(open_one() for _ in range(min(count, self.limit_per_host or count))), return_exceptions=True)
+        return sum(1 for result in results if not isinstance(result, BaseException))
+    
+    def get_stats(self):
+        active = 0
+        idle = 0
+        if self.connector is not None and not self.connector.closed:
+            active = len(getattr(self.connector, "_acquired", ()))
+            idle = sum(len(conns) for conns in getattr(self.connector, "_conns", {}).values())
+        
+        return dict(
+            self.stats,
+            active=active,
+            idle=idle,
+            limit=self.max_connections,
+            limit_per_host=self.limit_per_host
+        )
+    
     async def close(self):
         if self.session:
             await self.session.close()
             self.session = None
+            self.connector = None
 
 class RequestQueue:
     def __init__(self, max_queue_size=1000, max_workers=10):
@@ -137,6 +245,284 @@ class RequestQueue:
             except Exception:
                 continue
 
+class LoopWatchdog:
+    """事件循环卡顿看门狗：循环内定时打点测量延迟，独立线程发现长时间没有打点时抓取主线程堆栈定位插件"""
+    def __init__(self, logger, plugins_dir, interval=None, threshold=None, warn_interval=None):
+        self.logger = logger
+        self.plugins_dir = os.path.join(os.path.abspath(plugins_dir), "")
+        self.interval = interval or Config.LOOP_LAG_SAMPLE_INTERVAL
+        self.threshold = threshold or Config.LOOP_LAG_WARN_THRESHOLD
+        self.warn_interval = warn_interval or Config.LOOP_LAG_WARN_INTERVAL
+        self.histogram = LatencyHistogram()
+        self.last_lag = 0.0
+        self.max_stall = 0.0
+        self.blocked_by_plugin = {}
+        self.suppressed_warnings = 0
+        self._loop = None
+        self._loop_thread_id = None
+        self._handle = None
+        self._thread = None
+        self._stop_event = threading.Event()
+        self._last_beat = time.monotonic()
+        self._reported_beat = None
+        self._last_warn = {}
+    
+    def start(self):
+        """必须在事件循环线程中调用"""
+        if self._thread is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._stop_event.clear()
+        self._last_beat = time.monotonic()
+        self._handle = self._loop.call_later(self.interval, self._beat, self._loop.time() + self.interval)
+        self._thread = threading.Thread(target=self._watch, name="LoopWatchdog", daemon=True)
+        self._thread.start()
+    
+    def stop(self):
+        self._stop_event.set()
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval * 2)
+            self._thread = None
+    
+    def _beat(self, expected):
+        now = self._loop.time()
+        lag = max(0.0, now - expected)
+        self.last_lag = lag
+        self.histogram.record(lag)
+        self._last_beat = time.monotonic()
+        if not self._stop_event.is_set():
+            self._handle = self._loop.call_later(self.interval, self._beat, now + self.interval)
+    
+    def _watch(self):
+        while not self._stop_event.wait(self.interval):
+            last_beat = self._last_beat
+            stall = time.monotonic() - last_beat - self.interval
+            if stall < self.threshold or self._reported_beat == last_beat:
+                continue
+            
+            # 同一次卡顿只报告一次
+            self._reported_beat = last_beat
+            self.max_stall = max(self.max_stall, stall)
+            try:
+                self._report(stall)
+            except Exception as e:
+                self.logger.debug(f"看门狗抓取堆栈失败: {str(e)}")
+    
+    def _report(self, stall):
+        frame = sys._current_frames().get(self._loop_thread_id)
+        if frame is None:
+            return
+        
+        culprit, location = self._attribute(frame)
+        self.blocked_by_plugin[culprit] = self.blocked_by_plugin.get(culprit, 0) + 1
+        
+        now = time.monotonic()
+        if now - self._last_warn.get(culprit, 0) < self.warn_interval:
+            self.suppressed_warnings += 1
+            return
+        self._last_warn[culprit] = now
+        
+        stack = "".join(traceback.format_stack(frame, limit=12))
+        self.logger.warning(f"事件循环已阻塞 {stall:.2f} 秒，疑似来源: {culprit} ({location})，"
+                            f"插件中请勿调用阻塞代码(requests、time.sleep 等)\n{stack}")
+    
+    def _attribute(self, frame):
+        """从最内层向外找第一个位于插件目录的栈帧"""
+        innermost = frame
+        while frame is not None:
+            filename = frame.f_code.co_filename
+            if filename.startswith(self.plugins_dir):
+                module = os.path.splitext(os.path.relpath(filename, self.plugins_dir))[0].replace(os.sep, ".")
+                return module, f"{os.path.basename(filename)}:{frame.f_lineno} {frame.f_code.co_name}"
+            frame = frame.f_back
+        
+        module = innermost.f_globals.get("__name__", "unknown")
+        return module, f"{os.path.basename(innermost.f_code.co_filename)}:{innermost.f_lineno} {innermost.f_code.co_name}"
+    
+    def get_stats(self):
+        return {
+            "last_lag_ms": round(self.last_lag * 1000, 3),
+            "p50_ms": self.histogram.percentile(0.50),
+            "p95_ms": self.histogram.percentile(0.95),
+            "p99_ms": self.histogram.percentile(0.99),
+            "max_lag_ms": round(self.histogram.max, 3),
+            "max_stall_ms": round(self.max_stall * 1000, 3),
+            "samples": self.histogram.count,
+            "blocked_by_plugin": dict(self.blocked_by_plugin),
+            "suppressed_warnings": self.suppressed_warnings
+        }
+
+class EventIngressQueue:
+    """有界事件接收队列，固定数量的工作协程消费，队列满时按溢出策略丢弃或拒绝
+    
+    溢出策略:
+    drop_oldest - 丢弃队列中最早的事件
+    priority    - 按 post_type 优先级丢弃队列中优先级最低的事件，新事件优先级更低时直接丢弃新事件
+    reject      - 拒绝新事件，HTTP 上报返回 503 由后端重试
+    """
+    OVERFLOW_POLICIES = ("drop_oldest", "priority", "reject")
+    STATS_PUBLISH_INTERVAL = 1.0
+    
+    def __init__(self, handler, logger, max_size=None, workers=None, overflow_policy=None, priorities=None):
+        self.handler = handler
+        self.logger = logger
+        self.max_size = max(1, max_size or Config.EVENT_QUEUE_MAX_SIZE)
+        self.worker_count = max(1, workers or Config.EVENT_QUEUE_WORKERS)
+        self.overflow_policy = overflow_policy or Config.EVENT_QUEUE_OVERFLOW_POLICY
+        if self.overflow_policy not in self.OVERFLOW_POLICIES:
+            self.logger.warning(f"未知的事件队列溢出策略 {self.overflow_policy}，已改用 drop_oldest")
+            self.overflow_policy = "drop_oldest"
+        self.priorities = priorities if priorities is not None else Config.EVENT_QUEUE_PRIORITIES
+        self.default_priority = self.priorities.get("default", 1)
+        
+        self._buckets = {}
+        self._size = 0
+        self._seq = 0
+        self._not_empty = asyncio.Event()
+        self.workers = []
+        self.is_running = False
+        
+        self.enqueued_total = 0
+        self.processed_total = 0
+        self.dropped_total = 0
+        self.rejected_total = 0
+        self.dropped_by_type = {}
+        self.max_depth_seen = 0
+        self._last_publish = 0
+    
+    def _priority_of(self, event):
+        return self.priorities.get(event.get("post_type"), self.default_priority)
+    
+    def _oldest_bucket(self):
+        oldest = None
+        for bucket in self._buckets.values():
+            if bucket and (oldest is None or bucket[0][0] < oldest[0][0]):
+                oldest = bucket
+        return oldest
+    
+    def _lowest_priority_bucket(self):
+        for priority in sorted(self._buckets):
+            if self._buckets[priority]:
+                return priority, self._buckets[priority]
+        return None, None
+    
+    def _record_drop(self, event):
+        self.dropped_total += 1
+        post_type = event.get("post_type", "unknown")
+        self.dropped_by_type[post_type] = self.dropped_by_type.get(post_type, 0) + 1
+        if self.dropped_total == 1 or self.dropped_total % 1000 == 0:
+            self.logger.warning(f"事件接收队列已满 ({self.max_size})，按 {self.overflow_policy} 策略丢弃事件，累计丢弃: {self.dropped_total}")
+    
+    def put_nowait(self, event):
+        """放入事件，返回 queued / dropped / rejected"""
+        priority = self._priority_of(event)
+        
+        if self._size >= self.max_size:
+            if self.overflow_policy == "reject":
+                self.rejected_total += 1
+                self.publish_stats()
+                return "rejected"
+            
+            if self.overflow_policy == "priority":
+                victim_priority, victim_bucket = self._lowest_priority_bucket()
+                if victim_bucket is None or priority < victim_priority:
+                    self._record_drop(event)
+                    self.publish_stats()
+                    return "dropped"
+            else:
+                victim_bucket = self._oldest_bucket()
+            
+            _, victim = victim_bucket.popleft()
+            self._size -= 1
+            self._record_drop(victim)
+        
+        self._seq += 1
+        self._buckets.setdefault(priority, deque()).append((self._seq, event))
+        self._size += 1
+        self.enqueued_total += 1
+        if self._size > self.max_depth_seen:
+            self.max_depth_seen = self._size
+        self._not_empty.set()
+        
+        self.publish_stats()
+        return "queued"
+    
+    def _pop(self):
+        bucket = self._oldest_bucket()
+        if bucket is None:
+            return None
+        _, event = bucket.popleft()
+        self._size -= 1
+        if not self._size:
+            self._not_empty.clear()
+        return event
+    
+    async def start(self):
+        self.is_running = True
+        self.workers = [
+            asyncio.create_task(self._worker())
+            for _ in range(self.worker_count)
+        ]
+    
+    async def stop(self):
+        self.is_running = False
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        self.publish_stats(force=True)
+    
+    async def _worker(self):
+        while self.is_running:
+            try:
+                await self._not_empty.wait()
+                event = self._pop()
+                if event is None:
+                    continue
+                
+                try:
+                    await self.handler(event)
+                except Exception as e:
+                    self.logger.error(f"事件队列处理事件出错: {str(e)}", exc_info=Config.ENABLE_DEBUG)
+                finally:
+                    self.processed_total += 1
+            except asyncio.CancelledError:
+                break
+            except Exception:
+                continue
+    
+    def get_stats(self):
+        return {
+            "queue_depth": self._size,
+            "max_size": self.max_size,
+            "max_depth_seen": self.max_depth_seen,
+            "workers": self.worker_count,
+            "overflow_policy": self.overflow_policy,
+            "enqueued_total": self.enqueued_total,
+            "processed_total": self.processed_total,
+            "dropped_total": self.dropped_total,
+            "rejected_total": self.rejected_total,
+            "dropped_by_type": dict(self.dropped_by_type)
+        }
+    
+    def publish_stats(self, force=False):
+        """把队列统计写入全局状态，热路径上按固定间隔节流"""
+        now = time.monotonic()
+        if not force and now - self._last_publish < self.STATS_PUBLISH_INTERVAL:
+            return
+        self._last_publish = now
+        global_state._update_ingress_stats(
+            queue_depth=self._size,
+            dropped_total=self.dropped_total,
+            rejected_total=self.rejected_total,
+            enqueued_total=self.enqueued_total,
+            max_depth_seen=self.max_depth_seen
+        )
+
 class ServerManager:
     def __init__(self, config, logger):
         self.config = config
@@ -144,6 +530,8 @@ class ServerManager:
         self._stop_event = asyncio.Event()
         self.tasks = []
         self.connection_pool = ConnectionPool()
+        self.process_pool = process_pool
+        self.process_pool.logger = logger
         self.request_queue = RequestQueue()
         self.installed_modules = set()
         
@@ -155,6 +543,7 @@ class ServerManager:
         self._stop_event.set()
         await self.request_queue.stop()
         await self.connection_pool.close()
+        await self.process_pool.shutdown()
         
         for task in self.tasks:
             if not task.done():
@@ -179,6 +568,7 @@ class ServerManager:
     async def graceful_shutdown(self, signum=None, frame=None):
         self.logger.info("收到关闭信号，正在关闭服务器...")
         self._stop_event.set()
+        self.process_pool.terminate()
         self.cleanup_pycache()
         os._exit(0)
     
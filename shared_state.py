@@ -40,6 +40,12 @@ class GlobalState:
             self._global_vars["framework.performance.api_requests_failed"] = 0
             self._global_vars["framework.performance.plugin_timeouts"] = 0
             
+            self._global_vars["framework.ingress.queue_depth"] = 0
+            self._global_vars["framework.ingress.queue_max_depth"] = 0
+            self._global_vars["framework.ingress.enqueued_total"] = 0
+            self._global_vars["framework.ingress.dropped_total"] = 0
+            self._global_vars["framework.ingress.rejected_total"] = 0
+            
             self._global_vars["framework.system.last_cleanup_time"] = None
             self._global_vars["framework.system.last_reload_check"] = None
             self._global_vars["framework.system.is_healthy"] = True
@@ -176,6 +182,29 @@ class GlobalState:
                     self._security_hashes[key] = self._calculate_value_hash(self._global_vars[key])
                     self._value_hashes[key] = self._calculate_value_hash(self._global_vars[key])
     
+    def _update_ingress_stats(self, queue_depth: int = None, dropped_total: int = None,
+                              rejected_total: int = None, enqueued_total: int = None,
+                              max_depth_seen: int = None):
+        """更新事件接收队列统计 - 仅框架内部使用"""
+        with self._lock:
+            if queue_depth is not None:
+                self._global_vars["framework.ingress.queue_depth"] = queue_depth
+            if max_depth_seen is not None:
+                self._global_vars["framework.ingress.queue_max_depth"] = max_depth_seen
+            if enqueued_total is not None:
+                self._global_vars["framework.ingress.enqueued_total"] = enqueued_total
+            if dropped_total is not None:
+                self._global_vars["framework.ingress.dropped_total"] = dropped_total
+            if rejected_total is not None:
+                self._global_vars["framework.ingress.rejected_total"] = rejected_total
+            
+            for key in ["framework.ingress.queue_depth", "framework.ingress.queue_max_depth",
+                       "framework.ingress.enqueued_total", "framework.ingress.dropped_total",
+                       "framework.ingress.rejected_total"]:
+                if key in self._global_vars:
+                    self._security_hashes[key] = self._calculate_value_hash(self._global_vars[key])
+                    self._value_hashes[key] = self._calculate_value_hash(self._global_vars[key])
+    
     def _increment_plugin_timeout(self):
         """增加插件超时计数 - 仅框架内部使用"""
         with self._lock:
@@ -0,0 +1,194 @@
+import hmac
+import asyncio
+import json
+import time
+import aiohttp
+from aiohttp import web
+from config import Config
+
+class WebSocketEventTransport:
+    """OneBot WebSocket 事件通道
+    
+    反向 WebSocket: NapCat 主动连接框架的 REVERSE_WS_PATH
+    正向 WebSocket: 框架主动连接 FORWARD_WS_URL，断线后自动重连
+    收到的事件帧交给 on_event，与 HTTP 上报走同一条处理流程；
+    带 echo 的动作响应帧交给 on_response，可发送动作的连接通过 on_connect/on_disconnect 通知。
+    """
+    API_ROLES = ("Universal", "API")
+    
+    def __init__(self, logger, on_event, on_response=None, on_connect=None, on_disconnect=None):
+        self.logger = logger
+        self.on_event = on_event
+        self.on_response = on_response
+        self.on_connect = on_connect
+        self.on_disconnect = on_disconnect
+        self.connections = set()
+        self._forward_ws = None
+        self._session = None
+        
+        self.frames_received = 0
+        self.events_received = 0
+        self.frames_invalid = 0
+        self.frames_ignored = 0
+        self.responses_received = 0
+        self.connections_total = 0
+        self.reconnect_count = 0
+        self.auth_failures = 0
+        self.last_frame_time = None
+    
+    @staticmethod
+    def _token_equals(value, expected):
+        """定长时间比较，避免通过响应时间逐字符猜出 Token"""
+        return hmac.compare_digest(value.encode("utf-8", "replace"), expected.encode("utf-8", "replace"))
+    
+    def _check_token(self, request):
+        authorization = request.headers.get("Authorization", "")
+        if self._token_equals(authorization, f"Bearer {Config.TOKEN}") or self._token_equals(authorization, f"Token {Config.TOKEN}"):
+            return True
+        return self._token_equals(request.query.get("access_token", ""), Config.TOKEN)
+    
+    def _handle_frame(self, raw):
+        self.frames_received += 1
+        self.last_frame_time = time.time()
+        
+        try:
+            data = json.loads(raw)
+        except (ValueError, TypeError):
+            self.frames_invalid += 1
+            if Config.ENABLE_DEBUG:
+                self.logger.debug("收到无法解析的WebSocket帧，已忽略")
+            return
+        
+        if not isinstance(data, dict):
+            self.frames_invalid += 1
+            return
+        
+        try:
+            if "post_type" in data:
+                self.events_received += 1
+                self.on_event(data)
+            elif "echo" in data and self.on_response is not None:
+                self.responses_received += 1
+                self.on_response(data)
+            else:
+                self.frames_ignored += 1
+        except Exception as e:
+            # 单个帧处理失败不能中断读取循环，否则整个WebSocket连接会被断开
+            self.frames_invalid += 1
+            self.logger.error(f"处理WebSocket帧失败: {type(e).__name__}: {e}")
+    
+    async def _read_loop(self, ws, source):
+        async for msg in ws:
+            if msg.type == aiohttp.WSMsgType.TEXT:
+                self._handle_frame(msg.data)
+            elif msg.type == aiohttp.WSMsgType.BINARY:
+                self._handle_frame(msg.data.decode("utf-8", errors="replace"))
+            elif msg.type == aiohttp.WSMsgType.ERROR:
+                self.logger.warning(f"{source} WebSocket连接异常: {ws.exception()}")
+                break
+    
+    async def reverse_ws_handler(self, request):
+        """反向 WebSocket 入口，注册到 aiohttp 路由"""
+        if not self._check_token(request):
+            self.auth_failures += 1
+            self.logger.warning(f"反向WebSocket Token验证失败: {request.remote}")
+            return web.Response(status=401, text="Unauthorized")
+        
+        ws = web.WebSocketResponse(heartbeat=Config.WS_HEARTBEAT_INTERVAL, max_msg_size=Config.WS_MAX_MSG_SIZE)
+        await ws.prepare(request)
+        
+        self.connections.add(ws)
+        self.connections_total += 1
+        self_id = request.headers.get("X-Self-ID", "unknown")
+        role = request.headers.get("X-Client-Role", "Universal")
+        self.logger.info(f"反向WebSocket已连接: {request.remote} (账号: {self_id}, 角色: {role})")
+        
+        accepts_actions = role in self.API_ROLES
+        if accepts_actions and self.on_connect is not None:
+            self.on_connect(ws)
+        
+        try:
+            await self._read_loop(ws, "反向")
+        finally:
+            self.connections.discard(ws)
+            if accepts_actions and self.on_disconnect is not None:
+                self.on_disconnect(ws)
+            self.logger.info(f"反向WebSocket已断开: {request.remote}")
+        
+        return ws
+    
+    async def forward_ws_worker(self, stop_event):
+        """正向 WebSocket 客户端，断线后按指数退避自动重连"""
+        self.logger.info(f"正向WebSocket任务已启动: {Config.FORWARD_WS_URL}")
+        
+        headers = {"Authorization": f"Bearer {Config.TOKEN}"}
+        retry_interval = Config.WS_RECONNECT_INTERVAL
+        self._session = aiohttp.ClientSession()
+        
+        try:
+            while not stop_event.is_set():
+                try:
+                    async with self._session.ws_connect(
+                        Config.FORWARD_WS_URL,
+                        headers=headers,
+                        heartbeat=Config.WS_HEARTBEAT_INTERVAL,
+                        max_msg_size=Config.WS_MAX_MSG_SIZE
+                    ) as ws:
+                        self._forward_ws = ws
+                        self.connections.add(ws)
+                        self.connections_total += 1
+                        retry_interval = Config.WS_RECONNECT_INTERVAL
+                        self.logger.info(f"正向WebSocket已连接: {Config.FORWARD_WS_URL}")
+                        
+                        if self.on_connect is not None:
+                            self.on_connect(ws)
+                        
+                        try:
+                            await self._read_loop(ws, "正向")
+                        finally:
+                            self.connections.discard(ws)
+                            self._forward_ws = None
+                            if self.on_disconnect is not None:
+                                self.on_disconnect(ws)
+                    
+                    if not stop_event.is_set():
+                        self.logger.warning("正向WebSocket连接已断开，准备重连")
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self.logger.warning(f"正向WebSocket连接失败: {str(e)}，{retry_interval}秒后重试")
+                
+                if stop_event.is_set():
+                    break
+                
+                self.reconnect_count += 1
+                try:
+                    await asyncio.wait_for(stop_event.wait(), timeout=retry_interval)
+                except asyncio.TimeoutError:
+                    pass
+                retry_interval = min(retry_interval * 2, Config.WS_RECONNECT_MAX_INTERVAL)
+        finally:
+            await self._session.close()
+            self._session = None
+    
+    async def close(self):
+        for ws in list(self.connections):
+            try:
+                await ws.close()
+            except Exception:
+                pass
+        self.connections.clear()
+    
+    def get_stats(self):
+        return {
+            "active_connections": len(self.connections),
+            "connections_total": self.connections_total,
+            "reconnect_count": self.reconnect_count,
+            "frames_received": self.frames_received,
+            "events_received": self.events_received,
+            "frames_invalid": self.frames_invalid,
+            "frames_ignored": self.frames_ignored,
+            "responses_received": self.responses_received,
+            "auth_failures": self.auth_failures,
+            "last_frame_time": self.last_frame_time
+        }